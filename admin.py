@@ -1,7 +1,8 @@
 """Renders admin pages for ops and other management tasks.
 
-Currently just ``/admin/responses``, which shows active responses with tasks that
-haven't completed yet.
+Includes ``/admin/responses``, which shows active responses with tasks that
+haven't completed yet, and ``/admin/deliveries``, which shows their pending
+webmentions grouped by target domain.
 """
 import datetime
 import itertools
@@ -24,6 +25,8 @@ import bluesky, flickr, github, mastodon, reddit, tumblr, wordpress_rest
 logger = logging.getLogger(__name__)
 
 NUM_ENTITIES = 10
+# max responses and blog posts to load for /admin/deliveries
+NUM_DELIVERY_ENTITIES = 500
 
 # Result of this query in BigQuery:
 # SELECT count(*) FROM `brid-gy.datastore.Response` WHERE updated < timestamp('2021-11-01T00:00:00Z')
@@ -68,6 +71,29 @@ def responses():
   return render_template('admin_responses.html', responses=entities, logs=logs)
 
 
+@app.route('/admin/deliveries')
+def deliveries():
+  """Pending webmentions, grouped by target domain, with each domain's health."""
+  domains = {}
+  for cls in (Response, BlogPost):
+    query = cls.query(cls.status.IN(('new', 'processing', 'error')))
+    for e in query.fetch(NUM_DELIVERY_ENTITIES):
+      for url in util.dedupe_urls(e.unsent + e.error):
+        domain = util.domain_from_link(url)
+        domains.setdefault(domain, []).append((url, e))
+
+  names = sorted(domains, key=lambda d: (-len(domains[d]), d))
+  healths = ndb.get_multi(ndb.Key(models.InstanceHealth,
+                                  models.webmention_domain_key(d))
+                          for d in names)
+
+  return render_template(
+    'admin_deliveries.html',
+    domains=[(d, health, domains[d]) for d, health in zip(names, healths)],
+    logs=logs,
+  )
+
+
 @app.route('/admin/sources')
 def sources():
   """Find sources whose last poll errored out."""
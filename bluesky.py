@@ -30,6 +30,11 @@ class Bluesky(models.Source):
           domain=GR_CLASS.DOMAIN,
           # Bluesky does not support HEAD requests.
           redirects=False)
+  # the AppView allows 3000 calls per IP per 5m, ie 10/s, shared by everyone. a
+  # poll makes one call for the author feed plus up to three per recent post
+  # for its thread, likes, and reposts, so around 20.
+  THROTTLE_RATE = .4
+  THROTTLE_BURST = 20
 
   @staticmethod
   def new(auth_entity, **kwargs):
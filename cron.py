@@ -2,13 +2,14 @@
 """
 from builtins import range
 from datetime import datetime, timedelta, timezone
-import itertools
 import logging
+import random
 
 from flask import g
 from flask.views import View
 from google.cloud import ndb
 from webutil.models import StringIdModel
+from webutil.util import json_dumps
 import requests
 
 from bluesky import Bluesky
@@ -18,6 +19,7 @@ from mastodon import Mastodon
 from reddit import Reddit
 import models
 from models import Source
+import poll_scheduler
 import util
 
 logger = logging.getLogger(__name__)
@@ -25,6 +27,12 @@ logger = logging.getLogger(__name__)
 CIRCLECI_TOKEN = util.read('circleci_token')
 PAGE_SIZE = 20
 
+# replace_poll_tasks fetches this many sources per query page, runs for at most
+# this long, and spreads the new poll tasks' ETAs over this long
+REPLACE_POLL_TASKS_PAGE_SIZE = 500
+REPLACE_POLL_TASKS_DEADLINE = timedelta(minutes=5)
+REPLACE_POLL_TASKS_SPREAD = timedelta(minutes=30)
+
 
 class LastUpdatedPicture(StringIdModel):
   """Stores the last user in a given silo that we updated profile picture for.
@@ -36,18 +44,101 @@ class LastUpdatedPicture(StringIdModel):
   updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
 
 
+class ReplacePollTasksCursor(StringIdModel):
+  """Stores where :func:`replace_poll_tasks` left off in a given silo.
+
+  Key id is the silo's ``SHORT_NAME``.
+  """
+  last_poll_attempt = ndb.DateTimeProperty(tzinfo=timezone.utc)
+  updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
+
+
 @app.route('/cron/replace_poll_tasks')
 def replace_poll_tasks():
-  """Finds sources missing their poll tasks and adds new ones."""
-  queries = [cls.query(Source.features == 'listen', Source.status == 'enabled',
-                       Source.last_poll_attempt <  util.now() - timedelta(days=2))
-             for cls in models.sources.values() if cls.AUTO_POLL]
-  for source in itertools.chain(*queries):
-    age = util.now() - source.last_poll_attempt
-    logger.info(f'{source.bridgy_url()} last polled {age} ago. Adding new poll task.')
-    util.add_poll_task(source)
-
-  return ''
+  """Finds sources missing their poll tasks and adds new ones.
+
+  Only loads the properties that :func:`util.add_poll_task` needs, via
+  projection queries. Pages through each silo's stale sources, oldest first,
+  and stops each silo after its share of :const:`REPLACE_POLL_TASKS_DEADLINE`.
+  Stores the last ``last_poll_attempt`` it reached in
+  :class:`ReplacePollTasksCursor` so that the next run resumes there. (Query
+  cursors don't work across runs, since the cutoff changes.) Sources at
+  exactly that value get tasks again, but the extras are dropped as duplicates
+  when they run.
+  """
+  start = util.now()
+  cutoff = start - timedelta(days=2)
+  classes = [cls for cls in models.sources.values() if cls.AUTO_POLL]
+  budget = REPLACE_POLL_TASKS_DEADLINE / len(classes)
+  spread = REPLACE_POLL_TASKS_SPREAD.total_seconds()
+
+  counts = {}
+  for i, cls in enumerate(classes):
+    deadline = start + budget * (i + 1)
+    state = ReplacePollTasksCursor.get_by_id(cls.SHORT_NAME)
+    resume = state.last_poll_attempt if state else None
+    filters = [cls.features == 'listen', cls.status == 'enabled',
+               cls.last_poll_attempt < cutoff]
+    if resume:
+      filters.append(cls.last_poll_attempt >= resume)
+    query = cls.query(*filters).order(cls.last_poll_attempt)
+
+    count = 0
+    cursor = last = None
+    while True:
+      sources, cursor, more = query.fetch_page(
+        REPLACE_POLL_TASKS_PAGE_SIZE, start_cursor=cursor,
+        projection=[cls.last_poll_attempt, cls.last_polled])
+      count += len(sources)
+      with util.task_batch():
+        for source in sources:
+          # spread out the new tasks to prevent thundering herds
+          util.add_poll_task(source, eta=start + timedelta(
+            seconds=random.uniform(1, spread)))
+      if sources:
+        last = sources[-1].last_poll_attempt
+
+      if not more:
+        last = None
+        break
+      elif util.now() >= deadline:
+        logger.info(f'Out of time for {cls.SHORT_NAME}, will resume next run')
+        break
+
+    if last or resume:
+      ReplacePollTasksCursor(id=cls.SHORT_NAME, last_poll_attempt=last).put()
+
+    counts[cls.SHORT_NAME] = count
+    if count:
+      logger.info(f'{cls.SHORT_NAME}: added poll tasks for {count} sources not polled since {cutoff}')
+
+  return json_dumps(counts), {'Content-Type': 'application/json'}
+
+
+@app.route('/cron/update_poll_budget')
+def update_poll_budget():
+  """Recomputes the poll interval scale that fits :const:`POLL_BUDGET`.
+
+  Stores it in :class:`models.PollBudget`, which :meth:`Source.poll_period`
+  uses.
+  """
+  now = util.now()
+  schedules = []
+  for cls in models.sources.values():
+    if not cls.AUTO_POLL:
+      continue
+    for source in cls.query(cls.features == 'listen', cls.status == 'enabled'):
+      if source.uses_poll_scheduler(now):
+        schedules.append(poll_scheduler.schedule(source, now))
+      else:
+        schedules.append((None, source.poll_period(), None, None))
+
+  scale = poll_scheduler.budget_scale(schedules)
+  models.PollBudget(id=models.PollBudget.ID, scale=scale,
+                    sources=len(schedules)).put()
+  logger.info(f'Poll budget scale for {len(schedules)} sources: {scale}')
+  return json_dumps({'scale': scale, 'sources': len(schedules)}), {
+    'Content-Type': 'application/json'}
 
 
 class UpdatePictures(View):
@@ -70,12 +161,17 @@ class UpdatePictures(View):
     results, _, more = query.fetch_page(PAGE_SIZE)
     for source in results:
       if source.features and source.status != 'disabled':
+        if source.circuit_open():
+          continue
         user_id = self.user_id(source)
         logger.debug(f'checking for updated profile pictures for {source.bridgy_url()} {user_id}')
         try:
-          actor = source.gr_source.get_actor(user_id)
+          with source.concurrency_slot():
+            actor = source.gr_source.get_actor(user_id)
+          source.record_health()
         except BaseException as e:
           logger.debug('Failed', exc_info=True)
+          source.record_health(e)
           # Mastodon API returns HTTP 404 for deleted (etc) users, and
           # often one or more users' Mastodon instances are down.
           code, _ = util.interpret_http_exception(e)
@@ -24,6 +24,11 @@ class Flickr(models.Source):
   # Fetching comments and likes is extremely request-intensive, so let's dial
   # back the frequency for now.
   FAST_POLL = datetime.timedelta(minutes=60)
+  # Flickr allows 3600 calls per hour per API key, ie 1/s, across all of our
+  # users. a poll makes a few calls per recent photo for its comments and
+  # favorites, so around 20.
+  THROTTLE_RATE = .05
+  THROTTLE_BURST = 10
   GR_CLASS = gr_flickr.Flickr
   OAUTH_START = oauth_flickr.Start
   SHORT_NAME = 'flickr'
@@ -16,20 +16,23 @@ URL paths are:
   e.g. /rsvp/facebook/212038/12345/67890
 """
 import datetime
+import hashlib
 import logging
 import re
 import string
 from urllib.parse import unquote
 
-from flask import request
+from flask import make_response, request
 from flask.views import View
+from google.cloud import ndb
 from granary import microformats2
 from granary.microformats2 import first_props
 from webutil import flask_util
 from webutil.flask_util import error
-from webutil.util import json_loads
+from webutil.util import json_dumps, json_loads
 
 from flask_app import app
+import item_cache
 import models
 import original_post_discovery
 import util
@@ -38,6 +41,20 @@ logger = logging.getLogger(__name__)
 
 CACHE_CONTROL = {'Cache-Control': 'public, max-age=900'}  # 15m
 
+# serve permalinks from stored Responses updated within this long; older ones
+# come from the silo
+STORED_RESPONSE_MAX_AGE = datetime.timedelta(days=7)
+# max likes, reposts, or RSVPs per post to look through in load_response
+MAX_RESPONSES_PER_POST = 1000
+# labels between the post id and the responder's id in like, repost, and RSVP
+# ids that granary generates, eg tag:foo.com,2013:123_favorited_by_456, so that
+# load_response can usually get them by key instead of scanning
+RESPONSE_ID_LABELS = {
+  'like': ('liked_by', 'favorited_by'),
+  'repost': ('reblogged_by', 'reposted_by', 'shared_by'),
+  'rsvp': ('rsvp',),
+}
+
 TEMPLATE = string.Template("""\
 <!DOCTYPE html>
 <html>
@@ -111,6 +128,94 @@ class Item(View):
     except Exception as e:
       util.interpret_http_exception(e)
 
+  def stored_item(self, type, post_id, response_id=None):
+    """Builds an object from the stored :class:`models.Response`, if any.
+
+    Lets us serve permalinks without calling the silo API. Only uses responses
+    whose data we fetched from the silo within :const:`STORED_RESPONSE_MAX_AGE`,
+    except for Twitter, which we can't fetch from anymore.
+
+    Args:
+      type (str): :attr:`models.Response.type`
+      post_id (str): site-specific post or event id
+      response_id (str): site-specific id from the URL path: the comment or
+        reaction id, or the id of the user who liked, reposted, or RSVPed. Not
+        used for ``post``.
+
+    Returns:
+      dict: AS1 object, or None
+    """
+    resp = self.load_response(type, post_id, response_id)
+    if not resp:
+      return None
+
+    is_twitter = self.source.SHORT_NAME == 'twitter'
+    fetched = resp.fetched or resp.created
+    if not is_twitter and fetched < util.now() - STORED_RESPONSE_MAX_AGE:
+      logger.info(f'Stored response {resp.key.id()} is stale')
+      return None
+
+    response = json_loads(resp.response_json)
+    if type == 'post':
+      activity = response
+    else:
+      post_tag = self.source.gr_source.tag_uri(post_id)
+      activity = None
+      for activity_json in resp.activities_json:
+        a = json_loads(activity_json)
+        if a.get('id') == post_tag:
+          activity = a
+          break
+      else:
+        if not is_twitter:
+          return None
+        # no activity means no original post discovery, but Twitter has no
+        # other option
+        return response
+
+    logger.info(f'Using stored response {resp.key.id()}')
+    return item_cache.build(self.source, type, response, activity)
+
+  def load_response(self, type, post_id, response_id=None):
+    """Loads the stored :class:`models.Response` for a permalink, if any.
+
+    Comment, reaction, and post ids are the response's id, as are Twitter
+    repost ids, which are the retweet's id. Other like, repost, and RSVP ids in
+    our URLs are only the id of the user who responded, so we also try the ids
+    that granary generates for them, eg ``tag:foo.com,2013:123_favorited_by_456``,
+    and if none of those exist, look for a response to the post whose id ends
+    with the user's id.
+
+    Returns:
+      models.Response: or None
+    """
+    def valid(resp):
+      return (resp and resp.source == self.source.key and resp.type == type
+              and resp.response_json)
+
+    tag_uri = self.source.gr_source.tag_uri
+    ids = [tag_uri(response_id or post_id)]
+    if response_id:
+      ids += [tag_uri(f'{post_id}_{label}_{response_id}')
+              for label in RESPONSE_ID_LABELS.get(type, ())]
+
+    for resp in ndb.get_multi([ndb.Key(models.Response, id) for id in ids]):
+      if valid(resp):
+        return resp
+
+    if type in ('like', 'repost', 'rsvp'):
+      prefix = tag_uri(f'{post_id}_')
+      suffix = f'_{response_id}'
+      keys = models.Response.query(
+        models.Response.key >= ndb.Key(models.Response, prefix),
+        models.Response.key < ndb.Key(models.Response, prefix + '\ufffd'),
+      ).fetch(MAX_RESPONSES_PER_POST, keys_only=True)
+      for key in keys:
+        if key.id().endswith(suffix) and key.id() not in ids:
+          resp = key.get()
+          if valid(resp):
+            return resp
+
   @flask_util.headers(CACHE_CONTROL)
   def dispatch_request(self, site, key_id, **kwargs):
     """Handle HTTP request."""
@@ -145,6 +250,30 @@ class Item(View):
     if request.method == 'HEAD':
       return ''
 
+    cache_key = (site, key_id, tuple(kwargs.values()), format, request.scheme)
+    with util.item_cache_lock:
+      cached = util.item_cache.get(cache_key)
+    if cached is None:
+      cached = self.render(format, **kwargs)
+      with util.item_cache_lock:
+        util.item_cache[cache_key] = cached
+
+    body, content_type, etag = cached
+    resp = make_response(body)
+    resp.headers['Content-Type'] = content_type
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+  def render(self, format, **kwargs):
+    """Loads the object with :meth:`get_item` and renders it.
+
+    Args:
+      format (str): ``html`` or ``json``
+      kwargs: passed to :meth:`get_item`
+
+    Returns:
+      (str body, str content type, str ETag) tuple
+    """
     try:
       obj = self.get_item(**kwargs)
     except models.DisableSource:
@@ -153,7 +282,7 @@ class Item(View):
       error(f'{self.source.GR_CLASS.NAME} error: {e}')
 
     if not obj:
-      error(f'Not found: {site}:{key_id} {kwargs}', 404)
+      error(f'Not found: {self.source.SHORT_NAME}:{self.source.key_id()} {kwargs}', 404)
 
     if self.source.is_blocked(obj):
       error('That user is currently blocked', 410)
@@ -186,50 +315,32 @@ class Item(View):
     # write the response!
     if format == 'html':
       url = obj.get('url', '')
-      return TEMPLATE.substitute({
+      body = TEMPLATE.substitute({
         'refresh': (f'<meta http-equiv="refresh" content="0;url={url}">'
                     if url else ''),
         'url': url,
         'body': microformats2.json_to_html(mf2_json),
         'title': obj.get('title') or obj.get('content') or 'Bridgy Response',
       })
+      content_type = 'text/html; charset=utf-8'
     elif format == 'json':
-      return mf2_json
-
-  def merge_urls(self, obj, property, urls, object_type='article'):
-    r"""Updates an object's ActivityStreams URL objects in place.
-
-    Adds all URLs in urls that don't already exist in ``obj[property]``\.
-
-    ActivityStreams schema details:
-    http://activitystrea.ms/specs/json/1.0/#id-comparison
+      body = json_dumps(mf2_json, sort_keys=True)
+      content_type = 'application/json'
 
-    Args:
-      obj (dict): ActivityStreams object to merge URLs into
-      property (str): property to merge URLs into
-      urls (sequence of str): URLs to add
-      object_type (str): stored as the objectType alongside each URL
-    """
-    if obj:
-      obj[property] = util.get_list(obj, property)
-      existing = set(filter(None, (u.get('url') for u in obj[property])))
-      obj[property] += [{'url': url, 'objectType': object_type} for url in urls
-                        if url not in existing]
+    etag = hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+    return body, content_type, etag
 
 
 # Note that mention links are included in posts and comments, but not
 # likes, reposts, or rsvps. Matches logic in poll() (step 4) in tasks.py!
 class Post(Item):
   def get_item(self, post_id):
-    posts = None
+    obj = self.stored_item('post', post_id)
+    if obj or self.source.SHORT_NAME == 'twitter':
+      return obj
 
-    if self.source.SHORT_NAME == 'twitter':
-      resp = models.Response.get_by_id(self.source.gr_source.tag_uri(post_id))
-      if resp and resp.response_json:
-        posts = [json_loads(resp.response_json)]
-    else:
-      posts = self.source.get_activities(activity_id=post_id,
-                                         user_id=self.source.key_id())
+    posts = self.source.get_activities(activity_id=post_id,
+                                       user_id=self.source.key_id())
     if not posts:
       return None
 
@@ -239,81 +350,73 @@ class Post(Item):
     obj = post.get('object') or post
     obj['upstreamDuplicates'] = list(
       set(util.get_list(obj, 'upstreamDuplicates')) | originals)
-    self.merge_urls(obj, 'tags', mentions, object_type='mention')
+    item_cache.merge_urls(obj, 'tags', mentions, object_type='mention')
     return obj
 
 
 class Comment(Item):
   def get_item(self, post_id, comment_id):
-    if self.source.SHORT_NAME == 'twitter':
-      cmt = post = None
-      resp = models.Response.get_by_id(self.source.gr_source.tag_uri(comment_id))
-      if resp and resp.response_json:
-        cmt = json_loads(resp.response_json)
-        if resp.activities_json:
-          for activity in resp.activities_json:
-            activity = json_loads(activity)
-            if activity.get('id') == self.source.gr_source.tag_uri(post_id):
-              post = activity
-
-    else:
-      fetch_replies = not self.source.gr_source.OPTIMIZED_COMMENTS
-      post = self.get_post(post_id, fetch_replies=fetch_replies)
-      has_replies = (post.get('object', {}).get('replies', {}).get('items')
-                     if post else False)
-      cmt = self.source.get_comment(
-        comment_id, activity_id=post_id, activity_author_id=self.source.key_id(),
-        activity=post if fetch_replies or has_replies else None)
+    cmt = self.stored_item('comment', post_id, comment_id)
+    if cmt or self.source.SHORT_NAME == 'twitter':
+      return cmt
+
+    fetch_replies = not self.source.gr_source.OPTIMIZED_COMMENTS
+    post = self.get_post(post_id, fetch_replies=fetch_replies)
+    has_replies = (post.get('object', {}).get('replies', {}).get('items')
+                   if post else False)
+    cmt = self.source.get_comment(
+      comment_id, activity_id=post_id, activity_author_id=self.source.key_id(),
+      activity=post if fetch_replies or has_replies else None)
 
     if post:
       originals, mentions = original_post_discovery.discover(
         self.source, post, fetch_hfeed=False)
-      self.merge_urls(cmt, 'inReplyTo', originals)
-      self.merge_urls(cmt, 'tags', mentions, object_type='mention')
+      item_cache.merge_urls(cmt, 'inReplyTo', originals)
+      item_cache.merge_urls(cmt, 'tags', mentions, object_type='mention')
     return cmt
 
 
 class Like(Item):
   def get_item(self, post_id, user_id):
+    like = self.stored_item('like', post_id, user_id)
+    if like:
+      return like
+
     post = self.get_post(post_id, fetch_likes=True)
     like = self.source.get_like(self.source.key_id(), post_id, user_id,
                                 activity=post)
     if post:
       originals, mentions = original_post_discovery.discover(
         self.source, post, fetch_hfeed=False)
-      self.merge_urls(like, 'object', originals)
+      item_cache.merge_urls(like, 'object', originals)
     return like
 
 
 class Reaction(Item):
   def get_item(self, post_id, user_id, reaction_id):
+    reaction = self.stored_item('react', post_id, reaction_id)
+    if reaction:
+      return reaction
+
     post = self.get_post(post_id)
     reaction = self.source.gr_source.get_reaction(
       self.source.key_id(), post_id, user_id, reaction_id, activity=post)
     if post:
       originals, mentions = original_post_discovery.discover(
         self.source, post, fetch_hfeed=False)
-      self.merge_urls(reaction, 'object', originals)
+      item_cache.merge_urls(reaction, 'object', originals)
     return reaction
 
 
 class Repost(Item):
   def get_item(self, post_id, share_id):
-    if self.source.SHORT_NAME == 'twitter':
-      repost = post = None
-      resp = models.Response.get_by_id(self.source.gr_source.tag_uri(share_id))
-      if resp and resp.response_json:
-        repost = json_loads(resp.response_json)
-        if resp.activities_json:
-          for activity in resp.activities_json:
-            activity = json_loads(activity)
-            if activity.get('id') == self.source.gr_source.tag_uri(post_id):
-              post = activity
+    repost = self.stored_item('repost', post_id, share_id)
+    if repost or self.source.SHORT_NAME == 'twitter':
+      return repost
 
-    else:
-      post = self.get_post(post_id, fetch_shares=True)
-      repost = self.source.gr_source.get_share(
-        self.source.key_id(), post_id, share_id, activity=post)
+    post = self.get_post(post_id, fetch_shares=True)
+    repost = self.source.gr_source.get_share(
+      self.source.key_id(), post_id, share_id, activity=post)
 
     # webmention receivers don't want to see their own post in their
     # comments, so remove attachments before rendering.
@@ -322,20 +425,24 @@ class Repost(Item):
     if post:
       originals, mentions = original_post_discovery.discover(
         self.source, post, fetch_hfeed=False)
-      self.merge_urls(repost, 'object', originals)
+      item_cache.merge_urls(repost, 'object', originals)
 
     return repost
 
 
 class Rsvp(Item):
   def get_item(self, event_id, user_id):
+    rsvp = self.stored_item('rsvp', event_id, user_id)
+    if rsvp:
+      return rsvp
+
     event = self.source.gr_source.get_event(event_id)
     rsvp = self.source.gr_source.get_rsvp(
       self.source.key_id(), event_id, user_id, event=event)
     if event:
       originals, mentions = original_post_discovery.discover(
         self.source, event, fetch_hfeed=False)
-      self.merge_urls(rsvp, 'inReplyTo', originals)
+      item_cache.merge_urls(rsvp, 'inReplyTo', originals)
     return rsvp
 
 
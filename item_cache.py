@@ -0,0 +1,72 @@
+"""Builds the objects that :mod:`handlers` permalinks serve for responses.
+
+Webmention receivers fetch our source URLs, eg ``/comment/...``, right after we
+send them, often several times. :class:`handlers.Item` builds what it serves
+from the stored :class:`models.Response` when it can, so that it doesn't need
+the silo API.
+"""
+import copy
+
+import original_post_discovery
+import util
+
+
+def merge_urls(obj, property, urls, object_type='article'):
+  r"""Updates an object's ActivityStreams URL objects in place.
+
+  Adds all URLs in urls that don't already exist in ``obj[property]``\.
+
+  ActivityStreams schema details:
+  http://activitystrea.ms/specs/json/1.0/#id-comparison
+
+  Args:
+    obj (dict): ActivityStreams object to merge URLs into
+    property (str): property to merge URLs into
+    urls (sequence of str): URLs to add
+    object_type (str): stored as the objectType alongside each URL
+  """
+  if obj:
+    obj[property] = util.get_list(obj, property)
+    existing = set(filter(None, (u.get('url') for u in obj[property])))
+    obj[property] += [{'url': url, 'objectType': object_type} for url in urls
+                      if url not in existing]
+
+
+def build(source, type, response, activity):
+  """Builds the object that :class:`handlers.Item` serves for a response.
+
+  Matches the ``get_item`` methods in :mod:`handlers`.
+
+  Args:
+    source (models.Source)
+    type (str): :attr:`models.Response.type`
+    response (dict): AS1 response
+    activity (dict): AS1 activity that the response is to. For ``post``
+      responses, the post itself.
+
+  Returns:
+    dict: AS1 object
+  """
+  activity = copy.deepcopy(activity)
+  originals, mentions = original_post_discovery.discover(
+    source, activity, fetch_hfeed=False)
+
+  if type == 'post':
+    obj = activity.get('object') or activity
+    obj['upstreamDuplicates'] = list(
+      set(util.get_list(obj, 'upstreamDuplicates')) | originals)
+    merge_urls(obj, 'tags', mentions, object_type='mention')
+    return obj
+
+  obj = copy.deepcopy(response)
+  if type == 'comment':
+    merge_urls(obj, 'inReplyTo', originals)
+    merge_urls(obj, 'tags', mentions, object_type='mention')
+  elif type == 'rsvp':
+    merge_urls(obj, 'inReplyTo', originals)
+  else:
+    if type == 'repost':
+      obj.pop('attachments', None)
+    merge_urls(obj, 'object', originals)
+
+  return obj
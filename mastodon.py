@@ -73,6 +73,16 @@ class Mastodon(models.Source):
   }
   DISABLE_HTTP_CODES = ('401', '403', '404')
   USERNAME_KEY_ID = True
+  # Mastodon's default rate limits are 300 calls per account and 7500 per IP
+  # per 5m, ie 25/s, and all of our calls to an instance come from a few IPs. a
+  # poll makes one call for the timeline plus up to three per recent status for
+  # its replies, favorites, and boosts, so around 20, and discover makes a few.
+  # this leaves room for publish and other users of the same IPs.
+  THROTTLE_RATE = .5
+  THROTTLE_BURST = 30
+  THROTTLE_CONCURRENCY = 2
+  # instances go down regularly, and they take all of their users with them
+  CIRCUIT_BREAKER = True
 
   @property
   def URL_CANONICALIZER(self):
@@ -101,6 +111,10 @@ class Mastodon(models.Source):
     """Returns the Mastodon instance domain, e.g. ``foo.com`` ."""
     return self._split_address()[1]
 
+  def throttle_key(self):
+    """Throttles each instance separately."""
+    return f'{self.SHORT_NAME} {self.instance()}'
+
   def _split_address(self):
     split = self.key_id().split('@')
     assert len(split) == 3 and split[0] == '', self.key_id()
@@ -145,8 +159,8 @@ class Mastodon(models.Source):
         # scope, which the block list API endpoint requires. just skip them.
         # https://console.cloud.google.com/errors/CMfA_KfIld6Q2AE
         logger.info("Couldn't fetch block list due to missing OAuth scope")
-        self.blocked_ids = []
-        self.put()
+        self.poll_cache().blocked_ids = []
+        self.put_poll_cache()
       else:
         raise
 
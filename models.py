@@ -1,9 +1,16 @@
 """Datastore model classes."""
+import contextlib
+import contextvars
 from datetime import datetime, timedelta, timezone
+import hashlib
 import logging
+import math
 import os
+import random
 import re
+import threading
 
+from google.api_core.exceptions import Conflict
 from google.cloud import ndb
 from granary import as1
 from granary import microformats2
@@ -16,6 +23,7 @@ from webutil.models import StringIdModel
 from webutil.util import json_dumps, json_loads
 import requests
 
+import poll_scheduler
 import superfeedr
 import util
 
@@ -33,10 +41,75 @@ REFETCH_HFEED_TRIGGER = datetime.fromtimestamp(-1, tz=timezone.utc)
 # https://cloud.google.com/datastore/docs/concepts/limits
 BLOCKLIST_MAX_IDS = 20000
 
+# InstanceHealth circuit breaker: open after this many consecutive failures,
+# for CIRCUIT_OPEN_MIN, doubling with each failure after that up to
+# CIRCUIT_OPEN_MAX. when it expires, one caller gets a trial call, and the
+# circuit stays open for everyone else for up to CIRCUIT_TRIAL_TIMEOUT while
+# it's in progress.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_MIN = timedelta(minutes=10)
+CIRCUIT_OPEN_MAX = timedelta(hours=6)
+CIRCUIT_TRIAL_TIMEOUT = timedelta(minutes=5)
+
+# concurrency_slot() semaphores, keyed by eg Source.throttle_key()
+_concurrency_semaphores = {}
+_concurrency_semaphores_lock = threading.Lock()
+
+# max entities per transaction in Webmentions.get_or_save_multi. the datastore
+# allows 500, but Responses can be big, and requests are limited to 10MB.
+# https://cloud.google.com/datastore/docs/concepts/limits
+GET_OR_SAVE_BATCH_SIZE = 100
+
+# when get_or_save_multi stores at least this many new Responses for a source,
+# they're propagated together in propagate-batch tasks of up to
+# PROPAGATE_BATCH_SIZE each instead of one propagate task each.
+PROPAGATE_BATCH_MIN = 10
+PROPAGATE_BATCH_SIZE = 20
+
+# Response._pre_put_hook rewrites a response's ResponseSummary when its content
+# changes, and otherwise when its stored updated value is at least this old, so
+# that the user page's order by updated tracks Response.updated without a
+# summary write for every lease and status change.
+RESPONSE_SUMMARY_UPDATED_RESOLUTION = timedelta(hours=1)
+
+# the ResponseSummarys that Response._post_put_hook defers to
+# Webmentions.get_or_save_multi, which writes them in bulk, if any. maps key to
+# ResponseSummary.
+_summary_batch = contextvars.ContextVar('summary_batch', default=None)
+
+# TokenBucket shards at most this many entities per bucket...
+TOKEN_BUCKET_MAX_SHARDS = 10
+# ...and if taking a token fails due to datastore contention, callers defer
+# this long instead of failing
+TOKEN_BUCKET_CONTENTION_DELAY = timedelta(seconds=30)
+
 # maps string short name to Source subclass. populated by SourceMeta.
 sources = {}
 
 
+def concurrency_slot(key, limit):
+  """Returns a context manager that limits concurrent calls in this process.
+
+  Blocks until a slot is available.
+
+  Args:
+    key (str): calls with the same key share the limit
+    limit (int): max concurrent calls. If falsy, doesn't limit.
+  """
+  if not limit:
+    return contextlib.nullcontext()
+
+  with _concurrency_semaphores_lock:
+    return _concurrency_semaphores.setdefault(
+      key, threading.BoundedSemaphore(limit))
+
+
+def webmention_domain_key(domain):
+  """Returns the :class:`InstanceHealth` and :class:`TokenBucket` key id for a
+  webmention target domain."""
+  return f'webmention {domain}'
+
+
 def get_type(obj):
   """Returns the :class:`Response` or :class:`Publish` type for an AS object."""
   type = obj.get('objectType')
@@ -114,6 +187,19 @@ class Source(StringIdModel, metaclass=SourceMeta):
   RATE_LIMIT_HTTP_CODES = ('429',)
   DISABLE_HTTP_CODES = ('401',)
   TRANSIENT_ERROR_HTTP_CODES = ()
+  # budget for poll and discover tasks, which call the silo API, shared by all
+  # sources with the same throttle_key(). tasks per second and max burst. None
+  # means unlimited. see TokenBucket.
+  THROTTLE_RATE = None
+  THROTTLE_BURST = None
+  # max concurrent silo API fetches by poll and discover tasks per
+  # throttle_key() in each process. the poll, poll-now, and discover queues
+  # together run up to 13 tasks at once. None means unlimited. see
+  # concurrency_slot().
+  THROTTLE_CONCURRENCY = None
+  # whether to track API failures per throttle_key() and stop calling it while
+  # it's down. see InstanceHealth.
+  CIRCUIT_BREAKER = False
   # whether granary supports fetching block lists
   HAS_BLOCKS = False
   # whether to require a u-syndication link for backfeed
@@ -176,16 +262,31 @@ class Source(StringIdModel, metaclass=SourceMeta):
 
   last_activity_id = ndb.StringProperty()
   last_activities_etag = ndb.StringProperty()
+  # legacy. these now live in this source's PollCache, so that polls don't
+  # rewrite them along with the poll status and timestamps. they're still read
+  # if it doesn't exist yet, and cleared when it's first written.
   last_activities_cache_json = ndb.TextProperty()
+  seen_responses_fingerprints = ndb.BlobProperty()
   seen_responses_cache_json = ndb.TextProperty(compressed=True)
-
-  # populated in Poll.poll(), used by handlers
   blocked_ids = ndb.JsonProperty(compressed=True)
 
+  # response arrival rate estimate for adaptive polling. decayed totals of
+  # responses found and hours polled, and number of polls. see poll_scheduler.
+  poll_rate_responses = ndb.FloatProperty()
+  poll_rate_hours = ndb.FloatProperty()
+  poll_rate_samples = ndb.IntegerProperty(default=0)
+
+  # digest of the values that the last DirectoryEntry we wrote was generated
+  # from, so we only rewrite it when they change
+  directory_digest = ndb.BlobProperty()
+
   # maps updated property names to values that put_updates() writes back to the
   # datastore transactionally. set this to {} before beginning.
   updates = None
 
+  # the PollCache, lazily loaded by poll_cache()
+  _poll_cache = None
+
   # gr_source is *not* set to None by default here, since it needs to be unset
   # for __getattr__ to run when it's accessed.
 
@@ -321,6 +422,9 @@ class Source(StringIdModel, metaclass=SourceMeta):
   def put_updates(cls, source):
     """Writes ``source.updates`` to the datastore transactionally.
 
+    Only writes the values that differ from the stored entity's. If none do,
+    skips the write entirely.
+
     Returns:
       source (Source)
 
@@ -330,13 +434,21 @@ class Source(StringIdModel, metaclass=SourceMeta):
     if not source.updates:
       return source
 
-    to_log = {k: v for k, v in source.updates.items() if not k.endswith('_json')}
-    logger.info(f'Updating {source.label()} {source.bridgy_path()} : {to_log!r}')
-
     updates = source.updates
     source = source.key.get()
     source.updates = updates
-    for name, val in updates.items():
+
+    changed = {name: val for name, val in updates.items()
+               if getattr(source, name) != val}
+    if not changed:
+      logger.info(f'No changes to {source.label()} {source.bridgy_path()}, not writing')
+      return source
+
+    to_log = {k: v for k, v in changed.items()
+              if not k.endswith('_json') and not isinstance(v, bytes)}
+    logger.info(f'Updating {source.label()} {source.bridgy_path()} : {to_log!r}')
+
+    for name, val in changed.items():
       setattr(source, name, val)
 
     source.put()
@@ -347,7 +459,9 @@ class Source(StringIdModel, metaclass=SourceMeta):
 
     Defaults to ~30m, depending on silo. If we've never sent a webmention for
     this source, or the last one we sent was over a month ago, we drop them down
-    to ~1d after a week long grace period.
+    to ~1d after a week long grace period. Once we've polled enough to estimate
+    how often this source gets responses, :mod:`poll_scheduler` picks the
+    period instead.
     """
     now = util.now()
     if self.rate_limited:
@@ -356,6 +470,8 @@ class Source(StringIdModel, metaclass=SourceMeta):
       return self.FAST_POLL
     elif not self.last_webmention_sent:
       return self.SLOW_POLL
+    elif self.uses_poll_scheduler(now):
+      return poll_scheduler.poll_period(self, now, scale=PollBudget.current_scale())
     elif (self.is_volume_user()
           and self.last_webmention_sent > now - timedelta(hours=1)):
       return self.VOLUME_POLL
@@ -366,6 +482,108 @@ class Source(StringIdModel, metaclass=SourceMeta):
     else:
       return self.SLOW_POLL
 
+  def uses_poll_scheduler(self, now):
+    """Returns True if :mod:`poll_scheduler` picks this source's poll period.
+
+    Args:
+      now (datetime.datetime)
+    """
+    return bool(not self.rate_limited
+                and now >= self.created + self.FAST_POLL_GRACE_PERIOD
+                and self.last_webmention_sent
+                and (self.poll_rate_samples or 0) >= poll_scheduler.MIN_SAMPLES)
+
+  def throttle_key(self):
+    """Returns the key of the :class:`TokenBucket` that throttles this source.
+
+    Defaults to the silo. Subclasses may override, eg per instance.
+    """
+    return self.SHORT_NAME
+
+  def throttle(self):
+    """Takes a token from this source's API call budget, if any.
+
+    Returns:
+      datetime.timedelta: how long to defer calling the silo API, or None if we
+      can call it now
+    """
+    if not self.THROTTLE_RATE:
+      return None
+
+    delay = TokenBucket.take(self.throttle_key(), self.THROTTLE_RATE,
+                             self.THROTTLE_BURST)
+    if delay:
+      logger.info(f'{self.throttle_key()} is over its API budget, deferring {delay}')
+      return delay
+
+  def concurrency_slot(self):
+    """Returns a context manager that limits concurrent silo API calls.
+
+    Shared by all sources in this process with the same :meth:`throttle_key`.
+    Blocks until a slot is available.
+    """
+    return concurrency_slot(self.throttle_key(), self.THROTTLE_CONCURRENCY)
+
+  def circuit_open(self):
+    """Checks whether this source's silo instance is down.
+
+    Returns:
+      datetime.timedelta: how long until we should try the instance's API
+      again, or None if we can call it now
+    """
+    if not self.CIRCUIT_BREAKER:
+      return None
+
+    return InstanceHealth.open_delay(self.throttle_key())
+
+  def record_health(self, error=None):
+    """Records the outcome of a silo API call in :class:`InstanceHealth`.
+
+    Only HTTP 5xx and connection failures count against the instance. Other
+    errors, eg 401 or 404, mean it responded, so they count as successes.
+
+    Args:
+      error (Exception): optional, raised by the API call
+    """
+    if not self.CIRCUIT_BREAKER:
+      return
+
+    InstanceHealth.record(self.throttle_key(),
+                          error is None or not InstanceHealth.is_failure(error))
+
+  def _pre_put_hook(self):
+    """Regenerates this source's :class:`DirectoryEntry` if its values have
+    changed since we last wrote it.
+
+    Compares against :attr:`directory_digest` as loaded with this source, so
+    most source writes, eg polls, cost no extra datastore ops.
+    """
+    entry = DirectoryEntry.for_source(self)
+    digest = entry.digest()
+    if digest != self.directory_digest:
+      self.directory_digest = digest
+      self._directory_entry = entry
+    else:
+      self._directory_entry = None
+
+  def _post_put_hook(self, future):
+    """Writes this source's :class:`DirectoryEntry`, after commit if we're in a
+    transaction."""
+    entry = getattr(self, '_directory_entry', None)
+    if not entry:
+      return
+
+    if ndb.in_transaction():
+      ndb.get_context().call_on_commit(entry.put)
+    else:
+      entry.put()
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    DirectoryEntry.key_for(cls.SHORT_NAME, cls(key=key).key_id()).delete()
+    ndb.delete_multi(FeedFetch.query(ancestor=key).fetch(keys_only=True) +
+                     [ndb.Key(PollCache, PollCache.ID, parent=key)])
+
   def should_refetch(self):
     """Returns True if we should run OPD refetch on this source now."""
     now = util.now()
@@ -862,8 +1080,8 @@ class Source(StringIdModel, metaclass=SourceMeta):
     except gr_source.RateLimited as e:
       ids = e.partial or []
 
-    self.blocked_ids = ids[:BLOCKLIST_MAX_IDS]
-    self.put()
+    self.poll_cache().blocked_ids = ids[:BLOCKLIST_MAX_IDS]
+    self.put_poll_cache()
 
   def is_blocked(self, obj):
     """Returns True if an object's author is being blocked.
@@ -873,14 +1091,55 @@ class Source(StringIdModel, metaclass=SourceMeta):
     Note that this method is tested in test_twitter.py, not test_models.py, for
     historical reasons.
     """
-    if not self.blocked_ids:
+    blocked_ids = self.poll_cache().blocked_ids
+    if not blocked_ids:
       return False
 
     for o in [obj] + util.get_list(obj, 'object'):
       for field in 'author', 'actor':
-        if o.get(field, {}).get('numeric_id') in self.blocked_ids:
+        if o.get(field, {}).get('numeric_id') in blocked_ids:
           return True
 
+  def poll_cache(self):
+    """Returns this source's :class:`PollCache`, loading it if necessary.
+
+    If it hasn't been stored yet, returns a new one populated from this source's
+    legacy properties.
+
+    Returns:
+      PollCache:
+    """
+    if self._poll_cache is None:
+      key = ndb.Key(PollCache, PollCache.ID, parent=self.key)
+      cache = key.get()
+      if cache is None:
+        cache = PollCache(key=key,
+                          activities_cache_json=self.last_activities_cache_json,
+                          seen_responses_fingerprints=self.seen_responses_fingerprints,
+                          blocked_ids=self.blocked_ids)
+        cache.stored = None
+      else:
+        cache.stored = cache.to_dict(exclude=['updated'])
+      self._poll_cache = cache
+
+    return self._poll_cache
+
+  def put_poll_cache(self):
+    """Stores this source's :class:`PollCache` if it's changed.
+
+    Also clears the legacy properties on this source via :attr:`updates`, if
+    it's set.
+    """
+    cache = self.poll_cache()
+    values = cache.to_dict(exclude=['updated'])
+    if values != cache.stored:
+      cache.put()
+      cache.stored = values
+
+    if self.updates is not None:
+      self.updates.update({name: None for name in PollCache.LEGACY_PROPERTIES
+                           if getattr(self, name) is not None})
+
 
 class Webmentions(StringIdModel):
   """A bundle of links to send webmentions for.
@@ -892,6 +1151,9 @@ class Webmentions(StringIdModel):
   source = ndb.KeyProperty()
   status = ndb.StringProperty(choices=STATUSES, default='new')
   leased_until = ndb.DateTimeProperty(tzinfo=timezone.utc)
+  # incremented by each propagate task's lease. the task only writes its
+  # outcomes if it's unchanged when it finishes.
+  version = ndb.IntegerProperty(default=0, indexed=False)
   created = ndb.DateTimeProperty(auto_now_add=True, tzinfo=timezone.utc)
   updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
 
@@ -901,6 +1163,10 @@ class Webmentions(StringIdModel):
   error = ndb.StringProperty(repeated=True)
   failed = ndb.StringProperty(repeated=True)
   skipped = ndb.StringProperty(repeated=True)
+  # maps targets in error that we're holding off on because their domain is
+  # failing or rate limited to when we first did, as integer POSIX timestamps.
+  # see tasks.SendWebmentions.
+  deferred_since = ndb.JsonProperty()
 
   def label(self):
     """Returns a human-readable string description for use in log messages.
@@ -909,13 +1175,51 @@ class Webmentions(StringIdModel):
     """
     raise NotImplementedError()
 
-  def add_task(self):
+  def add_task(self, delay=None):
     """Adds a propagate task for this entity.
 
     To be implemented by subclasses.
+
+    Args:
+      delay (datetime.timedelta): optional, run the task after this long
     """
     raise NotImplementedError()
 
+  @classmethod
+  def add_tasks(cls, entities):
+    """Adds propagate tasks for multiple entities.
+
+    Subclasses may override to propagate them together.
+
+    Args:
+      entities (sequence of Webmentions)
+    """
+    for entity in entities:
+      entity.add_task()
+
+  def pretty_links(self):
+    """Generates pretty HTML for this entity's webmention targets.
+
+    Returns:
+      dict: maps str HTML label to sorted list of str HTML links. Omits empty
+      labels.
+    """
+    def link(url, g):
+      return util.pretty_link(
+        url, glyphicon=g, attrs={'class': 'original-post u-bridgy-target'},
+        new_tab=True)
+
+    return util.trim_nulls({
+        'Failed': sorted(set(link(url, 'exclamation-sign')
+                             for url in self.error + self.failed)),
+        'Sending': sorted(set(link(url, 'transfer') for url in self.unsent
+                              if url not in self.error)),
+        'Sent': sorted(set(link(url, None) for url in self.sent
+                           if url not in (self.error + self.unsent))),
+        'No <a href="http://indiewebify.me/#send-webmentions">webmention</a> '
+        'support': sorted(set(link(url, None) for url in self.skipped)),
+      })
+
   @ndb.transactional()
   def get_or_save(self):
     entity = existing = self.key.get()
@@ -944,17 +1248,77 @@ class Webmentions(StringIdModel):
     entity.put()
     return entity
 
+  @classmethod
+  def get_or_save_multi(cls, entities, **kwargs):
+    r"""Bulk version of :meth:`get_or_save`.
+
+    Looks up all of the entities at once. Stores new ones in batched
+    transactions that only write them if they still don't exist, then their
+    :class:`ResponseSummary`\s, if any, in bulk after each one, and adds
+    their propagate tasks afterward, deleting them again if that fails. Existing entities, including new ones that
+    another request stored in the meantime, fall back to :meth:`get_or_save`
+    individually so that they're merged the same way.
+
+    Args:
+      entities (sequence of Webmentions): with unique keys
+      kwargs: passed through to :meth:`get_or_save`
+
+    Returns:
+      list of Webmentions: the stored entities, in the same order as
+      ``entities``
+    """
+    existing = ndb.get_multi([e.key for e in entities])
+    new = [e for e, got in zip(entities, existing) if not got]
+
+    @ndb.transactional()
+    def put_new(batch):
+      collided = {got.key for got in ndb.get_multi([e.key for e in batch]) if got}
+      batch = [e for e in batch if e.key not in collided]
+      for entity in batch:
+        if not (entity.unsent or entity.error):
+          entity.status = 'complete'
+      ndb.put_multi(batch)
+      return batch
+
+    stored = {}
+    to_propagate = []
+    summaries = {}
+    token = _summary_batch.set(summaries)
+    try:
+      for i in range(0, len(new), GET_OR_SAVE_BATCH_SIZE):
+        summaries.clear()
+        for entity in put_new(new[i:i + GET_OR_SAVE_BATCH_SIZE]):
+          stored[entity.key] = entity
+          if entity.unsent or entity.error:
+            logger.debug(f'New webmentions to propagate! {entity.label()}')
+            to_propagate.append(entity)
+        ndb.put_multi(list(summaries.values()))
+    finally:
+      _summary_batch.reset(token)
+
+    # Cloud Tasks can't join the datastore transactions, so if adding the tasks
+    # fails, delete the new entities so that the caller's retry stores them
+    # and adds their tasks again instead of finding them already stored.
+    try:
+      cls.add_tasks(to_propagate)
+    except BaseException:
+      logger.warning(f'Adding propagate tasks failed, deleting {len(to_propagate)} new {cls.__name__}s')
+      ndb.delete_multi([e.key for e in to_propagate])
+      raise
+
+    logger.info(f'Stored {len(stored)} new of {len(entities)} {cls.__name__}s in bulk')
+    return [stored.get(e.key) or e.get_or_save(**kwargs) for e in entities]
+
   def restart(self):
     """Moves status and targets to 'new' and adds a propagate task."""
     self.status = 'new'
     self.unsent = util.dedupe_urls(self.unsent + self.sent + self.error +
                                    self.failed + self.skipped)
     self.sent = self.error = self.failed = self.skipped = []
+    self.deferred_since = None
 
     # clear any cached webmention endpoints
-    with util.webmention_endpoint_cache_lock:
-      for url in self.unsent:
-        util.webmention_endpoint_cache.pop(util.webmention_endpoint_cache_key(url), None)
+    WebmentionEndpoint.clear(self.unsent)
 
     # this datastore put and task add should be transactional, but Cloud Tasks
     # doesn't support that :(
@@ -988,13 +1352,84 @@ class Response(Webmentions):
   urls_to_activity = ndb.TextProperty()
   # Original post links found by original post discovery
   original_posts = ndb.StringProperty(repeated=True)
+  # when we last refetched this response from the silo and stored its new data.
+  # None if we haven't since we created it.
+  fetched = ndb.DateTimeProperty(tzinfo=timezone.utc)
+  # digest of the properties that the last ResponseSummary we wrote was
+  # generated from, and when we wrote it, so we only regenerate and rewrite it
+  # when they change or it's old
+  summary_digest = ndb.BlobProperty()
+  summary_updated = ndb.DateTimeProperty(tzinfo=timezone.utc)
 
   def label(self):
     return ' '.join((self.key.kind(), self.type, self.key.id(),
                      json_loads(self.response_json).get('url', '[no url]')))
 
-  def add_task(self):
-    util.add_propagate_task(self)
+  def _pre_put_hook(self):
+    """Regenerates this response's :class:`ResponseSummary` if its inputs have
+    changed, or if its ``updated`` is older than
+    :const:`RESPONSE_SUMMARY_UPDATED_RESOLUTION`.
+
+    Status and webmention targets aren't in the summary, so leasing and
+    finishing propagate tasks only rewrite it to update ``updated``, at most
+    once per :const:`RESPONSE_SUMMARY_UPDATED_RESOLUTION`.
+    """
+    self._summary = None
+    if not self.response_json:
+      return
+
+    now = util.now()
+    digest = hashlib.blake2b(json_dumps([
+      self.type, self.response_json, self.activities_json, self.original_posts,
+    ]).encode(), digest_size=16).digest()
+    if (digest != self.summary_digest or not self.summary_updated or
+        now - self.summary_updated >= RESPONSE_SUMMARY_UPDATED_RESOLUTION):
+      self.summary_digest = digest
+      self.summary_updated = now
+      self._summary = ResponseSummary.summarize(self)
+
+  def _post_put_hook(self, future):
+    """Writes this response's :class:`ResponseSummary`, after commit if we're in
+    a transaction, or leaves it for :meth:`get_or_save_multi` to write in bulk
+    if we're inside it."""
+    if not getattr(self, '_summary', None):
+      return
+
+    summary, public = self._summary
+    entity = ResponseSummary(id=self.key.id(), source=self.source,
+                             public=public, updated=self.updated, summary=summary)
+    batch = _summary_batch.get()
+    if batch is not None:
+      batch[entity.key] = entity
+    elif ndb.in_transaction():
+      ndb.get_context().call_on_commit(entity.put)
+    else:
+      entity.put()
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    ndb.Key(ResponseSummary, key.id()).delete()
+
+  def add_task(self, delay=None):
+    util.add_propagate_task(self, delay=delay)
+
+  @classmethod
+  def add_tasks(cls, entities):
+    """Adds propagate-batch tasks for sources with lots of new responses.
+
+    Sources with fewer than :const:`PROPAGATE_BATCH_MIN` get individual
+    propagate tasks.
+    """
+    by_source = {}
+    for entity in entities:
+      by_source.setdefault(entity.source, []).append(entity)
+
+    for source, responses in by_source.items():
+      if len(responses) < PROPAGATE_BATCH_MIN:
+        super().add_tasks(responses)
+        continue
+      for i in range(0, len(responses), PROPAGATE_BATCH_SIZE):
+        util.add_propagate_batch_task(source, responses[i:i + PROPAGATE_BATCH_SIZE])
 
   @staticmethod
   def get_type(obj):
@@ -1021,6 +1456,8 @@ class Response(Webmentions):
     elif resp is self or not restart:  # ie it already existed
       return resp
 
+    resp.fetched = util.now()
+
     # merge activities_json, urls_to_activity
     urls_to_full_activities = {}
     for r in self, resp:
@@ -1067,6 +1504,92 @@ class Response(Webmentions):
     return super().restart()
 
 
+class ResponseSummary(StringIdModel):
+  """What a :class:`Response` shows on its source's user page.
+
+  Small and precomputed, so that the user page doesn't have to parse whole
+  responses. Written by :meth:`Response._post_put_hook` when the summary
+  changes, and otherwise at most every
+  :const:`RESPONSE_SUMMARY_UPDATED_RESOLUTION`. ``updated`` is the response's
+  as of then. Doesn't include the
+  response's status or webmention targets, which change as it's propagated; the
+  user page gets those from the response itself.
+
+  Key id is the response's.
+  """
+  source = ndb.KeyProperty()
+  public = ndb.BooleanProperty(required=True)
+  updated = ndb.DateTimeProperty(required=True, tzinfo=timezone.utc)
+  summary = ndb.JsonProperty()
+
+  def response_key(self):
+    return ndb.Key(Response, self.key.id())
+
+  @staticmethod
+  def summarize(resp):
+    """Generates a response's summary.
+
+    Args:
+      resp (Response)
+
+    Returns:
+      (dict, bool) tuple: the summary, and whether the response and all of its
+      activities are public
+    """
+    response = json_loads(resp.response_json)
+    activities = [json_loads(a) for a in resp.activities_json]
+    public = (as1.is_public(response) and
+              all(as1.is_public(a) for a in activities))
+    if resp.type == 'post':
+      activities = []
+
+    verb = response.get('verb')
+    actor = (response.get('object') if verb == 'invite'
+             else response.get('author') or response.get('actor')
+            ) or {}
+
+    activity_content = ''
+    for a in activities + [response]:
+      if not a.get('content'):
+        obj = a.get('object', {})
+        a['content'] = activity_content = (
+          obj.get('content') or obj.get('displayName') or
+          # historical, from a Reddit bug fixed in granary@4f9df7c
+          obj.get('name') or '')
+
+    response_content = response.get('content')
+    phrases = {
+      'like': 'liked this',
+      'repost': 'reposted this',
+      'rsvp-yes': 'is attending',
+      'rsvp-no': 'is not attending',
+      'rsvp-maybe': 'might attend',
+      'rsvp-interested': 'is interested',
+      'invite': 'is invited',
+    }
+    phrase = phrases.get(resp.type) or phrases.get(verb)
+    if phrase and (resp.type != 'repost' or
+                   activity_content.startswith(response_content)):
+      response_content = f'{actor.get("displayName") or ""} {phrase}.'
+
+    return {
+      'type': resp.type,
+      'url': response.get('url'),
+      'content': response_content,
+      'actor': {
+        'displayName': actor.get('displayName'),
+        'url': as1.get_url(actor),
+        'image': {'url': util.get_url(util.get_first(actor, 'image', {}))},
+      },
+      'activities': [{
+        'url': a.get('url') or a.get('object', {}).get('url'),
+        'content': a.get('content'),
+      } for a in activities],
+      'original_links': [util.pretty_link(url, new_tab=True)
+                         for url in resp.original_posts],
+    }, public
+
+
 class BlogPost(Webmentions):
   """A blog post to be processed for links to send webmentions to.
 
@@ -1078,8 +1601,8 @@ class BlogPost(Webmentions):
     url = self.feed_item.get('permalinkUrl') if self.feed_item else None
     return ' '.join((self.key.kind(), self.key.id(), url or '[no url]'))
 
-  def add_task(self):
-    util.add_propagate_blogpost_task(self)
+  def add_task(self, delay=None):
+    util.add_propagate_blogpost_task(self, delay=delay)
 
 
 class PublishedPage(StringIdModel):
@@ -1226,6 +1749,381 @@ class SyndicatedPost(ndb.Model):
     return r
 
 
+class TokenBucket(StringIdModel):
+  """A token bucket rate limiter, shared across instances.
+
+  Sharded into one entity per token per second of rate, since each entity
+  only sustains around one transactional write per second. Each shard gets an
+  even share of the rate and burst, and callers take from a random shard. Once
+  a shard is empty, this process remembers when it will have a token again in
+  :attr:`util.token_bucket_cache`, so that callers don't read it until then.
+
+  Key id is :meth:`Source.throttle_key`, eg ``mastodon`` or
+  ``mastodon foo.social``, with the shard number appended if there's more than
+  one, eg ``bluesky 1``.
+  """
+  tokens = ndb.FloatProperty(required=True)
+  updated = ndb.DateTimeProperty(required=True, tzinfo=timezone.utc)
+
+  @classmethod
+  def take(cls, id, rate, burst):
+    """Takes a token if one is available.
+
+    If the shard's transaction fails due to contention, defers for
+    :const:`TOKEN_BUCKET_CONTENTION_DELAY` instead of raising.
+
+    Args:
+      id (str): key id
+      rate (float): tokens added per second
+      burst (int): maximum tokens
+
+    Returns:
+      datetime.timedelta: zero if we took a token, otherwise how long until
+      one is available
+    """
+    shards = min(max(math.ceil(rate), 1), TOKEN_BUCKET_MAX_SHARDS)
+    if shards > 1:
+      id = f'{id} {random.randrange(shards)}'
+
+    now = util.now()
+    with util.token_bucket_cache_lock:
+      available = util.token_bucket_cache.get(id)
+    if available and available > now:
+      return available - now
+
+    try:
+      delay = cls._take(id, rate / shards, max(burst / shards, 1))
+    except Conflict as e:
+      logger.info(f'Token bucket {id} is contended, deferring: {e}')
+      return TOKEN_BUCKET_CONTENTION_DELAY
+
+    if delay:
+      with util.token_bucket_cache_lock:
+        util.token_bucket_cache[id] = now + delay
+    return delay
+
+  @classmethod
+  @ndb.transactional()
+  def _take(cls, id, rate, burst):
+    now = util.now()
+    bucket = cls.get_by_id(id)
+    if bucket:
+      elapsed = max((now - bucket.updated).total_seconds(), 0)
+      bucket.tokens = min(bucket.tokens + elapsed * rate, burst)
+      bucket.updated = now
+    else:
+      bucket = cls(id=id, tokens=burst, updated=now)
+
+    if bucket.tokens < 1:
+      return timedelta(seconds=(1 - bucket.tokens) / rate)
+
+    bucket.tokens -= 1
+    bucket.put()
+    return timedelta()
+
+
+class PollBudget(StringIdModel):
+  """The global poll budget's interval scale, from
+  :func:`poll_scheduler.budget_scale`.
+
+  Singleton, key id :attr:`ID`. Updated daily by ``/cron/update_poll_budget``.
+  """
+  ID = 'poll'
+
+  scale = ndb.FloatProperty(required=True)
+  sources = ndb.IntegerProperty()
+  updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
+
+  @classmethod
+  def current_scale(cls):
+    """Returns the current scale, 1 if it hasn't been computed yet.
+
+    Cached in this process for a while in :attr:`util.poll_budget_cache`.
+    """
+    with util.poll_budget_cache_lock:
+      if cls.ID in util.poll_budget_cache:
+        return util.poll_budget_cache[cls.ID]
+
+    budget = cls.get_by_id(cls.ID)
+    scale = budget.scale if budget else 1
+    with util.poll_budget_cache_lock:
+      util.poll_budget_cache[cls.ID] = scale
+    return scale
+
+
+class DirectoryEntry(StringIdModel):
+  """A user on the ``/users`` page, denormalized from a :class:`Source`.
+
+  Small, so that the page can page through them with one ordered query instead
+  of loading whole sources from every silo. Maintained by
+  :meth:`Source._pre_put_hook` and :meth:`Source._post_put_hook`. Implements the
+  parts of the :class:`Source` interface that ``profile_link.html`` uses.
+
+  Key id is the source's :meth:`Source.bridgy_path`.
+  """
+  name_lower = ndb.StringProperty(required=True)
+  silo = ndb.StringProperty(required=True)
+  enabled = ndb.BooleanProperty(required=True)
+  title = ndb.TextProperty()
+  name = ndb.TextProperty()
+  picture = ndb.TextProperty()
+  updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
+
+  @staticmethod
+  def key_for(silo, id):
+    """Returns the :class:`ndb.Key` for a silo's ``SHORT_NAME`` and key id."""
+    return ndb.Key(DirectoryEntry, f'/{silo}/{id}')
+
+  @classmethod
+  def for_source(cls, source):
+    """Returns a new, unsaved entry with a source's current values.
+
+    Args:
+      source (Source)
+
+    Returns:
+      DirectoryEntry:
+    """
+    return cls(key=cls.key_for(source.SHORT_NAME, source.key_id()),
+               name_lower=source.label_name().lower(),
+               silo=source.SHORT_NAME,
+               enabled=bool(source.features) and source.status != 'disabled',
+               title=source.label(),
+               name=source.label_name(),
+               picture=source.picture)
+
+  def digest(self):
+    """Returns a digest of this entry's key and values, as bytes."""
+    return hashlib.blake2b(json_dumps([
+      self.key.id(), self.name_lower, self.silo, self.enabled, self.title,
+      self.name, self.picture,
+    ]).encode(), digest_size=16).digest()
+
+  def bridgy_path(self):
+    return self.key.id()
+
+  @property
+  def SHORT_NAME(self):
+    return self.silo
+
+  @property
+  def GR_CLASS(self):
+    return sources[self.silo].GR_CLASS
+
+  def label(self):
+    return self.title
+
+  def label_name(self):
+    return self.name
+
+  def silo_url(self):
+    """Not stored, since ``/users`` links to Bridgy user pages instead."""
+    return None
+
+
+class InstanceHealth(StringIdModel):
+  """Circuit breaker for a remote host, eg a Mastodon server.
+
+  Counts consecutive failed API calls to the instance. After
+  :const:`CIRCUIT_FAILURE_THRESHOLD`, opens the circuit until
+  :attr:`open_until`, with exponential backoff, so that we defer polls and skip
+  other calls for all of the instance's users instead of failing each one
+  separately. When it expires, the next caller claims a trial call, and the
+  circuit stays open for everyone else until it finishes, or for
+  :const:`CIRCUIT_TRIAL_TIMEOUT`. If the trial fails, the circuit reopens for
+  longer.
+
+  Key id is :meth:`Source.throttle_key`, eg ``mastodon foo.social``, or
+  :func:`webmention_domain_key` for webmention targets, eg
+  ``webmention foo.com``.
+  """
+  failures = ndb.IntegerProperty(default=0)
+  open_until = ndb.DateTimeProperty(tzinfo=timezone.utc)
+  updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
+
+  @classmethod
+  def load(cls, id):
+    """Returns the :class:`InstanceHealth` for a key id, or None.
+
+    Uses :attr:`util.instance_health_cache`.
+    """
+    with util.instance_health_cache_lock:
+      if id in util.instance_health_cache:
+        return util.instance_health_cache[id]
+
+    health = cls.get_by_id(id)
+    with util.instance_health_cache_lock:
+      util.instance_health_cache[id] = health
+    return health
+
+  @classmethod
+  def load_multi(cls, ids):
+    r"""Loads multiple :class:`InstanceHealth`\s into :attr:`util.instance_health_cache`.
+
+    Fetches the ones that aren't already cached with one batch get, so that
+    :meth:`load` calls for them afterward don't need the datastore.
+
+    Args:
+      ids (sequence of str): key ids
+    """
+    with util.instance_health_cache_lock:
+      missing = [id for id in ids if id not in util.instance_health_cache]
+    if not missing:
+      return
+
+    healths = ndb.get_multi(ndb.Key(cls, id) for id in missing)
+    with util.instance_health_cache_lock:
+      util.instance_health_cache.update(zip(missing, healths))
+
+  @classmethod
+  def open_delay(cls, id):
+    """Checks whether a circuit is open.
+
+    If it's expired, claims the trial call for the caller. Only one caller
+    gets it.
+
+    Args:
+      id (str): key id
+
+    Returns:
+      datetime.timedelta: how long until we should try again, or None if we
+      can call it now
+    """
+    health = cls.load(id)
+    if not health or not health.open_until:
+      return None
+
+    now = util.now()
+    if health.open_until <= now:
+      claimed, health = cls._claim_trial(id)
+      with util.instance_health_cache_lock:
+        util.instance_health_cache[id] = health
+      if claimed:
+        logger.info(f'{id} circuit is half open, trying it')
+        return None
+
+    if health and health.open_until and health.open_until > now:
+      delay = health.open_until - now
+      logger.info(f"{id} is failing, deferring {delay}")
+      return delay
+
+  @classmethod
+  @ndb.transactional()
+  def _claim_trial(cls, id):
+    """Claims the trial call for an expired circuit, unless someone else has.
+
+    Returns:
+      (bool, InstanceHealth) tuple: whether we claimed it, and the current
+      entity
+    """
+    health = cls.get_by_id(id)
+    now = util.now()
+    if not health or not health.open_until or health.open_until > now:
+      return False, health
+
+    health.open_until = now + CIRCUIT_TRIAL_TIMEOUT
+    health.put()
+    return True, health
+
+  @staticmethod
+  def is_failure(error):
+    """Returns True if an exception counts against the remote host.
+
+    Only HTTP 5xx and connection failures do. Other errors, eg 401 or 404,
+    mean it responded.
+
+    Args:
+      error (Exception)
+
+    Returns:
+      bool
+    """
+    code, _ = util.interpret_http_exception(error)
+    return bool((code and code.isdigit() and int(code) >= 500)
+                or util.is_connection_failure(error))
+
+  @classmethod
+  def record(cls, id, ok):
+    """Records a successful or failed API call.
+
+    Successes only write to the datastore if there were failures to reset.
+
+    Args:
+      id (str): key id
+      ok (bool)
+    """
+    if ok:
+      health = cls.load(id)
+      if not health or not health.failures:
+        return
+
+    health = cls._record(id, ok)
+    with util.instance_health_cache_lock:
+      util.instance_health_cache[id] = health
+
+  @classmethod
+  @ndb.transactional()
+  def _record(cls, id, ok):
+    health = cls.get_by_id(id) or cls(id=id)
+
+    if ok:
+      health.failures = 0
+      health.open_until = None
+    else:
+      health.failures += 1
+      excess = health.failures - CIRCUIT_FAILURE_THRESHOLD
+      if excess >= 0:
+        health.open_until = util.now() + min(CIRCUIT_OPEN_MIN * 2 ** min(excess, 10),
+                                             CIRCUIT_OPEN_MAX)
+        logger.warning(f'{id} failed {health.failures} times in a row, opening circuit until {health.open_until}')
+
+    health.put()
+    return health
+
+
+class FeedFetch(StringIdModel):
+  """HTTP validators and digests of an author's page or rel-feed.
+
+  Stored after :mod:`original_post_discovery` processes all of the page's
+  permalinks, so that it can skip the page next time if it hasn't changed.
+
+  Child of a :class:`Source`. Key id is the URL.
+  """
+  etag = ndb.StringProperty()
+  last_modified = ndb.StringProperty()
+  content_digest = ndb.BlobProperty()
+  mf2_digest = ndb.BlobProperty()
+  # author pages only: their rel-feeds
+  feed_urls = ndb.StringProperty(repeated=True)
+  updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
+
+
+class PollCache(StringIdModel):
+  """A :class:`Source`'s poll caches and block list.
+
+  These can be large, and change much less often than the source's poll status
+  and timestamps, which each poll updates twice. Storing them separately means
+  those writes don't rewrite them. Only stored when they change.
+
+  Child of a :class:`Source`. Key id is :const:`ID`.
+  """
+  ID = 'poll'
+  # legacy Source properties that these replace. seen_responses_cache_json is
+  # the old format of seen_responses_fingerprints, which stored the full pruned
+  # JSON of each response.
+  LEGACY_PROPERTIES = ('last_activities_cache_json',
+                       'seen_responses_fingerprints',
+                       'seen_responses_cache_json', 'blocked_ids')
+
+  activities_cache_json = ndb.TextProperty()
+  # responses we've already seen and backfed, as util.encode_seen_responses()
+  # fingerprints
+  seen_responses_fingerprints = ndb.BlobProperty()
+  # populated in Poll.poll(), used by handlers
+  blocked_ids = ndb.JsonProperty(compressed=True)
+  updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
+
+
 class Domain(StringIdModel):
   """A domain owned by a user.
 
@@ -1239,3 +2137,71 @@ class Domain(StringIdModel):
   auth = ndb.KeyProperty(IndieAuth)
   created = ndb.DateTimeProperty(auto_now_add=True, tzinfo=timezone.utc)
   updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
+
+
+class WebmentionEndpoint(StringIdModel):
+  """Cached webmention endpoint discovery result for a site.
+
+  The datastore tier of the webmention endpoint cache, shared across instances
+  and restarts. The in-process tier is :attr:`util.webmention_endpoint_cache`.
+
+  Key id is :func:`util.webmention_endpoint_cache_key`, eg
+  ``https snarfed.org /``.
+  """
+  # URL, or util.NO_ENDPOINT if discovery didn't find one
+  endpoint = ndb.TextProperty()
+  expires = ndb.DateTimeProperty(tzinfo=timezone.utc)
+  updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
+
+  @classmethod
+  def load(cls, urls):
+    """Loads unexpired cached endpoints into the in-process cache.
+
+    Only looks up URLs that aren't already in the in-process cache.
+
+    Args:
+      urls (sequence of str): target URLs
+    """
+    with util.webmention_endpoint_cache_lock:
+      ids = {util.webmention_endpoint_cache_key(url) for url in urls}
+      ids = {id for id in ids if id not in util.webmention_endpoint_cache}
+
+    if not ids:
+      return
+
+    ids = list(ids)
+    now = util.now()
+    for id, entity in zip(ids, ndb.get_multi(ndb.Key(cls, id) for id in ids)):
+      with util.webmention_endpoint_cache_lock:
+        if entity and entity.expires and entity.expires > now:
+          util.webmention_endpoint_cache_stats['datastore hit'] += 1
+          util.webmention_endpoint_cache[id] = (entity.endpoint, entity.expires)
+        else:
+          util.webmention_endpoint_cache_stats['miss'] += 1
+
+  @classmethod
+  def save(cls, results):
+    """Stores discovery results.
+
+    Args:
+      results (dict): maps str :func:`util.webmention_endpoint_cache_key` to
+        (str endpoint or ``NO_ENDPOINT``, datetime expires) tuple
+    """
+    if results:
+      ndb.put_multi(cls(id=id, endpoint=endpoint, expires=expires)
+                    for id, (endpoint, expires) in results.items())
+
+  @classmethod
+  def clear(cls, urls):
+    """Removes cached endpoints for the given URLs from both tiers.
+
+    Args:
+      urls (sequence of str): target URLs
+    """
+    ids = {util.webmention_endpoint_cache_key(url) for url in urls}
+    with util.webmention_endpoint_cache_lock:
+      for id in ids:
+        util.webmention_endpoint_cache.pop(id, None)
+
+    if ids:
+      ndb.delete_multi(ndb.Key(cls, id) for id in ids)
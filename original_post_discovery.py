@@ -23,13 +23,19 @@ lookups in the following primary cases:
      *each* post permalink.
 """
 import collections
+from datetime import timedelta
+import hashlib
 import itertools
 import logging
+import threading
+
+from google.cloud import ndb
 import mf2util
 
 from granary import as1
 from granary import microformats2
 from webutil.appengine_info import DEBUG
+from webutil.util import json_dumps
 import models
 from models import SyndicatedPost
 import util
@@ -38,6 +44,11 @@ logger = logging.getLogger(__name__)
 
 MAX_PERMALINK_FETCHES = 10
 MAX_PERMALINK_FETCHES_BETA = 50
+# permalinks are fetched concurrently, at most this many per domain at once,
+# and we give up on the rest after the deadline
+PERMALINK_FETCH_THREADS = 10
+PERMALINK_FETCHES_PER_DOMAIN = 4
+PERMALINK_FETCH_DEADLINE = timedelta(seconds=60)
 MAX_FEED_ENTRIES = 100
 MAX_ORIGINAL_CANDIDATES = 10
 MAX_MENTION_CANDIDATES = 10
@@ -45,12 +56,18 @@ MAX_MENTION_CANDIDATES = 10
 # yet, or whether it's even there at all, but we only rarely hit it anyway, so
 # let's just keep it as is for now.
 MAX_ALLOWABLE_QUERIES = 30
+# length of models.FeedFetch digests
+FEED_DIGEST_BYTES = 16
 
 MF2_HTML_MIME_TYPE= 'text/mf2+html'
 
+# guards source.updates, since Poll.backfeed runs discover() for multiple
+# activities concurrently
+updates_lock = threading.RLock()
+
 
 def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
-             already_fetched_hfeeds=None):
+             already_fetched_hfeeds=None, relationships=None):
   r"""Augments the standard original post discovery algorithm with a
   reverse lookup that supports posts without a backlink or citation.
 
@@ -66,8 +83,12 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
     fetch_hfeed (bool)
     include_redirect_sources (bool): whether to include URLs that redirect as
       well as their final destination URLs
-    already_fetched_hfeeds (set of str): URLs that we have already fetched and
-      run posse-post-discovery on, so we can avoid running it multiple times
+    already_fetched_hfeeds (util.FetchTable): author URLs that we have already
+      fetched and run posse-post-discovery on, so we can avoid running it
+      multiple times. Safe to share across concurrent calls.
+    relationships (dict): optional, preloaded :class:`models.SyndicatedPost`\s
+      from :func:`load_relationships`. If the activity's syndication URL is in
+      here, we use these instead of querying the datastore.
 
   Returns:
     (set of str, set of str) tuple: (original post URLs, mention URLs)
@@ -75,11 +96,12 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
   label = activity.get('url') or activity.get('id')
   logger.debug(f'discovering original posts for: {label}')
 
-  if not source.updates:
-    source.updates = {}
+  with updates_lock:
+    if source.updates is None:
+      source.updates = {}
 
   if already_fetched_hfeeds is None:
-    already_fetched_hfeeds = set()
+    already_fetched_hfeeds = util.FetchTable()
 
   originals, mentions = as1.original_post_discovery(
     activity, domains=source.domains,
@@ -159,7 +181,8 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
     syndication_url = source.canonicalize_url(syndication_url)
     if syndication_url:
       syndicated = _posse_post_discovery(source, activity, syndication_url,
-                                         fetch_hfeed, already_fetched_hfeeds)
+                                         fetch_hfeed, already_fetched_hfeeds,
+                                         relationships=relationships)
       originals.update(syndicated)
     originals = set(util.dedupe_urls(originals))
 
@@ -184,8 +207,9 @@ def refetch(source):
   """
   logger.debug(f'attempting to refetch h-feed for {source.label()}')
 
-  if not source.updates:
-    source.updates = {}
+  with updates_lock:
+    if source.updates is None:
+      source.updates = {}
 
   results = {}
   for url in _get_author_urls(source):
@@ -194,6 +218,73 @@ def refetch(source):
   return results
 
 
+def get_syndication_url(source, activity):
+  """Returns an activity's canonicalized syndication URL, or None.
+
+  Args:
+    source (models.Source)
+    activity (dict)
+
+  Returns:
+    str:
+  """
+  obj = activity.get('object', {})
+  url = obj.get('url') or activity.get('url')
+  return source.canonicalize_url(url) if url else None
+
+
+def load_relationships(source, activities, max_workers=1):
+  r"""Loads the stored :class:`models.SyndicatedPost`\s for a batch of activities.
+
+  Looks up all of their syndication URLs at once, with ``IN`` queries of up
+  to :const:`MAX_ALLOWABLE_QUERIES` URLs each, run in parallel. Pass the result
+  to :func:`discover` so that it doesn't query for each activity separately.
+
+  Args:
+    source (models.Source)
+    activities (sequence of dict)
+    max_workers (int): threads to use to canonicalize syndication URLs, which
+      may follow redirects
+
+  Returns:
+    dict: maps canonicalized syndication URL to list of
+    :class:`models.SyndicatedPost`\s, possibly empty. Has an entry for every
+    activity's syndication URL.
+  """
+  if not source.get_author_urls():
+    return {}  # discover() won't do posse post discovery
+
+  urls = sorted(set(filter(None, util.concurrent_map(
+    lambda activity: get_syndication_url(source, activity), activities,
+    max_workers))))
+  if not urls:
+    return {}
+
+  # (prefix URL or None for exact matches, query future) tuples
+  futures = [
+    (None, SyndicatedPost.query(
+      SyndicatedPost.syndication.IN(urls[i:i + MAX_ALLOWABLE_QUERIES]),
+      ancestor=source.key).fetch_async())
+    for i in range(0, len(urls), MAX_ALLOWABLE_QUERIES)]
+
+  if source.IGNORE_SYNDICATION_LINK_FRAGMENTS:
+    # prefix searches can't be batched into IN queries, so run them all at once
+    futures += [
+      (url, SyndicatedPost.query(
+        SyndicatedPost.syndication > f'{url}#',
+        SyndicatedPost.syndication < f'{url}#\ufffd',
+        ancestor=source.key).fetch_async())
+      for url in urls]
+
+  relationships = {url: [] for url in urls}
+  for prefix, future in futures:
+    for rel in future.result():
+      relationships[prefix or rel.syndication].append(rel)
+
+  logger.info(f'Loaded {sum(len(r) for r in relationships.values())} SyndicatedPosts for {len(urls)} syndication URLs in {len(futures)} queries')
+  return relationships
+
+
 def targets_for_response(resp, originals, mentions):
   """Returns the URLs that we should send webmentions to for a given response.
 
@@ -217,7 +308,7 @@ def targets_for_response(resp, originals, mentions):
 
 
 def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
-                          already_fetched_hfeeds):
+                          already_fetched_hfeeds, relationships=None):
   """Performs the actual meat of the posse-post-discover.
 
   Args:
@@ -228,38 +319,45 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
     fetch_hfeed (bool): whether or not to fetch and parse the
       author's feed if we don't have a previously stored
       relationship
-    already_fetched_hfeeds (set of str): URLs we've already fetched in a
-      previous iteration
+    already_fetched_hfeeds (util.FetchTable): author URLs we've already
+      fetched, or are currently fetching, in a previous or concurrent
+      iteration
+    relationships (dict): optional, from :func:`load_relationships`
 
   Return:
     list of str: original post urls, possibly empty
   """
   logger.info(f'starting posse post discovery with syndicated {syndication_url}')
 
-  relationships = SyndicatedPost.query(
-    SyndicatedPost.syndication == syndication_url,
-    ancestor=source.key).fetch()
-
-  if source.IGNORE_SYNDICATION_LINK_FRAGMENTS:
-    relationships += SyndicatedPost.query(
-      # prefix search to find any instances of this synd link with a fragment
-      SyndicatedPost.syndication > f'{syndication_url}#',
-      SyndicatedPost.syndication < f'{syndication_url}#\ufffd',
+  if relationships is not None and syndication_url in relationships:
+    relationships = list(relationships[syndication_url])
+  else:
+    relationships = SyndicatedPost.query(
+      SyndicatedPost.syndication == syndication_url,
       ancestor=source.key).fetch()
 
+    if source.IGNORE_SYNDICATION_LINK_FRAGMENTS:
+      relationships += SyndicatedPost.query(
+        # prefix search to find any instances of this synd link with a fragment
+        SyndicatedPost.syndication > f'{syndication_url}#',
+        SyndicatedPost.syndication < f'{syndication_url}#\ufffd',
+        ancestor=source.key).fetch()
+
   if not relationships and fetch_hfeed:
     # a syndicated post we haven't seen before! fetch the author's URLs to see
     # if we can find it.
     #
     # TODO: Consider using the actor's url, with get_author_urls() as the
     # fallback in the future to support content from non-Bridgy users.
+    #
+    # if another activity has already fetched them this round, or is fetching
+    # them concurrently, reuse its results. they include any new relationships
+    # that it found for this syndication URL.
     results = {}
     for url in _get_author_urls(source):
-      if url not in already_fetched_hfeeds:
-        results.update(_process_author(source, url))
-        already_fetched_hfeeds.add(url)
-      else:
-        logger.debug(f'skipping {url}, already fetched this round')
+      if url in already_fetched_hfeeds:
+        logger.debug(f'reusing {url}, already fetched this round')
+      results.update(already_fetched_hfeeds.get(url, _process_author, source, url))
 
     relationships = results.get(syndication_url, [])
 
@@ -295,9 +393,31 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   if not ok:
     return {}
 
+  # if the author's page and rel-feeds haven't changed since we last processed
+  # them, there's nothing new to find. refetches also look for new syndication
+  # links on permalinks, unless the h-feed has them, and users can force that.
+  prefetched = {}
+  if (source.last_hfeed_refetch != models.REFETCH_HFEED_TRIGGER
+      and (not refetch or source.last_feed_syndication_url)):
+    unchanged, prefetched = _feeds_unchanged(source, author_url)
+    if unchanged:
+      logger.info(f"{author_url} and its rel-feeds haven't changed since we last processed them")
+      return {}
+
+  feed_fetches = []
+
+  def fetch_feed(url):
+    fetched = prefetched.pop(url, None)
+    if isinstance(fetched, tuple):
+      mf2, feed_fetch = fetched
+    else:
+      mf2, feed_fetch = _fetch_feed(source, url, resp=fetched)
+    feed_fetches.append(feed_fetch)
+    return mf2
+
   logger.debug(f'fetching author url {author_url}')
   try:
-    author_mf2 = util.fetch_mf2(author_url)
+    author_mf2 = fetch_feed(author_url)
   except AssertionError:
     raise  # for unit tests
   except BaseException:
@@ -330,17 +450,18 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   for feed_url in feed_urls:
     try:
       logger.debug(f"fetching author's rel-feed {feed_url}")
-      feed_mf2 = util.fetch_mf2(feed_url)
+      feed_mf2 = fetch_feed(feed_url)
       if not feed_mf2:
         logger.debug('nothing found')
         continue
       feeditems = _merge_hfeeds(feeditems, _find_feed_items(feed_mf2))
       domain = util.domain_from_link(feed_url)
-      if source.updates is not None and domain not in source.domains:
-        domains = source.updates.setdefault('domains', source.domains)
-        if domain not in domains:
-          logger.info(f'rel-feed found new domain {domain}! adding to source')
-          domains.append(domain)
+      with updates_lock:
+        if source.updates is not None and domain not in source.domains:
+          domains = source.updates.setdefault('domains', source.domains)
+          if domain not in domains:
+            logger.info(f'rel-feed found new domain {domain}! adding to source')
+            domains.append(domain)
 
     except AssertionError:
       raise  # reraise assertions for unit tests
@@ -384,25 +505,168 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   for r in preexisting_list:
     preexisting.setdefault(r.original, []).append(r)
 
+  # fetch and parse permalinks concurrently, then store what we found serially,
+  # in feed order
+  deadline = util.now() + PERMALINK_FETCH_DEADLINE
+  domain_semaphores = {}
+  domain_semaphores_lock = threading.Lock()
+  timed_out = False
+
+  def fetch(item):
+    nonlocal timed_out
+    permalink, entry = item
+    domain = util.domain_from_link(permalink)
+    with domain_semaphores_lock:
+      semaphore = domain_semaphores.setdefault(
+        domain, threading.BoundedSemaphore(PERMALINK_FETCHES_PER_DOMAIN))
+    with semaphore:
+      if util.now() >= deadline:
+        logger.info(f'Hit permalink fetch deadline, skipping {permalink}')
+        timed_out = True
+        return None
+      logger.debug(f'processing permalink: {permalink}')
+      return _fetch_entry(source, permalink, entry, refetch,
+                          preexisting.get(permalink, []))
+
+  fetched = util.concurrent_map(fetch, permalink_to_entry.items(),
+                                max_workers=PERMALINK_FETCH_THREADS)
+
   results = {}
-  for permalink, entry in permalink_to_entry.items():
-    logger.debug(f'processing permalink: {permalink}')
-    new_results = process_entry(
-      source, permalink, entry, refetch, preexisting.get(permalink, []),
-      store_blanks=store_blanks)
+  for new_results in _store_entries(source, fetched, store_blanks=store_blanks):
     for key, value in new_results.items():
       results.setdefault(key, []).extend(value)
 
-  if source.updates is not None and results:
+  if results:
     # keep track of the last time we've seen rel=syndication urls for
     # this author. this helps us decide whether to refetch periodically
     # and look for updates.
     # Source will be saved at the end of each round of polling
-    source.updates['last_syndication_url'] = util.now()
+    with updates_lock:
+      if source.updates is not None:
+        source.updates['last_syndication_url'] = util.now()
+
+  # only skip these pages next time if we processed every permalink
+  if store_blanks and not timed_out and all(entry[2] for entry in fetched if entry):
+    author_fetch = feed_fetches[0]
+    old = author_fetch.key.get()
+    author_fetch.feed_urls = sorted(feed_urls)
+    ndb.put_multi(feed_fetches)
+    # forget rel-feeds that the author page doesn't link to any more
+    if old:
+      ndb.delete_multi(ndb.Key(models.FeedFetch, url, parent=source.key)
+                       for url in set(old.feed_urls) - feed_urls)
 
   return results
 
 
+def _feeds_unchanged(source, author_url):
+  r"""Checks whether an author's page and rel-feeds have changed.
+
+  Uses the :class:`models.FeedFetch`\es from the last time we processed them.
+  Stops at the first one that changed. Earlier ones that returned their full
+  body, unchanged, are returned too, so that they don't have to be fetched
+  again. Ones that returned 304 have no body, so they do.
+
+  Args:
+    source (models.Source)
+    author_url (str)
+
+  Returns:
+    (bool, dict) tuple: whether none of them changed, and a dict that maps URL
+    to :func:`_fetch_feed` return value for the one that changed, if any, and
+    to :class:`requests.Response` for earlier ones with unchanged bodies
+  """
+  cached = {f.key.id(): f for f in models.FeedFetch.query(ancestor=source.key)}
+  author = cached.get(author_url)
+  if not author:
+    return False, {}
+
+  responses = {}
+  for url in [author_url] + author.feed_urls:
+    try:
+      resp = _get_feed(url, cached.get(url))
+      mf2, feed_fetch = _fetch_feed(source, url, cached.get(url), resp=resp)
+    except AssertionError:
+      raise  # for unit tests
+    except BaseException:
+      logger.info(f'Could not fetch {url}', exc_info=True)
+      return False, responses
+    if feed_fetch:
+      responses[url] = (mf2, feed_fetch)
+      return False, responses
+    if resp.status_code != 304:
+      responses[url] = resp
+
+  return True, {}
+
+
+def _get_feed(url, cached=None):
+  """Fetches an author URL or rel-feed, conditionally if ``cached`` is provided.
+
+  Args:
+    url (str)
+    cached (models.FeedFetch): from the last time we processed this URL
+
+  Returns:
+    requests.Response:
+  """
+  headers = {}
+  if cached and cached.etag:
+    headers['If-None-Match'] = cached.etag
+  if cached and cached.last_modified:
+    headers['If-Modified-Since'] = cached.last_modified
+
+  return util.requests_get(util.fragmentless(url), headers=headers)
+
+
+def _fetch_feed(source, url, cached=None, resp=None):
+  r"""Fetches an author URL or rel-feed and parses it, unless it's unchanged.
+
+  If ``cached`` is provided, sends a conditional GET with its ``ETag`` and
+  ``Last-Modified`` validators, and doesn't parse the page if it's unchanged.
+
+  Args:
+    source (models.Source)
+    url (str)
+    cached (models.FeedFetch): from the last time we processed this URL
+    resp (requests.Response): if provided, uses this instead of fetching
+
+  Returns:
+    (dict, models.FeedFetch) tuple: parsed mf2, or None if the URL isn't HTML,
+    and its new :class:`models.FeedFetch`\, not yet stored. (None, None) if
+    it hasn't changed since ``cached``.
+
+  Raises:
+    requests.RequestException: if the fetch fails
+  """
+  if resp is None:
+    resp = _get_feed(url, cached)
+  if cached and resp.status_code == 304:
+    logger.debug(f'{url} not modified')
+    return None, None
+  resp.raise_for_status()
+
+  feed_fetch = models.FeedFetch(
+    parent=source.key, id=url, etag=resp.headers.get('ETag'),
+    last_modified=resp.headers.get('Last-Modified'),
+    content_digest=_digest(resp.content))
+  if cached and feed_fetch.content_digest == cached.content_digest:
+    logger.debug(f'{url} content unchanged')
+    return None, None
+
+  mf2 = util.fetch_mf2(url, get_fn=lambda *args, **kwargs: resp)
+  feed_fetch.mf2_digest = _digest(json_dumps(mf2, sort_keys=True).encode())
+  if cached and feed_fetch.mf2_digest == cached.mf2_digest:
+    logger.debug(f'{url} mf2 unchanged')
+    return None, None
+
+  return mf2, feed_fetch
+
+
+def _digest(data):
+  return hashlib.blake2b(data, digest_size=FEED_DIGEST_BYTES).digest()
+
+
 def _merge_hfeeds(feed1, feed2):
   r"""Merge items from two ``h-feeds`` into a composite feed.
 
@@ -471,6 +735,24 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
   Returns:
     dict: maps syndicated url to a list of new :class:`models.SyndicatedPost`\s
   """
+  fetched = _fetch_entry(source, permalink, feed_entry, refetch, preexisting)
+  return _store_entries(source, [fetched], store_blanks=store_blanks)[0]
+
+
+def _fetch_entry(source, permalink, feed_entry, refetch, preexisting):
+  r"""Collects an h-entry's syndication URLs, fetching its permalink if necessary.
+
+  Doesn't write to the datastore, so it's safe to run concurrently.
+  :func:`_store_entries` stores the results.
+
+  Args: same as :func:`process_entry`
+
+  Returns:
+    tuple: (str resolved permalink, set of str syndication urls, bool whether
+    we got a definitive answer, list of preexisting
+    :class:`models.SyndicatedPost`\s), or None if we've already processed this
+    entry and aren't refetching
+  """
   # if the post has already been processed, do not add to the results
   # since this method only returns *newly* discovered relationships.
   if preexisting:
@@ -478,7 +760,7 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
     # if there is a blank entry, it should be the one and only entry,
     # but go ahead and check 'all' of them to be safe.
     if not refetch:
-      return {}
+      return None
     synds = [s.syndication for s in preexisting if s.syndication]
     if synds:
       logger.debug(f'previously found relationship(s) for original {permalink}: {synds}')
@@ -490,12 +772,15 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
   usynd_urls = {url for url in usynd if isinstance(url, str)}
   if usynd_urls:
     logger.debug(f'u-syndication links on the h-feed h-entry: {usynd_urls}')
-  results = _process_syndication_urls(source, permalink, usynd_urls, preexisting)
-  success = True
 
-  if results:
-    source.updates['last_feed_syndication_url'] = util.now()
-  elif not source.last_feed_syndication_url or not feed_entry:
+  if any(source.canonicalize_url(url) for url in usynd_urls):
+    with updates_lock:
+      source.updates['last_feed_syndication_url'] = util.now()
+    return permalink, usynd_urls, True, preexisting
+
+  syndication_urls = set()
+  success = True
+  if not source.last_feed_syndication_url or not feed_entry:
     # fetch the full permalink page if we think it might have more details
     mf2 = None
     try:
@@ -510,7 +795,6 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
       success = False
 
     if mf2:
-      syndication_urls = set()
       relsynd = mf2['rels'].get('syndication', [])
       if relsynd:
         logger.debug(f'rel-syndication links: {relsynd}')
@@ -525,37 +809,73 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
           logger.debug(f'u-syndication links: {usynd}')
         syndication_urls.update(url for url in usynd
                                 if isinstance(url, str))
-      results = _process_syndication_urls(
-        source, permalink, syndication_urls, preexisting)
 
+  return permalink, syndication_urls, success, preexisting
+
+
+def _store_entries(source, fetched, store_blanks=True):
+  r"""Stores the relationships found by :func:`_fetch_entry`.
+
+  Deletes relationships that disappeared from every entry in one batch first,
+  then inserts new and blank relationships, in order.
+
+  Args:
+    source (models.Source)
+    fetched (sequence): of :func:`_fetch_entry` return values
+    store_blanks (bool): whether we should store blank
+      :class:`models.SyndicatedPost`\s when we don't find a relationship
+
+  Returns:
+    list of dict: one for each element of ``fetched``, mapping syndicated url
+    to a list of new :class:`models.SyndicatedPost`\s
+  """
   # detect and delete SyndicatedPosts that were removed from the site
-  if success:
-    result_syndposts = list(itertools.chain(*results.values()))
-    for syndpost in preexisting:
-      if syndpost.syndication and syndpost not in result_syndposts:
-        logger.info(f'deleting relationship that disappeared: {syndpost}')
-        syndpost.key.delete()
-        preexisting.remove(syndpost)
-
-  if not results:
-    logger.debug(f'no syndication links from {permalink} to current source {source.label()}.')
-    results = {}
-    if store_blanks and not preexisting:
-      # remember that this post doesn't have syndication links for this
-      # particular source
-      logger.debug(f'saving empty relationship so that {permalink} will not be searched again')
-      SyndicatedPost.insert_original_blank(source, permalink)
-
-  # only return results that are not in the preexisting list
-  new_results = {}
-  for syndurl, syndposts_for_url in results.items():
-    for syndpost in syndposts_for_url:
-      if syndpost not in preexisting:
-        new_results.setdefault(syndurl, []).append(syndpost)
-
-  if new_results:
-    logger.debug(f'discovered relationships {new_results}')
-  return new_results
+  deletes = []
+  for entry in fetched:
+    if not entry:
+      continue
+    permalink, syndication_urls, success, preexisting = entry
+    if success:
+      urls = {source.canonicalize_url(url) for url in syndication_urls}
+      for syndpost in list(preexisting):
+        if (syndpost.syndication and not (syndpost.syndication in urls
+                                          and syndpost.original == permalink)):
+          logger.info(f'deleting relationship that disappeared: {syndpost}')
+          deletes.append(syndpost.key)
+          preexisting.remove(syndpost)
+
+  if deletes:
+    ndb.delete_multi(deletes)
+
+  all_new_results = []
+  for entry in fetched:
+    if not entry:
+      all_new_results.append({})
+      continue
+
+    permalink, syndication_urls, success, preexisting = entry
+    results = _process_syndication_urls(source, permalink, syndication_urls,
+                                        preexisting)
+    if not results:
+      logger.debug(f'no syndication links from {permalink} to current source {source.label()}.')
+      if store_blanks and not preexisting:
+        # remember that this post doesn't have syndication links for this
+        # particular source
+        logger.debug(f'saving empty relationship so that {permalink} will not be searched again')
+        SyndicatedPost.insert_original_blank(source, permalink)
+
+    # only return results that are not in the preexisting list
+    new_results = {}
+    for syndurl, syndposts_for_url in results.items():
+      for syndpost in syndposts_for_url:
+        if syndpost not in preexisting:
+          new_results.setdefault(syndurl, []).append(syndpost)
+
+    if new_results:
+      logger.debug(f'discovered relationships {new_results}')
+    all_new_results.append(new_results)
+
+  return all_new_results
 
 
 def _process_syndication_urls(source, permalink, syndication_urls,
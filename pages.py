@@ -1,13 +1,11 @@
 """Bridgy user-facing pages: front page, user pages, delete POSTs, etc."""
 import datetime
-import itertools
 import functools
 import logging
 import urllib.request, urllib.parse, urllib.error
 
 from flask import request
 from google.cloud import ndb
-from granary import as1
 from granary.source import html_to_text
 from webutil import logs
 from webutil import flask_util
@@ -17,7 +15,7 @@ import werkzeug.exceptions
 
 from flask_app import app
 import models
-from models import BlogPost, BlogWebmention, Publish, Response, Source, Webmentions
+from models import BlogPost, BlogWebmention, DirectoryEntry, Publish, ResponseSummary, Source, Webmentions
 import original_post_discovery
 from tumblr import Tumblr
 import util
@@ -32,6 +30,7 @@ logger = logging.getLogger(__name__)
 SITES = ','.join(list(models.sources.keys()) + ['fake'])  # for unit tests
 
 RECENT_PRIVATE_POSTS_THRESHOLD = 5
+RESPONSES_PAGE_SIZE = 10
 
 
 def authed(fn):
@@ -91,28 +90,45 @@ def which_bridgy():
 def users():
   r"""View for ``/users``.
 
-  Semi-optimized. Pages by source name. Queries each source type for results
-  with name greater than the start_name query param, then merge sorts the
-  results and truncates at ``PAGE_SIZE``\.
-
-  The start_name param is expected to be capitalized because capital letters
-  sort lexicographically before lower case letters. An alternative would be to
-  store a lower cased version of the name in another property and query on that.
+  Pages through :class:`models.DirectoryEntry`\s by lower cased name, starting
+  at the ``start_name`` query param, with the ``cursor`` query param for
+  subsequent pages. Caches the rendered list in :attr:`util.users_page_cache`,
+  per request scheme, since profile pictures are upgraded to https for https
+  requests.
   """
   PAGE_SIZE = 50
 
-  start_name = request.values.get('start_name', '')
-  queries = [cls.query(cls.name >= start_name).fetch_async(PAGE_SIZE)
-             for cls in models.sources.values()]
+  start_name = request.values.get('start_name', '').lower()
+  cursor = request.values.get('cursor')
+  cache_key = (start_name, cursor, request.scheme)
+
+  with util.users_page_cache_lock:
+    users_html = util.users_page_cache.get(cache_key)
+
+  if users_html is None:
+    try:
+      start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    except BaseException:
+      error(f'Invalid cursor {cursor}')
+
+    query = DirectoryEntry.query(DirectoryEntry.enabled == True)
+    if start_name:
+      query = query.filter(DirectoryEntry.name_lower >= start_name)
+    entries, next_cursor, more = query.order(
+      DirectoryEntry.name_lower, DirectoryEntry.silo
+    ).fetch_page(PAGE_SIZE, start_cursor=start_cursor)
 
-  sources = sorted(itertools.chain(*[q.get_result() for q in queries]),
-                   key=lambda s: (s.name.lower(), s.GR_CLASS.NAME))
-  sources = [util.preprocess_source(s) for s in sources
-             if s.name.lower() >= start_name.lower() and s.features
-                and s.status != 'disabled'
-             ][:PAGE_SIZE]
+    for entry in entries:
+      if entry.picture:
+        entry.picture = util.update_scheme(entry.picture, request)
 
-  return render_template('users.html', PAGE_SIZE=PAGE_SIZE, sources=sources)
+    users_html = render_template(
+      '_users.html', entries=entries, start_name=start_name,
+      next_cursor=next_cursor.urlsafe().decode() if more and next_cursor else None)
+    with util.users_page_cache_lock:
+      util.users_page_cache[cache_key] = users_html
+
+  return render_template('users.html', users_html=users_html)
 
 
 @app.route(f'/<any({SITES}):site>/<id>')
@@ -159,105 +175,7 @@ def user(site, id):
 
   # Responses
   if 'listen' in source.features or 'email' in source.features:
-    vars['responses'] = []
-    query = Response.query().filter(Response.source == source.key)
-
-    # if there's a paging param (responses_before or responses_after), update
-    # query with it
-    def get_paging_param(param):
-      val = request.values.get(param)
-      try:
-        return datetime.datetime.fromisoformat(val.replace(' ', '+')) if val else None
-      except BaseException:
-        error(f"Couldn't parse {param}, {val!r} as ISO8601")
-
-    before = get_paging_param('responses_before')
-    after = get_paging_param('responses_after')
-    if before and after:
-      error("can't handle both responses_before and responses_after")
-    elif after:
-      query = query.filter(Response.updated > after).order(Response.updated)
-    elif before:
-      query = query.filter(Response.updated < before).order(-Response.updated)
-    else:
-      query = query.order(-Response.updated)
-
-    query_iter = query.iter()
-    for i, r in enumerate(query_iter):
-      r.response = json_loads(r.response_json)
-      r.activities = [json_loads(a) for a in r.activities_json]
-
-      if (not as1.is_public(r.response) or
-          not all(as1.is_public(a) for a in r.activities)):
-        continue
-      elif r.type == 'post':
-        r.activities = []
-
-      verb = r.response.get('verb')
-      r.actor = (r.response.get('object') if verb == 'invite'
-                 else r.response.get('author') or r.response.get('actor')
-                ) or {}
-      r.actor['url'] = as1.get_url(r.actor)
-
-      activity_content = ''
-      for a in r.activities + [r.response]:
-        if not a.get('content'):
-          obj = a.get('object', {})
-          a['content'] = activity_content = (
-            obj.get('content') or obj.get('displayName') or
-            # historical, from a Reddit bug fixed in granary@4f9df7c
-            obj.get('name') or '')
-
-      response_content = r.response.get('content')
-      phrases = {
-        'like': 'liked this',
-        'repost': 'reposted this',
-        'rsvp-yes': 'is attending',
-        'rsvp-no': 'is not attending',
-        'rsvp-maybe': 'might attend',
-        'rsvp-interested': 'is interested',
-        'invite': 'is invited',
-      }
-      phrase = phrases.get(r.type) or phrases.get(verb)
-      if phrase and (r.type != 'repost' or
-                     activity_content.startswith(response_content)):
-        r.response['content'] = f'{r.actor.get("displayName") or ""} {phrase}.'
-
-      # convert image URL to https if we're serving over SSL
-      # account for fact image might be a list
-      image = util.get_first(r.actor, 'image', {})
-      image_url = image.get('url')
-      if image_url:
-        image['url'] = util.update_scheme(image_url, request)
-      r.actor['image'] = image
-      # generate original post links
-      r.links = process_webmention_links(r)
-      r.original_links = [util.pretty_link(url, new_tab=True)
-                          for url in r.original_posts]
-
-      vars['responses'].append(r)
-      if len(vars['responses']) >= 10 or i > 200:
-        break
-
-    vars['responses'].sort(key=lambda r: r.updated, reverse=True)
-
-    # calculate new paging param(s)
-    new_after = (
-      before if before else
-      vars['responses'][0].updated if
-        vars['responses'] and query_iter.probably_has_next() and (before or after)
-      else None)
-    if new_after:
-      vars['responses_after_link'] = f'?responses_after={new_after.isoformat()}#responses'
-
-    new_before = (
-      after if after else
-      vars['responses'][-1].updated if
-        vars['responses'] and query_iter.probably_has_next()
-      else None)
-    if new_before:
-      vars['responses_before_link'] = f'?responses_before={new_before.isoformat()}#responses'
-
+    vars['responses_html'] = render_responses(source)
     vars['next_poll'] = max(source.last_poll_attempt + source.poll_period(),
                             # lower bound is 1 minute from now
                             util.now() + datetime.timedelta(seconds=90))
@@ -290,7 +208,7 @@ def user(site, id):
                                 .order(-BlogPost.created)\
                                 .fetch(10)
     for b in blogposts:
-      b.links = process_webmention_links(b)
+      b.links = b.pretty_links()
       try:
         text = html_to_text(b.feed_item.get('title'))
       except ValueError:
@@ -321,26 +239,90 @@ def user(site, id):
   return render_template(f'{source.SHORT_NAME}_user.html', **vars)
 
 
-def process_webmention_links(e):
-  """Generates pretty HTML for the links in a :class:`models.Webmentions` entity.
+def render_responses(source):
+  r"""Renders a source's recent public responses for its user page.
+
+  Pages through :class:`models.ResponseSummary`\s by their responses'
+  ``updated``, to within :const:`models.RESPONSE_SUMMARY_UPDATED_RESOLUTION`,
+  with the
+  ``responses_before`` or ``responses_after`` query params. Loads the responses
+  themselves for their status and webmention targets. Caches the rendered HTML
+  in :attr:`util.responses_html_cache`.
 
   Args:
-    e (models.Response or models.BlogPost)
+    source (models.Source)
+
+  Returns:
+    str: HTML
   """
-  def link(url, g):
-    return util.pretty_link(
-      url, glyphicon=g, attrs={'class': 'original-post u-bridgy-target'},
-      new_tab=True)
-
-  return util.trim_nulls({
-      'Failed': set(link(url, 'exclamation-sign') for url in e.error + e.failed),
-      'Sending': set(link(url, 'transfer') for url in e.unsent
-                     if url not in e.error),
-      'Sent': set(link(url, None) for url in e.sent
-                  if url not in (e.error + e.unsent)),
-      'No <a href="http://indiewebify.me/#send-webmentions">webmention</a> '
-      'support': set(link(url, None) for url in e.skipped),
-      })
+  cache_key = (source.key, request.url)
+  with util.responses_html_cache_lock:
+    html = util.responses_html_cache.get(cache_key)
+  if html is not None:
+    return html
+
+  query = ResponseSummary.query(ResponseSummary.source == source.key,
+                                ResponseSummary.public == True)
+
+  # if there's a paging param (responses_before or responses_after), update
+  # query with it
+  def get_paging_param(param):
+    val = request.values.get(param)
+    try:
+      return datetime.datetime.fromisoformat(val.replace(' ', '+')) if val else None
+    except BaseException:
+      error(f"Couldn't parse {param}, {val!r} as ISO8601")
+
+  before = get_paging_param('responses_before')
+  after = get_paging_param('responses_after')
+  if before and after:
+    error("can't handle both responses_before and responses_after")
+  elif after:
+    query = query.filter(ResponseSummary.updated > after).order(ResponseSummary.updated)
+  elif before:
+    query = query.filter(ResponseSummary.updated < before).order(-ResponseSummary.updated)
+  else:
+    query = query.order(-ResponseSummary.updated)
+
+  summaries, _, more = query.fetch_page(RESPONSES_PAGE_SIZE)
+  summaries.sort(key=lambda s: s.updated, reverse=True)
+  resps = ndb.get_multi(s.response_key() for s in summaries)
+
+  responses = []
+  for summary, resp in zip(summaries, resps):
+    r = summary.summary
+    r.update({
+      'key': summary.response_key(),
+      'updated': resp.updated if resp else summary.updated,
+      'status': resp.status if resp else None,
+      'links': resp.pretty_links() if resp else {},
+    })
+    # convert image URL to https if we're serving over SSL
+    image = r['actor']['image']
+    if image.get('url'):
+      image['url'] = util.update_scheme(image['url'], request)
+    responses.append(r)
+
+  # calculate new paging param(s)
+  vars = {'source': source, 'logs': logs, 'responses': responses}
+  new_after = (
+    before if before else
+    summaries[0].updated if summaries and more and (before or after)
+    else None)
+  if new_after:
+    vars['responses_after_link'] = f'?responses_after={new_after.isoformat()}#responses'
+
+  new_before = (
+    after if after else
+    summaries[-1].updated if summaries and more
+    else None)
+  if new_before:
+    vars['responses_before_link'] = f'?responses_before={new_before.isoformat()}#responses'
+
+  html = render_template('_responses.html', **vars)
+  with util.responses_html_cache_lock:
+    util.responses_html_cache[cache_key] = html
+  return html
 
 
 @app.route('/delete/start', methods=['POST'])
@@ -494,6 +476,11 @@ def retry():
         json_loads(entity.response_json), originals=originals, mentions=mentions)
 
   entity.restart()
+
+  with util.responses_html_cache_lock:
+    for key in [key for key in util.responses_html_cache if key[0] == source.key]:
+      util.responses_html_cache.pop(key, None)
+
   flash('Retrying. Refresh in a minute to see the results!')
   return redirect(request.values.get('redirect_to') or source.bridgy_url())
 
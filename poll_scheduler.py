@@ -0,0 +1,250 @@
+"""Adaptive poll scheduling based on each source's response arrival rate.
+
+Each poll records how many new responses with webmention targets it found and
+how long it had been since the previous poll. We keep exponentially decayed
+sums of both in the :class:`models.Source` and estimate the source's arrival
+rate from them, with a weak prior so that a few quiet polls don't drop a
+source to zero.
+
+Polling every ``T`` hours means a new response waits ``T/2`` on average before
+we see it, so a source with arrival rate ``λ`` accrues ``λ·T/2`` hours of
+latency per hour. For a fixed total number of polls, the sum of that across
+all sources is minimized when ``T ∝ 1/sqrt(λ)``, so we poll at
+``FAST_POLL * sqrt(REFERENCE_RATE / λ)``, times a scale that fits all sources'
+polls into :const:`POLL_BUDGET`, then clamped. A daily cron job computes the
+scale with :func:`budget_scale` and stores it in :class:`models.PollBudget`.
+Polls that get an etag hit find nothing new, so they count as quiet polls in
+the estimate. :func:`simulate` replays recorded response history offline to
+compare poll volume and latency between schedules.
+"""
+from datetime import timedelta
+import math
+
+import util
+
+# how long a poll's outcome takes to lose half of its weight in the estimate
+RATE_HALF_LIFE = timedelta(days=30)
+# prior, as pseudo-observations: a tenth of a response in one week
+PRIOR_RESPONSES = .1
+PRIOR_HOURS = 24 * 7
+# only use the estimate once it's based on this many polls
+MIN_SAMPLES = 10
+# responses per hour at which we poll every FAST_POLL
+REFERENCE_RATE = 6 / 24
+# target polls per hour across all auto-polled sources. the poll queue runs at
+# most 3600, including retries, and discover and poll-now tasks share the same
+# silo API budgets.
+POLL_BUDGET = 1800
+# bounds on the scale that budget_scale() returns. it multiplies every
+# interval, so >1 polls less, <1 more.
+MIN_BUDGET_SCALE = .25
+MAX_BUDGET_SCALE = 4
+# poll at least every FAST_POLL for this long after the user's last public post,
+# since that's when most responses arrive
+RECENT_POST = timedelta(days=1)
+
+
+def record_poll(source, found, now):
+  """Updates a source's rate estimate with a poll's outcome.
+
+  Args:
+    source (models.Source): ``last_polled`` should be the previous successful
+      poll
+    found (int): number of new or changed responses with webmention targets
+    now (datetime.datetime): when this poll ran
+
+  Returns:
+    dict: property names and values to store in ``source.updates``. Empty if
+    this is the source's first poll.
+  """
+  if source.last_polled == util.EPOCH or now <= source.last_polled:
+    return {}
+
+  responses, hours, samples = update_rate(
+    source.poll_rate_responses or 0, source.poll_rate_hours or 0,
+    source.poll_rate_samples or 0, found, now - source.last_polled)
+  return {
+    'poll_rate_responses': responses,
+    'poll_rate_hours': hours,
+    'poll_rate_samples': samples,
+  }
+
+
+def update_rate(responses, hours, samples, found, elapsed):
+  """Adds a poll's outcome to decayed response and time totals.
+
+  Args:
+    responses (float): decayed total responses found so far
+    hours (float): decayed total hours covered by polls so far
+    samples (int): number of polls so far
+    found (int): responses found by this poll
+    elapsed (datetime.timedelta): since the previous poll
+
+  Returns:
+    (float, float, int) tuple: updated ``responses``, ``hours``, ``samples``
+  """
+  decay = 0.5 ** (elapsed / RATE_HALF_LIFE)
+  return (responses * decay + found,
+          hours * decay + elapsed.total_seconds() / 3600,
+          samples + 1)
+
+
+def rate(responses, hours):
+  """Returns the estimated response arrival rate, per hour.
+
+  Args:
+    responses (float): decayed total, from :func:`update_rate`
+    hours (float): decayed total, from :func:`update_rate`
+
+  Returns:
+    float:
+  """
+  return (responses + PRIOR_RESPONSES) / (hours + PRIOR_HOURS)
+
+
+def poll_interval(rate, fast, shortest, longest, scale=1):
+  """Returns the poll interval for a given response arrival rate.
+
+  Args:
+    rate (float): responses per hour
+    fast (datetime.timedelta): interval at :const:`REFERENCE_RATE`
+    shortest (datetime.timedelta)
+    longest (datetime.timedelta)
+    scale (float): from :func:`budget_scale`
+
+  Returns:
+    datetime.timedelta:
+  """
+  interval = fast * (scale * math.sqrt(REFERENCE_RATE / rate))
+  return sorted((shortest, interval, longest))[1]
+
+
+def poll_period(source, now, scale=1):
+  """Returns a source's adaptive poll period.
+
+  Args:
+    source (models.Source): with at least :const:`MIN_SAMPLES` polls recorded
+    now (datetime.datetime)
+    scale (float): from :func:`budget_scale`
+
+  Returns:
+    datetime.timedelta:
+  """
+  return poll_interval(*schedule(source, now), scale=scale)
+
+
+def schedule(source, now):
+  """Returns a source's :func:`poll_interval` arguments, except the scale.
+
+  Args:
+    source (models.Source): with at least :const:`MIN_SAMPLES` polls recorded
+    now (datetime.datetime)
+
+  Returns:
+    (float, datetime.timedelta, datetime.timedelta, datetime.timedelta) tuple:
+    rate, fast, shortest, longest
+  """
+  shortest = source.VOLUME_POLL if source.is_volume_user() else source.FAST_POLL
+  longest = source.SLOW_POLL
+  if source.last_public_post and source.last_public_post > now - RECENT_POST:
+    longest = source.FAST_POLL
+
+  return (rate(source.poll_rate_responses, source.poll_rate_hours),
+          source.FAST_POLL, shortest, longest)
+
+
+def budget_scale(schedules, budget=None):
+  """Returns the interval scale that fits sources' polls into a budget.
+
+  Finds it by bisection, since clamping makes polls per hour nonlinear in the
+  scale.
+
+  Args:
+    schedules (sequence): one ``(rate, fast, shortest, longest)`` tuple per
+      source, as in :func:`poll_interval`. ``rate`` is None for sources
+      without an estimate yet, which poll every ``fast`` regardless of scale.
+    budget (float): polls per hour, defaults to :const:`POLL_BUDGET`
+
+  Returns:
+    float: between :const:`MIN_BUDGET_SCALE` and :const:`MAX_BUDGET_SCALE`
+  """
+  def polls_per_hour(scale):
+    total = 0
+    for rate, fast, shortest, longest in schedules:
+      interval = (fast if rate is None
+                  else poll_interval(rate, fast, shortest, longest, scale=scale))
+      total += 3600 / interval.total_seconds()
+    return total
+
+  if budget is None:
+    budget = POLL_BUDGET
+
+  low, high = MIN_BUDGET_SCALE, MAX_BUDGET_SCALE
+  if polls_per_hour(low) <= budget:
+    return low
+  elif polls_per_hour(high) > budget:
+    return high
+
+  for _ in range(20):
+    mid = math.sqrt(low * high)
+    if polls_per_hour(mid) > budget:
+      low = mid
+    else:
+      high = mid
+  return high
+
+
+def simulate(arrivals, start, end, fast, shortest, longest, interval_fn=None):
+  """Replays a source's recorded responses against a poll schedule.
+
+  Starts with no rate estimate, like a new source, and polls every ``fast``
+  until there are :const:`MIN_SAMPLES` polls. Ignores task ETA jitter.
+
+  Args:
+    arrivals (sequence of datetime.datetime): when each response with
+      webmention targets was created in the silo
+    start (datetime.datetime)
+    end (datetime.datetime)
+    fast, shortest, longest (datetime.timedelta): see :func:`poll_interval`
+    interval_fn (callable): optional, takes (float rate or None, int samples)
+      and returns the next poll interval as a :class:`datetime.timedelta`.
+      Defaults to the adaptive schedule. Pass eg ``lambda *_: FAST_POLL`` to
+      compare against a fixed schedule.
+
+  Returns:
+    dict: with int ``polls`` (silo API calls), int ``responses`` detected, and
+    :class:`datetime.timedelta` ``mean latency`` and ``max latency`` from when
+    each response arrived until the poll that found it
+  """
+  if interval_fn is None:
+    def interval_fn(rate, samples):
+      return (poll_interval(rate, fast, shortest, longest)
+              if samples >= MIN_SAMPLES else fast)
+
+  arrivals = sorted(a for a in arrivals if start <= a < end)
+  responses = hours = samples = polls = 0
+  latencies = []
+  last = now = start
+  i = 0
+
+  while now < end:
+    polls += 1
+    found = 0
+    while i < len(arrivals) and arrivals[i] <= now:
+      latencies.append(now - arrivals[i])
+      found += 1
+      i += 1
+
+    if now > start:
+      responses, hours, samples = update_rate(responses, hours, samples,
+                                              found, now - last)
+    last = now
+    now += interval_fn(rate(responses, hours) if samples else None, samples)
+
+  return {
+    'polls': polls,
+    'responses': len(latencies),
+    'mean latency': (sum(latencies, timedelta()) / len(latencies)
+                     if latencies else timedelta()),
+    'max latency': max(latencies, default=timedelta()),
+  }
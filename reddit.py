@@ -26,6 +26,11 @@ class Reddit(models.Source):
   DISABLE_HTTP_CODES = ('401', '403')
   USERNAME_KEY_ID = True
   URL_CANONICALIZER = util.UrlCanonicalizer(domain=GR_CLASS.DOMAIN)
+  # Reddit allows 100 calls per minute per OAuth client, ie 1.7/s, across all
+  # of our users. a poll makes one call for the user's submissions plus one
+  # for each one's comments, so around 10.
+  THROTTLE_RATE = .15
+  THROTTLE_BURST = 10
 
   @staticmethod
   def new(auth_entity=None, **kwargs):
@@ -0,0 +1,29 @@
+#!/usr/local/bin/python
+"""Create the ResponseSummary for every Response, for user pages.
+
+Responses write their summaries when they're saved, so this only needs to run
+once, for responses that haven't been saved since ResponseSummary was added.
+Doesn't write the responses themselves, so their updated timestamps don't
+change.
+"""
+from google.cloud import ndb
+
+from models import Response, ResponseSummary
+
+
+cursor = None
+while True:
+  responses, cursor, more = Response.query().fetch_page(100, start_cursor=cursor)
+
+  summaries = []
+  for resp in responses:
+    if resp.response_json:
+      summary, public = ResponseSummary.summarize(resp)
+      summaries.append(ResponseSummary(id=resp.key.id(), source=resp.source,
+                                       public=public, updated=resp.updated,
+                                       summary=summary))
+  ndb.put_multi(summaries)
+  print(f'{len(summaries)} summaries, up to {responses[-1].key.id() if responses else None}')
+
+  if not more:
+    break
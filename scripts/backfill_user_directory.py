@@ -0,0 +1,15 @@
+#!/usr/local/bin/python
+"""Create or update the DirectoryEntry for every source, for the /users page.
+
+Sources maintain their entries on every write, so this only needs to run once,
+for sources that haven't been written since DirectoryEntry was added.
+"""
+import models
+from models import DirectoryEntry
+import bluesky, flickr, github, indieauth, mastodon, reddit, tumblr, wordpress_rest
+
+
+for cls in models.sources.values():
+  for src in cls.query():
+    print(src.bridgy_path())
+    DirectoryEntry.for_source(src).put()
@@ -83,41 +83,42 @@ def handle_feed(feed, source):
     logger.info("Dropping because source doesn't have webmention feature")
     return
 
-  for item in feed.get('items', []):
-    url = item.get('permalinkUrl') or item.get('id')
-    if not url:
-      logger.error('Dropping feed item without permalinkUrl or id!')
-      continue
-
-    # extract links from content, discarding self links.
-    #
-    # i don't use get_webmention_target[s]() here because they follows redirects
-    # and fetch link contents, and this handler should be small and fast and try
-    # to return a response to superfeedr successfully.
-    content = item.get('content') or item.get('summary', '')
-    links = [util.clean_url(util.unwrap_t_umblr_com(url))
-             for url in util.extract_links(content)
-             if util.domain_from_link(url) not in source.domains]
-
-    unique = []
-    for link in util.dedupe_urls(links):
-      if len(link) <= _MAX_STRING_LENGTH:
-        unique.append(link)
+  with util.task_batch():
+    for item in feed.get('items', []):
+      url = item.get('permalinkUrl') or item.get('id')
+      if not url:
+        logger.error('Dropping feed item without permalinkUrl or id!')
+        continue
+
+      # extract links from content, discarding self links.
+      #
+      # i don't use get_webmention_target[s]() here because they follows redirects
+      # and fetch link contents, and this handler should be small and fast and try
+      # to return a response to superfeedr successfully.
+      content = item.get('content') or item.get('summary', '')
+      links = [util.clean_url(util.unwrap_t_umblr_com(url))
+               for url in util.extract_links(content)
+               if util.domain_from_link(url) not in source.domains]
+
+      unique = []
+      for link in util.dedupe_urls(links):
+        if len(link) <= _MAX_STRING_LENGTH:
+          unique.append(link)
+        else:
+          logger.info(f'Giving up on link over {_MAX_STRING_LENGTH} chars! {link}')
+        if len(unique) >= MAX_BLOGPOST_LINKS:
+          logger.info('Stopping at 10 links! Skipping the rest.')
+          break
+
+      logger.info(f'Found links: {unique}')
+      if len(url) > _MAX_KEYPART_BYTES:
+        logger.warning('Blog post URL is too long (over 500 chars)! Giving up.')
+        bp = models.BlogPost(id=url[:_MAX_KEYPART_BYTES], source=source.key,
+                             feed_item=item, failed=unique)
       else:
-        logger.info(f'Giving up on link over {_MAX_STRING_LENGTH} chars! {link}')
-      if len(unique) >= MAX_BLOGPOST_LINKS:
-        logger.info('Stopping at 10 links! Skipping the rest.')
-        break
-
-    logger.info(f'Found links: {unique}')
-    if len(url) > _MAX_KEYPART_BYTES:
-      logger.warning('Blog post URL is too long (over 500 chars)! Giving up.')
-      bp = models.BlogPost(id=url[:_MAX_KEYPART_BYTES], source=source.key,
-                           feed_item=item, failed=unique)
-    else:
-      bp = models.BlogPost(id=url, source=source.key, feed_item=item, unsent=unique)
-
-    bp.get_or_save()
+        bp = models.BlogPost(id=url, source=source.key, feed_item=item, unsent=unique)
+
+      bp.get_or_save()
 
 
 class Notify(View):
@@ -12,7 +12,7 @@ from webutil import logs, webmention
 from webutil.flask_util import error
 from webutil.util import json_dumps, json_loads
 
-import models, original_post_discovery, util
+import models, original_post_discovery, poll_scheduler, util
 from flask_background import app
 from models import Response
 from util import ERROR_HTTP_RETURN_CODE
@@ -21,11 +21,49 @@ import bluesky, flickr, github, mastodon, reddit, tumblr, wordpress_rest
 
 logger = logging.getLogger(__name__)
 
-# Used as a sentinel value in the webmention endpoint cache
-NO_ENDPOINT = 'NONE'
-
 WEBMENTION_SEND_TIMEOUT = datetime.timedelta(seconds=30)
 
+# Max number of activities to run original post discovery on in parallel
+# during a poll.
+ORIGINAL_POST_DISCOVERY_THREADS = 4
+
+# Max number of target domains to send webmentions to in parallel. Targets on
+# the same domain are sent serially, so each domain sees at most one request at
+# a time.
+WEBMENTION_SEND_THREADS = 5
+
+# Politeness toward webmention target domains, across all responses and
+# blog posts. We send to each domain from at most this many threads in this
+# process at once...
+WEBMENTION_DOMAIN_CONCURRENCY = 2
+# ...and, once sends to a domain start failing, in at most this many tasks per
+# second across all instances, with models.TokenBucket. After
+# models.CIRCUIT_FAILURE_THRESHOLD consecutive failures, models.InstanceHealth
+# stops sending to the domain entirely for a while, with exponential backoff.
+WEBMENTION_DOMAIN_RATE = 1 / 60
+WEBMENTION_DOMAIN_BURST = 5
+# give up on targets whose domain has been deferring them for this long.
+# matches the propagate queues' task_age_limit.
+WEBMENTION_DEFER_MAX_AGE = datetime.timedelta(days=1)
+
+# Only rewrite a source's last_webmention_sent when the stored value is at
+# least this old, so that bursts of propagate tasks don't each write the source.
+# Source.poll_period() only looks at it with hour resolution.
+LAST_WEBMENTION_SENT_RESOLUTION = datetime.timedelta(minutes=10)
+
+
+class DomainDeferred(Exception):
+  """We didn't send to a target because its domain is failing or rate limited."""
+
+
+def is_domain_failure(e):
+  """Returns True if a webmention send error counts against the target domain.
+
+  DNS lookup failures don't, since we give up on those targets.
+  """
+  return (models.InstanceHealth.is_failure(e)
+          and 'DNS lookup failed' not in str(e))
+
 
 def is_public(obj):
   """Checks both the object and its author/actor."""
@@ -34,6 +72,18 @@ def is_public(obj):
           as1.is_public(as1.get_object(obj, 'actor'), unlisted=False))
 
 
+def log_fetch_stats(fetches):
+  """Logs how many HTTP fetches a task's :func:`util.fetch_scope` saved.
+
+  Args:
+    fetches (util.FetchTable)
+  """
+  saved = fetches.hits + fetches.stats['resolve cross-task hits']
+  logger.info(f'Memoized fetches saved {saved} HTTP round trips: {dict(fetches.stats)}')
+  logger.info(f'HTTP connection pools, process-wide: {util.http_pool_stats()}')
+  logger.info(f'mf2 parse cache, process-wide: {util.mf2_cache_info()}')
+
+
 def is_quote_mention(activity, source):
   obj = activity.get('object') or activity
   for att in obj.get('attachments', []):
@@ -58,10 +108,14 @@ class Poll(View):
   2. Extract responses, store their activities.
   3. Filter out responses we've already seen, using :class:`models.Response`\s
      in the datastore.
-  4. Store new responses and enqueue propagate tasks.
-  5. Possibly refetch updated syndication urls.
+  4. Run original post discovery on the new responses' activities, in parallel.
+  5. Store new responses and enqueue propagate tasks.
+  6. Possibly refetch updated syndication urls.
 
-  1-4 are in :meth:`backfeed`; 5 is in :meth:`poll`.
+  2-5 are in :meth:`backfeed`; 1 and 6 are in :meth:`poll`.
+
+  HTTP fetches during the whole poll share a :func:`util.fetch_scope`, and
+  propagate tasks are batched with :func:`util.task_batch`.
   """
   RESTART_EXISTING_TASKS = False  # overridden in Discover
 
@@ -84,7 +138,13 @@ class Poll(View):
         logger.warning('duplicate poll task! deferring to the other task.')
         return ''
 
+    delay = source.circuit_open() or source.throttle()
+    if delay:
+      util.add_poll_task(source, delay=delay)
+      return ''
+
     logger.info(f'Last poll: {self._last_poll_url(source)}')
+    prev_poll_status = source.poll_status
 
     # mark this source as polling
     source.updates = {
@@ -96,7 +156,11 @@ class Poll(View):
 
     source.updates = {}
     try:
-      self.poll(source)
+      with util.fetch_scope() as fetches, util.task_batch():
+        if prev_poll_status == 'error':
+          self.requeue_new_responses(source)
+        self.poll(source)
+      log_fetch_stats(fetches)
     except Exception as e:
       source.updates['poll_status'] = 'error'
       code, _ = util.interpret_http_exception(e)
@@ -125,6 +189,23 @@ class Poll(View):
 
     return 'OK'
 
+  @staticmethod
+  def requeue_new_responses(source):
+    """Re-adds propagate tasks for this source's responses that are still new.
+
+    Responses and the seen responses cache are stored before the poll's task
+    batch is flushed, so if the flush fails, the retried poll won't see those
+    responses as new. This catches them instead. Duplicate propagate tasks are
+    harmless since propagate leases each response.
+    """
+    keys = models.Response.query(models.Response.source == source.key,
+                                 models.Response.status == 'new',
+                                 ).fetch(keys_only=True)
+    if keys:
+      logger.info(f'Re-adding propagate tasks for {len(keys)} new responses')
+      models.Response.add_tasks(
+        [models.Response(key=key, source=source.key) for key in keys])
+
   def poll(self, source):
     """Actually runs the poll.
 
@@ -138,19 +219,24 @@ class Poll(View):
     # * posts by the user
     # * search all posts for the user's domain URLs to find links
     #
-    cache = util.CacheDict()
-    if source.last_activities_cache_json:
-      cache.update(json_loads(source.last_activities_cache_json))
-
-    # search for links first so that the user's activities and responses
-    # override them if they overlap
-    links = source.search_for_links()
-
-    # this user's own activities (and user mentions)
-    resp = source.get_activities_response(
-      fetch_replies=True, fetch_likes=True, fetch_shares=True,
-      fetch_mentions=True, count=30, etag=source.last_activities_etag,
-      min_id=source.last_activity_id, cache=cache)
+    poll_cache = source.poll_cache()
+    cache = util.ActivitiesCache(poll_cache.activities_cache_json)
+
+    with source.concurrency_slot():
+      try:
+        # search for links first so that the user's activities and responses
+        # override them if they overlap
+        links = source.search_for_links()
+
+        # this user's own activities (and user mentions)
+        resp = source.get_activities_response(
+          fetch_replies=True, fetch_likes=True, fetch_shares=True,
+          fetch_mentions=True, count=30, etag=source.last_activities_etag,
+          min_id=source.last_activity_id, cache=cache)
+      except BaseException as e:
+        source.record_health(e)
+        raise
+      source.record_health()
     etag = resp.get('etag')  # used later
     user_activities = resp.get('items', [])
 
@@ -185,12 +271,15 @@ class Poll(View):
       source.updates['last_activity_id'] = last_activity_id
 
     # trim cache to just the returned activity ids, so that it doesn't grow
-    # without bound. (WARNING: depends on get_activities_response()'s cache key
-    # format, e.g. 'PREFIX ACTIVITY_ID'!)
-    source.updates['last_activities_cache_json'] = json_dumps(
-      {k: v for k, v in cache.items() if k.split()[-1] in silo_activity_ids})
+    # without bound, and only store it if it changed.
+    cache.trim(silo_activity_ids)
+    if cache.dirty:
+      poll_cache.activities_cache_json = cache.to_json()
 
-    self.backfeed(source, responses, activities=activities)
+    found = self.backfeed(source, responses, activities=activities)
+    source.put_poll_cache()
+    source.updates.update(
+      poll_scheduler.record_poll(source, found, source.last_poll_attempt))
 
     source.updates.update({'last_polled': source.last_poll_attempt,
                            'poll_status': 'ok'})
@@ -230,12 +319,16 @@ class Poll(View):
   def backfeed(self, source, responses=None, activities=None):
     """Processes responses and activities and generates propagate tasks.
 
-    Stores property names and values to update in source.updates.
+    Stores property names and values to update in source.updates, and seen
+    responses in ``source.poll_cache()``, which the caller should store.
 
     Args:
       source (models.Source)
       responses (dict): maps AS response id to AS object
       activities (dict): maps AS activity id to AS object
+
+    Returns:
+      int: number of new or changed responses with webmention targets
     """
     if responses is None:
       responses = {}
@@ -244,7 +337,7 @@ class Poll(View):
 
     # Cache to make sure we only fetch the author's h-feed(s) the
     # first time we see it
-    fetched_hfeeds = set()
+    fetched_hfeeds = util.FetchTable()
 
     # narrow down to just public activities
     public = {}
@@ -273,9 +366,13 @@ class Poll(View):
     #
     # WARNING: this creates circular references in link posts found by search
     # queries in step 1, since they are their own activity. We use
-    # prune_activity() and prune_response() in step 4 to remove these before
+    # prune_activity() and prune_response() in step 5 to remove these before
     # serializing to JSON.
     #
+    # Original post discovery happens later, in step 4, after we've filtered
+    # out responses we've already seen. user_mentions collects (activity, URLs)
+    # tuples for user mentions, to add to each activity's mentions after OPD.
+    user_mentions = []
     for id, activity in public.items():
       obj = activity.get('object') or activity
 
@@ -285,25 +382,12 @@ class Poll(View):
         for tag in obj.get('tags', []):
           urls = tag.get('urls')
           if tag.get('objectType') == 'person' and tag.get('id') == user_id and urls:
-            activity['originals'], activity['mentions'] = \
-              original_post_discovery.discover(
-                source, activity, fetch_hfeed=True,
-                include_redirect_sources=False,
-                already_fetched_hfeeds=fetched_hfeeds)
-            activity['mentions'].update(u.get('value') for u in urls)
+            user_mentions.append((activity, [u.get('value') for u in urls]))
             _merge_activity_into_response(activity, responses)
             break
 
-      # handle quote mentions
+      # handle quote mentions. OPD will dig into the actual attachments
       if is_quote_mention(activity, source):
-        # now that we've confirmed that one exists, OPD will dig
-        # into the actual attachments
-        if 'originals' not in activity or 'mentions' not in activity:
-          activity['originals'], activity['mentions'] = \
-            original_post_discovery.discover(
-              source, activity, fetch_hfeed=True,
-              include_redirect_sources=False,
-              already_fetched_hfeeds=fetched_hfeeds)
         _merge_activity_into_response(activity, responses)
 
       # extract replies, likes, reactions, reposts, and rsvps
@@ -341,49 +425,87 @@ class Poll(View):
     #
     # Step 3: filter out responses we've already seen
     #
-    # seen responses (JSON objects) for each source are stored in its entity.
-    unchanged_responses = []
-    if source.seen_responses_cache_json:
-      for seen in json_loads(source.seen_responses_cache_json):
-        id = seen['id']
-        resp = responses.get(id)
-        if (resp and not as1.activity_changed(seen, resp, log=True)
-            and not resp.get('activities_changed')):
-          unchanged_responses.append(seen)
-          del responses[id]
+    # fingerprints of seen responses for each source are stored in its
+    # PollCache. migrate from the old format, full JSON objects, if necessary.
+    poll_cache = source.poll_cache()
+    migrated = False
+    if poll_cache.seen_responses_fingerprints is not None:
+      seen = util.decode_seen_responses(poll_cache.seen_responses_fingerprints)
+    elif source.seen_responses_cache_json:
+      seen = {util.seen_response_key(resp['id']): util.response_fingerprint(resp)
+              for resp in json_loads(source.seen_responses_cache_json)}
+      migrated = True
+    else:
+      seen = {}
+
+    unchanged_responses = {}
+    for id, resp in list(responses.items()):
+      key = util.seen_response_key(id)
+      fingerprint = seen.get(key)
+      if (fingerprint and fingerprint == util.response_fingerprint(resp)
+          and not resp.get('activities_changed')):
+        unchanged_responses[key] = fingerprint
+        del responses[id]
 
     #
-    # Step 4: store new responses and enqueue propagate tasks
+    # Step 4: run original post discovery on the remaining responses'
+    # activities, in parallel.
     #
-    pruned_responses = []
-    source.blocked_ids = None
-
+    # we'll usually have multiple responses for the same activity, and the
+    # objects in resp['activities'] are shared, so cache each activity's
+    # discovered webmention targets inside its object.
+    def discover(activity):
+      return original_post_discovery.discover(
+        source, activity, fetch_hfeed=True, include_redirect_sources=False,
+        already_fetched_hfeeds=fetched_hfeeds, relationships=relationships)
+
+    responses_activities = {}
+    to_discover = []
     for id, resp in responses.items():
-      resp_type = Response.get_type(resp)
       activities = resp.pop('activities', [])
-      if not activities and (resp_type in ('post', 'comment') or
+      if not activities and (Response.get_type(resp) in ('post', 'comment') or
                              is_quote_mention(resp, source)):
         activities = [resp]
+      responses_activities[id] = activities
+      for activity in activities:
+        if (('originals' not in activity or 'mentions' not in activity)
+            and not any(activity is a for a in to_discover)):
+          to_discover.append(activity)
+
+    with util.fetch_scope():
+      # look up stored syndication relationships for all activities at once
+      relationships = original_post_discovery.load_relationships(
+        source, to_discover, max_workers=ORIGINAL_POST_DISCOVERY_THREADS)
+      discovered = util.concurrent_map(discover, to_discover,
+                                       max_workers=ORIGINAL_POST_DISCOVERY_THREADS)
+    for activity, (originals, mentions) in zip(to_discover, discovered):
+      activity['originals'], activity['mentions'] = originals, mentions
+
+    for activity, urls in user_mentions:
+      if 'mentions' in activity:
+        activity['mentions'].update(urls)
+
+    #
+    # Step 5: store new responses and enqueue propagate tasks
+    #
+    seen_responses = {}
+    resp_entities = []
+    loaded_blocklist = False
+
+    for id, resp in responses.items():
+      resp_type = Response.get_type(resp)
+      activities = responses_activities[id]
       too_long = set()
       urls_to_activity = {}
       for i, activity in enumerate(activities):
-        # we'll usually have multiple responses for the same activity, and the
-        # objects in resp['activities'] are shared, so cache each activity's
-        # discovered webmention targets inside its object.
-        if 'originals' not in activity or 'mentions' not in activity:
-          activity['originals'], activity['mentions'] = \
-            original_post_discovery.discover(
-              source, activity, fetch_hfeed=True,
-              include_redirect_sources=False,
-              already_fetched_hfeeds=fetched_hfeeds)
-
         targets = original_post_discovery.targets_for_response(
           resp, originals=activity['originals'], mentions=activity['mentions'])
         if targets:
           logger.info(f"{activity.get('url')} has {len(targets)} webmention target(s): {' '.join(targets)}")
           # new response to propagate! load block list if we haven't already
-          if source.blocked_ids is None:
+          if not loaded_blocklist:
             source.load_blocklist()
+            loaded_blocklist = True
 
         for t in targets:
           if len(t) <= _MAX_STRING_LENGTH:
@@ -396,7 +518,8 @@ class Poll(View):
       # remove circular references in link responses, which are their own
       # activities. details in the step 2 comment above.
       pruned_response = util.prune_response(resp)
-      pruned_responses.append(pruned_response)
+      seen_responses[util.seen_response_key(id)] = util.response_fingerprint(
+        pruned_response)
       resp_entity = Response(
         id=id,
         source=source.key,
@@ -408,12 +531,21 @@ class Poll(View):
         original_posts=resp.get('originals', []))
       if urls_to_activity:
         resp_entity.urls_to_activity=json_dumps(urls_to_activity)
-      resp_entity.get_or_save(source, restart=self.RESTART_EXISTING_TASKS)
+      resp_entities.append(resp_entity)
+
+    Response.get_or_save_multi(resp_entities, source=source,
+                               restart=self.RESTART_EXISTING_TASKS)
 
-    # update cache
-    if pruned_responses:
-      source.updates['seen_responses_cache_json'] = json_dumps(
-        pruned_responses + unchanged_responses)
+    # update cache. always write it when we migrated from the legacy JSON,
+    # since put_poll_cache() clears that.
+    if seen_responses:
+      seen_responses.update(unchanged_responses)
+      poll_cache.seen_responses_fingerprints = util.encode_seen_responses(
+        seen_responses)
+    elif migrated:
+      poll_cache.seen_responses_fingerprints = util.encode_seen_responses(seen)
+
+    return sum(1 for entity in resp_entities if entity.unsent)
 
   def repropagate_old_responses(self, source, relationships):
     """Find old Responses that match a new SyndicatedPost and repropagate them.
@@ -521,14 +653,25 @@ class Discover(Poll):
     logger.info(f'Source: {source.label()} {source.key_id()}, {source.bridgy_url()}')
 
     post_id = request.values['post_id']
+    delay = source.circuit_open() or source.throttle()
+    if delay:
+      util.add_discover_task(source, post_id, type=type, delay=delay)
+      return ''
+
     source.updates = {}
 
-    if type == 'event':
-      activities = [source.gr_source.get_event(post_id)]
-    else:
-      activities = source.get_activities(
-        fetch_replies=True, fetch_likes=True, fetch_shares=True,
-        activity_id=post_id, user_id=source.key_id())
+    with source.concurrency_slot():
+      try:
+        if type == 'event':
+          activities = [source.gr_source.get_event(post_id)]
+        else:
+          activities = source.get_activities(
+            fetch_replies=True, fetch_likes=True, fetch_shares=True,
+            activity_id=post_id, user_id=source.key_id())
+      except BaseException as e:
+        source.record_health(e)
+        raise
+      source.record_health()
 
     if not activities or not activities[0]:
       logger.info(f'Post {post_id} not found.')
@@ -540,7 +683,9 @@ class Discover(Poll):
     # no more transactional tasks. https://github.com/googleapis/python-tasks/issues/26
     # they're still supported in the new "bundled services" thing, but that seems like a dead end.
     # https://groups.google.com/g/google-appengine/c/22BKInlWty0/m/05ObNEdsAgAJ
-    self.backfeed(source, responses=activities, activities=activities)
+    with util.fetch_scope() as fetches, util.task_batch():
+      self.backfeed(source, responses=activities, activities=activities)
+    log_fetch_stats(fetches)
 
     obj = activity.get('object') or activity
     in_reply_to = util.get_first(obj, 'inReplyTo')
@@ -559,9 +704,15 @@ class SendWebmentions(View):
 
   * entity (models.Webmentions): subclass instance (set in :meth:`lease`)
   * source (models.Source): entity (set in :meth:`send_webmentions`)
+  * version (int): ``entity.version`` as of our lease (set in :meth:`lease`)
+  * sent (list of (str endpoint URL, str target URL) tuples): webmentions
+    we've sent so far (set in :meth:`lease`)
   """
   # request deadline (10m) plus some padding
   LEASE_LENGTH = datetime.timedelta(minutes=12)
+  # if True, :meth:`finish` doesn't update the source. the caller does it,
+  # eg :class:`PropagateBatch` does it once for the whole batch.
+  defer_source_update = False
 
   def source_url(self, target_url):
     """Return the source URL to use for a given target URL.
@@ -587,7 +738,9 @@ class SendWebmentions(View):
     logger.info(f'Starting {self.entity.label()}')
 
     try:
-      self.do_send_webmentions()
+      with util.fetch_scope() as fetches:
+        self.do_send_webmentions()
+      log_fetch_stats(fetches)
     except:
       logger.info('Propagate task failed', exc_info=True)
       self.release('error')
@@ -611,64 +764,219 @@ class SendWebmentions(View):
           self.entity.failed.append(orig_url)
     self.entity.unsent = sorted(unsent)
 
-    while self.entity.unsent:
-      resp = None
-      target = self.entity.unsent.pop(0)
-
+    # source_url() and request_headers() may need the request context, and
+    # the endpoint cache's datastore tier needs the datastore, so generate
+    # source URLs and load cached endpoints here, up front. the sending threads
+    # only make HTTP requests.
+    models.WebmentionEndpoint.load(self.entity.unsent)
+    headers = util.request_headers(source=g.source)
+    outcomes = {}
+    by_domain = {}
+    for target in self.entity.unsent:
       try:
         source_url = self.source_url(target)
-        logger.info(f'Webmention from {source_url} to {target}')
-
-        # see if we've cached webmention discovery for this domain. the cache
-        # value is a string URL endpoint if discovery succeeded, NO_ENDPOINT if
-        # no endpoint was found.
-        cache_key = util.webmention_endpoint_cache_key(target)
-        endpoint = util.webmention_endpoint_cache.get(cache_key)
-        if endpoint:
-          logger.info(f'Webmention discovery: using cached endpoint {cache_key}: {endpoint}')
-
-        # send! and handle response or error
-        headers = util.request_headers(source=g.source)
-        if not endpoint:
-          endpoint, resp = webmention.discover(target, follow_meta_refresh=True, headers=headers)
-          with util.webmention_endpoint_cache_lock:
-            util.webmention_endpoint_cache[cache_key] = endpoint or NO_ENDPOINT
-
-        if endpoint and endpoint != NO_ENDPOINT:
-          logger.info('Sending...')
-          resp = webmention.send(endpoint, source_url, target, headers=headers,
-                                 timeout=WEBMENTION_SEND_TIMEOUT.total_seconds())
-          logger.info(f'Sent! {resp}')
-          self.record_source_webmention(endpoint, target)
+      except BaseException as e:
+        logger.info(f"Couldn't generate source URL for {target}", exc_info=True)
+        outcomes[target] = (None, None, e)
+        continue
+      domain = util.domain_from_link(target)
+      by_domain.setdefault(domain, []).append((source_url, target))
+
+    # hold off on domains that are failing or over their rate limit
+    models.InstanceHealth.load_multi(
+      [models.webmention_domain_key(domain) for domain in by_domain])
+    deferred = {}
+    for domain in list(by_domain):
+      delay = self.domain_delay(domain)
+      if delay:
+        deferred[domain] = delay
+        for _, target in by_domain.pop(domain):
+          outcomes[target] = (None, None, DomainDeferred(domain))
+
+    discovered = {}
+    healthy = {}
+    for domain, (domain_outcomes, domain_discovered) in zip(
+        by_domain, util.concurrent_map(
+          lambda targets: self.send_to_domain(targets, headers),
+          by_domain.values(), max_workers=WEBMENTION_SEND_THREADS)):
+      outcomes.update(domain_outcomes)
+      discovered.update(domain_discovered)
+      healthy[domain] = not any(e is not None and is_domain_failure(e)
+                                for _, _, e in domain_outcomes.values())
+
+    models.WebmentionEndpoint.save(discovered)
+    logger.info(f'Webmention endpoint cache stats: {dict(util.webmention_endpoint_cache_stats)}')
+    for domain, ok in healthy.items():
+      models.InstanceHealth.record(models.webmention_domain_key(domain), ok)
+
+    # record outcomes in target order so that they're deterministic
+    sent = self.sent
+    now = int(util.to_utc_timestamp(util.now()))
+    deferred_since = {}
+    for target in self.entity.unsent:
+      endpoint, resp, e = outcomes[target]
+
+      if e is None:
+        if endpoint and endpoint != util.NO_ENDPOINT:
           self.entity.sent.append(target)
+          sent.append((endpoint, target))
         else:
-          logger.info('Giving up this target.')
+          logger.info(f'No endpoint; giving up on {target}')
           self.entity.skipped.append(target)
 
-      except ValueError:
-        logger.info('Bad URL; giving up this target.')
+      elif isinstance(e, ValueError):
+        logger.info(f'Bad URL; giving up on {target}')
         self.entity.skipped.append(target)
 
-      except BaseException as e:
-        logger.info('', exc_info=True)
+      elif isinstance(e, DomainDeferred):
+        since = (self.entity.deferred_since or {}).get(target, now)
+        if now - since > WEBMENTION_DEFER_MAX_AGE.total_seconds():
+          logger.info(f'{e} has been failing too long; giving up on {target}')
+          self.entity.failed.append(target)
+        else:
+          logger.info(f'Deferring {target}')
+          self.entity.error.append(target)
+          deferred_since[target] = since
+
+      else:
         # Give up on 4XX and DNS errors; we don't expect retries to succeed.
         code, _ = util.interpret_http_exception(e)
         if ((code and code.startswith('4') and code != '429')
             or 'DNS lookup failed' in str(e)):
-          logger.info('Giving up this target.')
+          logger.info(f'Giving up on {target}')
           self.entity.failed.append(target)
         else:
           self.fail(f'Error sending to endpoint: {resp}')
           self.entity.error.append(target)
 
-      if target in self.entity.unsent:
-        self.entity.unsent.remove(target)
-
-    if self.entity.error:
-      logger.info('Some targets failed')
-      self.release('error')
-    else:
+    self.entity.unsent = []
+    self.entity.deferred_since = deferred_since or None
+    if not self.entity.error:
       self.complete()
+      return
+
+    logger.info('Some targets failed')
+    failed = getattr(g, 'failed', None)
+    self.release('error')
+    if deferred and not failed:
+      # only deferred targets are left. retry when the first domain is ready,
+      # instead of with the queue's backoff.
+      delay = min(deferred.values())
+      logger.info(f'Retrying in {delay}')
+      self.entity.add_task(delay=delay)
+
+  @staticmethod
+  def domain_delay(domain):
+    """Checks whether we should hold off on sending to a target domain.
+
+    Args:
+      domain (str)
+
+    Returns:
+      datetime.timedelta: how long to wait, or None if we can send now
+    """
+    key = models.webmention_domain_key(domain)
+    delay = models.InstanceHealth.open_delay(key)
+    if delay:
+      return delay
+
+    health = models.InstanceHealth.load(key)
+    if health and health.failures:
+      delay = models.TokenBucket.take(key, WEBMENTION_DOMAIN_RATE,
+                                      WEBMENTION_DOMAIN_BURST)
+      if delay:
+        logger.info(f'{domain} is over its rate limit, deferring {delay}')
+        return delay
+
+  @staticmethod
+  def send_to_domain(targets, headers):
+    """Discovers endpoints and sends webmentions to targets on a single domain.
+
+    Sends serially, in target order. Runs in a worker thread, so it only makes
+    HTTP requests and uses the in-memory endpoint cache. It doesn't touch the
+    datastore, ``g``, or the entity.
+
+    Waits for one of the domain's :const:`WEBMENTION_DOMAIN_CONCURRENCY` slots
+    in this process first. If sending to a target fails with
+    :func:`is_domain_failure`, doesn't try the rest, and their outcomes are
+    :class:`DomainDeferred`.
+
+    Args:
+      targets (sequence of (str source URL, str target URL) tuples)
+      headers (dict): HTTP request headers
+
+    Returns:
+      (dict outcomes, dict discovered) tuple: outcomes maps str target URL to
+      (str endpoint, :class:`requests.Response`, :class:`BaseException`) tuple.
+      The exception is None if sending succeeded, or if we didn't find an
+      endpoint; the endpoint is None or ``NO_ENDPOINT`` in that case. discovered
+      maps :func:`util.webmention_endpoint_cache_key` to (str endpoint, datetime
+      expires) tuple for new discovery results, to be stored with
+      :meth:`models.WebmentionEndpoint.save`.
+    """
+    outcomes = {}
+    discovered = {}
+    if not targets:
+      return outcomes, discovered
+
+    domain = util.domain_from_link(targets[0][1])
+    with models.concurrency_slot(models.webmention_domain_key(domain),
+                                 WEBMENTION_DOMAIN_CONCURRENCY):
+      failing = False
+      for source_url, target in targets:
+        if failing:
+          outcomes[target] = (None, None, DomainDeferred(domain))
+          continue
+        outcomes[target] = endpoint, resp, e = SendWebmentions.send_one(
+          source_url, target, headers, discovered)
+        failing = e is not None and is_domain_failure(e)
+
+    return outcomes, discovered
+
+  @staticmethod
+  def send_one(source_url, target, headers, discovered):
+    """Discovers a target's endpoint, if necessary, and sends a webmention.
+
+    Args:
+      source_url (str)
+      target (str)
+      headers (dict): HTTP request headers
+      discovered (dict): new discovery results are added here. See
+        :meth:`send_to_domain`.
+
+    Returns:
+      (str endpoint, :class:`requests.Response`, :class:`BaseException`) tuple:
+      see :meth:`send_to_domain`
+    """
+    endpoint = resp = None
+    try:
+      logger.info(f'Webmention from {source_url} to {target}')
+
+      # see if we've cached webmention discovery for this domain. the cache
+      # value is a string URL endpoint if discovery succeeded, NO_ENDPOINT if
+      # no endpoint was found.
+      endpoint = util.get_cached_webmention_endpoint(target)
+      if endpoint:
+        logger.info(f'Webmention discovery: using cached endpoint for {target}: {endpoint}')
+
+      # send! and handle response or error
+      if not endpoint:
+        endpoint, resp = webmention.discover(target, follow_meta_refresh=True, headers=headers)
+        endpoint = endpoint or util.NO_ENDPOINT
+        expires = util.cache_webmention_endpoint(target, endpoint, resp)
+        discovered[util.webmention_endpoint_cache_key(target)] = (endpoint, expires)
+
+      if endpoint and endpoint != util.NO_ENDPOINT:
+        logger.info(f'Sending to {endpoint}...')
+        resp = webmention.send(endpoint, source_url, target, headers=headers,
+                               timeout=WEBMENTION_SEND_TIMEOUT.total_seconds())
+        logger.info(f'Sent! {resp}')
+
+      return endpoint, resp, None
+
+    except BaseException as e:
+      logger.info(f'Sending to {target} failed', exc_info=True)
+      return endpoint, resp, e
 
   @ndb.transactional()
   def lease(self, key):
@@ -677,6 +985,10 @@ class SendWebmentions(View):
     Also loads and sets ``g.source``, and returns False if the source doesn't
     exist or is disabled.
 
+    Increments the entity's ``version`` and stores it in ``self.version``.
+    :meth:`finish` only writes our outcomes if it hasn't changed since, ie if no
+    other task has leased the entity since we did.
+
     Args:
       key (ndb.Key):
 
@@ -704,73 +1016,101 @@ class SendWebmentions(View):
     assert self.entity.status in ('new', 'processing', 'error'), self.entity.status
     self.entity.status = 'processing'
     self.entity.leased_until = util.now() + self.LEASE_LENGTH
+    self.entity.version = self.version = (self.entity.version or 0) + 1
     self.entity.put()
+    self.sent = []
     return True
 
-  @ndb.transactional()
   def complete(self):
     """Attempts to mark the :class:`models.Webmentions` entity completed.
 
     Returns True on success, False otherwise.
     """
-    existing = self.entity.key.get()
-    if existing is None:
-      self.fail('entity disappeared!')
-    elif existing.status == 'complete':
-      # let this task return 200 and finish
-      logger.warning('another task stole and finished this. did my lease expire?')
-    elif self.entity.status == 'complete':
-      # let this task return 200 and finish
-      logger.error('i already completed this task myself somehow?! '
-                    'https://github.com/snarfed/bridgy/issues/610')
-    elif existing.status == 'new':
-      self.fail('went backward from processing to new!')
-    else:
-      assert existing.status == 'processing', existing.status
-      assert self.entity.status == 'processing', self.entity.status
-      self.entity.status = 'complete'
-      self.entity.put()
-      return True
+    return self.finish('complete')
 
-    return False
-
-  @ndb.transactional()
   def release(self, new_status):
     """Attempts to unlease the :class:`models.Webmentions` entity.
 
     Args:
       new_status (str):
     """
+    self.finish(new_status)
+
+  @ndb.transactional()
+  def finish(self, new_status):
+    """Writes the :class:`models.Webmentions` entity's final state.
+
+    Also updates the source's ``last_webmention_sent`` and
+    ``webmention_endpoint`` for the webmentions in ``self.sent``, in the same
+    transaction, so that each propagate task only runs two transactions, this
+    one and :meth:`lease`, regardless of how many targets it sends to.
+
+    Does nothing if another task has leased the entity since we did, or if
+    we've already finished it. The other task's outcomes win, and it sends
+    any webmentions we didn't.
+
+    Args:
+      new_status (str): ``complete`` or ``error``
+
+    Returns:
+      bool: True if we wrote the entity, False otherwise
+    """
     existing = self.entity.key.get()
-    # TODO: send_webmentions() edits self.entity.unsent etc, so if it fails and hits here, those values may be lost mid flight!
-    if existing and existing.status == 'processing':
-      self.entity.status = new_status
+    if existing is None:
+      self.fail('entity disappeared!')
+      return False
+    elif existing.version != self.version:
+      # let this task return 200 and finish
+      logger.warning(f'another task leased this after us, version {existing.version} vs our {self.version}. did my lease expire?')
+      return False
+    elif existing.status != 'processing':
+      logger.error(f"can't finish, status is already {existing.status}")
+      return False
+
+    self.entity.status = new_status
+    if new_status != 'complete':
       self.entity.leased_until = None
-      self.entity.put()
+    self.entity.put()
+
+    if self.sent and not self.defer_source_update:
+      self.record_source_webmentions(self.sent)
+    return True
 
   def fail(self, message):
     """Marks the request failed and logs an error message."""
     logger.warning(message)
     g.failed = True
 
-  @ndb.transactional()
-  def record_source_webmention(self, endpoint, target):
+  @staticmethod
+  def record_source_webmentions(sent):
     """Sets this source's last_webmention_sent and maybe webmention_endpoint.
 
+    Uses :meth:`models.Source.put_updates`, so it only writes the source if
+    something changed. Skips ``last_webmention_sent`` if the stored value is
+    within :const:`LAST_WEBMENTION_SENT_RESOLUTION`. Called inside
+    :meth:`finish`'s transaction, or by :class:`PropagateBatch` for the whole
+    batch.
+
     Args:
-      endpoint (str): URL
-      target (str): URL
+      sent (sequence of (str endpoint URL, str target URL) tuples): webmentions
+        we just sent
     """
-    g.source = g.source.key.get()
-    logger.info('Setting last_webmention_sent')
-    g.source.last_webmention_sent = util.now()
+    now = util.now()
+    updates = g.source.updates = {}
 
-    if (endpoint != g.source.webmention_endpoint and
-        util.domain_from_link(target) in g.source.domains):
-      logger.info(f'Also setting webmention_endpoint to {endpoint} (discovered in {target}; was {g.source.webmention_endpoint})')
-      g.source.webmention_endpoint = endpoint
+    last_sent = g.source.last_webmention_sent
+    if not last_sent or last_sent <= now - LAST_WEBMENTION_SENT_RESOLUTION:
+      logger.info('Setting last_webmention_sent')
+      updates['last_webmention_sent'] = now
 
-    g.source.put()
+    for endpoint, target in sent:
+      current = updates.get('webmention_endpoint', g.source.webmention_endpoint)
+      if (endpoint != current and
+          util.domain_from_link(target) in g.source.domains):
+        logger.info(f'Also setting webmention_endpoint to {endpoint} (discovered in {target}; was {current})')
+        updates['webmention_endpoint'] = endpoint
+
+    g.source = g.source.put_updates(g.source)
 
 
 class PropagateResponse(SendWebmentions):
@@ -787,8 +1127,19 @@ class PropagateResponse(SendWebmentions):
 
   def dispatch_request(self):
     logger.debug(f'Params: {list(request.values.items())}')
-    if not self.lease(ndb.Key(urlsafe=request.values['response_key'])):
-      return ('', ERROR_HTTP_RETURN_CODE) if getattr(g, 'failed', None) else 'OK'
+    self.propagate(ndb.Key(urlsafe=request.values['response_key']))
+    return ('', ERROR_HTTP_RETURN_CODE) if getattr(g, 'failed', None) else 'OK'
+
+  def propagate(self, key):
+    """Leases a :class:`models.Response` and sends its webmentions.
+
+    Sets ``g.failed`` if it should be retried.
+
+    Args:
+      key (ndb.Key): :class:`models.Response` key
+    """
+    if not self.lease(key):
+      return
 
     source = g.source
     poll_estimate = self.entity.created - datetime.timedelta(seconds=61)
@@ -801,10 +1152,9 @@ class PropagateResponse(SendWebmentions):
         not all(is_public(a) for a in self.activities)):
       logger.info('Response or author or activity is non-public. Dropping.')
       self.complete()
-      return ''
+      return
 
     self.send_webmentions()
-    return ('', ERROR_HTTP_RETURN_CODE) if getattr(g, 'failed', None) else 'OK'
 
   def source_url(self, target_url):
     # determine which activity to use. default to response.
@@ -842,6 +1192,60 @@ class PropagateResponse(SendWebmentions):
     return util.host_url('/'.join(parts))
 
 
+class PropagateBatch(View):
+  """Task handler that sends webmentions for multiple responses from one source.
+
+  :meth:`models.Response.add_tasks` uses this when a poll finds lots of new
+  responses for a source, eg 50 likes of a post that all point to the same
+  original post. Propagates each response in turn with
+  :class:`PropagateResponse`, so each one is leased and its status is stored
+  individually, but the responses after the first reuse the first ones'
+  webmention endpoint discovery results from the in-memory cache, and the
+  source is only updated once, at the end.
+
+  If any response fails, returns an error so that the task is retried.
+  Responses that were already completed are skipped on retry.
+
+  Request parameters:
+
+  * source_key (str): key of :class:`models.Source` entity
+  * response_keys (str): comma-separated keys of :class:`models.Response`
+    entities
+  """
+
+  def dispatch_request(self):
+    logger.debug(f'Params: {list(request.values.items())}')
+    source_key = ndb.Key(urlsafe=request.values['source_key'])
+    keys = [ndb.Key(urlsafe=key) for key
+            in request.values['response_keys'].split(',') if key]
+
+    sent = []
+    failed = False
+    for key in keys:
+      # per response, so that one's failure doesn't stop later ones from
+      # scheduling their own retries for deferred targets
+      g.failed = False
+      task = PropagateResponse()
+      task.defer_source_update = True
+      try:
+        task.propagate(key)
+      except Exception:
+        # keep going, and retry the whole batch afterward
+        logger.warning(f"Couldn't propagate {key.urlsafe().decode()}",
+                       exc_info=True)
+        g.failed = True
+      finally:
+        sent.extend(getattr(task, 'sent', []))
+      failed = failed or g.failed
+
+    g.failed = failed
+    if sent and getattr(g, 'source', None) and g.source.key == source_key:
+      SendWebmentions.record_source_webmentions(sent)
+
+    logger.info(f'Webmention endpoint cache stats: {dict(util.webmention_endpoint_cache_stats)}')
+    return ('', ERROR_HTTP_RETURN_CODE) if failed else 'OK'
+
+
 class PropagateBlogPost(SendWebmentions):
   """Task handler that sends webmentions for a :class:`models.BlogPost`.
 
@@ -875,4 +1279,5 @@ app.add_url_rule('/_ah/queue/poll', view_func=Poll.as_view('poll'), methods=['PO
 app.add_url_rule('/_ah/queue/poll-now', view_func=Poll.as_view('poll-now'), methods=['POST'])
 app.add_url_rule('/_ah/queue/discover', view_func=Discover.as_view('discover'), methods=['POST'])
 app.add_url_rule('/_ah/queue/propagate', view_func=PropagateResponse.as_view('propagate'), methods=['POST'])
+app.add_url_rule('/_ah/queue/propagate-batch', view_func=PropagateBatch.as_view('propagate_batch'), methods=['POST'])
 app.add_url_rule('/_ah/queue/propagate-blogpost', view_func=PropagateBlogPost.as_view('propagate_blogpost'), methods=['POST'])
@@ -11,7 +11,7 @@ import oauth_dropins.flickr
 import oauth_dropins.flickr_auth
 from oauth_dropins import indieauth
 import oauth_dropins.mastodon
-from webutil.testutil import requests_response, UrlopenResult
+from webutil.testutil import NOW, requests_response, UrlopenResult
 from webutil.util import json_dumps, json_loads
 import requests
 from urllib3.exceptions import NewConnectionError
@@ -20,6 +20,7 @@ import cron
 from flickr import Flickr
 from mastodon import Mastodon
 import models
+import poll_scheduler
 from . import testutil
 from .testutil import FakeSource
 import tasks
@@ -63,8 +64,76 @@ class CronTest(testutil.BackgroundTest):
 
     resp = self.client.get('/cron/replace_poll_tasks')
     self.assertEqual(200, resp.status_code)
+    self.assertEqual(1, resp.json['fake'])
     self.assert_task('poll', source_key=sources[4], last_polled='1970-01-01-00-00-00')
 
+  @patch('cron.REPLACE_POLL_TASKS_PAGE_SIZE', new=2)
+  @patch('cron.REPLACE_POLL_TASKS_DEADLINE', new=datetime.timedelta())
+  def test_replace_poll_tasks_resumes(self):
+    month_ago = util.now() - datetime.timedelta(days=30)
+    self.clear_datastore()
+    sources = [FakeSource.new(features=['listen'],
+                              last_poll_attempt=month_ago + datetime.timedelta(minutes=i)
+                              ).put()
+               for i in range(3)]
+
+    def check(expected):
+      resp = self.client.get('/cron/replace_poll_tasks')
+      self.assertEqual(200, resp.status_code)
+      self.assertEqual(len(expected), resp.json['fake'])
+      self.assert_tasks(*({'queue': 'poll', 'source_key': key,
+                           'last_polled': '1970-01-01-00-00-00'}
+                          for key in expected))
+
+    # out of time after the first page
+    check(sources[:2])
+    self.assertEqual(month_ago + datetime.timedelta(minutes=1),
+                     cron.ReplacePollTasksCursor.get_by_id('fake').last_poll_attempt)
+
+    # resumes at the last source it reached, then finishes and starts over next
+    # time
+    with patch('cron.REPLACE_POLL_TASKS_DEADLINE', new=datetime.timedelta(hours=1)):
+      check(sources[1:])
+    self.assertIsNone(cron.ReplacePollTasksCursor.get_by_id('fake').last_poll_attempt)
+    check(sources[:2])
+
+  def test_replace_poll_tasks_exact_eta(self):
+    self.clear_datastore()
+    source = FakeSource.new(features=['listen'],
+                            last_poll_attempt=util.now() - datetime.timedelta(days=30)
+                            ).put()
+
+    with patch('random.uniform', return_value=600):
+      resp = self.client.get('/cron/replace_poll_tasks')
+    self.assertEqual(200, resp.status_code)
+
+    # no extra jitter on top of the spread
+    task = self.mock_create_task.call_args.args[0].task
+    self.assertEqual(int(util.to_utc_timestamp(NOW)) + 600,
+                     util.to_utc_timestamp(task.schedule_time))
+    self.assert_task('poll', source_key=source, last_polled='1970-01-01-00-00-00')
+
+  @patch('poll_scheduler.POLL_BUDGET', new=2)
+  def test_update_poll_budget(self):
+    self.clear_datastore()
+    for _ in range(2):
+      FakeSource.new(features=['listen'], created=util.now() - datetime.timedelta(days=30),
+                     last_webmention_sent=util.now() - datetime.timedelta(days=1),
+                     poll_rate_samples=poll_scheduler.MIN_SAMPLES,
+                     # REFERENCE_RATE, including the prior
+                     poll_rate_responses=249.9, poll_rate_hours=832).put()
+    # not listening, doesn't count
+    FakeSource.new(features=['publish']).put()
+
+    resp = self.client.get('/cron/update_poll_budget')
+    self.assertEqual(200, resp.status_code)
+    self.assertEqual(2, resp.json['sources'])
+
+    # two sources would poll every FAST_POLL, twice the budget
+    budget = models.PollBudget.get_by_id(models.PollBudget.ID)
+    self.assertAlmostEqual(2, budget.scale, places=3)
+    self.assertEqual(2, budget.sources)
+
   # @patch('cron.PAGE_SIZE', new=1)
   def test_update_flickr_pictures(self):
     flickrs = self._setup_flickr()
@@ -130,6 +199,24 @@ class CronTest(testutil.BackgroundTest):
     self.assertEqual(200, resp.status_code)
     self.assertEqual('http://before', mastodon.key.get().picture)
 
+  def test_update_mastodon_pictures_circuit_open(self):
+    mastodon = self._setup_mastodon()
+    models.InstanceHealth(id='mastodon foo.com', failures=5,
+                          open_until=NOW + datetime.timedelta(hours=1)).put()
+
+    resp = self.client.get('/cron/update_mastodon_pictures')
+    self.assertEqual(200, resp.status_code)
+    self.assertEqual('http://before', mastodon.key.get().picture)
+    self.mock_get.assert_not_called()
+
+  def test_update_mastodon_pictures_records_instance_failure(self):
+    self.mock_get.side_effect = NewConnectionError(None, None)
+
+    self._setup_mastodon()
+    resp = self.client.get('/cron/update_mastodon_pictures')
+    self.assertEqual(200, resp.status_code)
+    self.assertEqual(1, models.InstanceHealth.get_by_id('mastodon foo.com').failures)
+
   def _setup_flickr(self):
     """Creates and test :class:`Flickr` entities."""
     flickrs = []
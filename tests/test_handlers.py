@@ -1,15 +1,17 @@
 """Unit tests for handlers.py."""
+from datetime import timedelta
 import html
 import io
 import urllib.request, urllib.error, urllib.parse
 from unittest.mock import patch
 
-from webutil.testutil import enable_flask_caching, requests_response
+from webutil.testutil import enable_flask_caching, NOW, requests_response
 from util import json_dumps, json_loads
 
 from flask_app import app
 import handlers
 import models
+import util
 from . import testutil
 from .testutil import FakeGrSource, FakeSource
 
@@ -129,6 +131,123 @@ asdf http://other/link qwert
       },
     }, resp.json)
 
+  def test_etag(self):
+    resp = self.check_response('/post/fake/%s/000', self.post_html)
+    etag = resp.headers['ETag']
+    self.assertTrue(etag)
+
+    # served from the in-memory cache
+    FakeGrSource.activities = []
+    resp = self.client.get(f'/post/fake/{self.source.key.string_id()}/000',
+                           base_url='https://localhost/',
+                           headers={'If-None-Match': etag})
+    self.assertEqual(304, resp.status_code)
+    self.assertEqual('', resp.get_data(as_text=True))
+
+  def store_response(self, id, response, type):
+    resp = models.Response(
+      id=id, source=self.source.key, type=type,
+      response_json=json_dumps(response),
+      activities_json=[json_dumps(self.activities[0])])
+    resp.put()
+    return resp
+
+  def test_stored_response_comment(self):
+    self.store_response('tag:fa.ke,2013:a1-b2.c3', FakeGrSource.comment, 'comment')
+    FakeGrSource.activities = []
+    FakeGrSource.comment = None
+
+    resp = self.check_response('/comment/fake/%s/000/a1-b2.c3')
+    body = resp.get_data(as_text=True)
+    self.assertIn('<span class="p-uid">tag:fa.ke,2013:a1-b2.c3</span>', body)
+    self.assertIn('<a class="u-in-reply-to" href="http://or.ig/post"></a>', body)
+    self.assertIn('<a class="u-mention" aria-hidden="true" href="http://other/link"></a>', body)
+
+  def test_stored_response_like(self):
+    self.store_response('tag:fa.ke,2013:000_liked_by_111', {
+      'objectType': 'activity',
+      'verb': 'like',
+      'id': 'tag:fa.ke,2013:000_liked_by_111',
+      'object': {'url': 'http://fa.ke/000'},
+      'author': {'displayName': 'Alice'},
+    }, 'like')
+    # another user's like of the same post
+    self.store_response('tag:fa.ke,2013:000_liked_by_2222', {}, 'like')
+    FakeGrSource.activities = []
+
+    resp = self.check_response('/like/fake/%s/000/111')
+    body = resp.get_data(as_text=True)
+    self.assertIn('<span class="p-name">Alice</span>', body)
+    self.assertIn('<a class="u-like-of" href="http://or.ig/post"></a>', body)
+
+  def test_stored_response_like_other_label(self):
+    """Like ids with labels we don't know fall back to scanning the post."""
+    self.store_response('tag:fa.ke,2013:000_hearted_by_111', {
+      'objectType': 'activity',
+      'verb': 'like',
+      'id': 'tag:fa.ke,2013:000_hearted_by_111',
+      'object': {'url': 'http://fa.ke/000'},
+      'author': {'displayName': 'Alice'},
+    }, 'like')
+    FakeGrSource.activities = []
+
+    resp = self.check_response('/like/fake/%s/000/111')
+    self.assertIn('<span class="p-name">Alice</span>', resp.get_data(as_text=True))
+
+  def test_stored_response_repost_by_id(self):
+    """Twitter-style repost ids are the repost's own id, eg the retweet id."""
+    self.store_response('tag:fa.ke,2013:333', {
+      'objectType': 'activity',
+      'verb': 'share',
+      'id': 'tag:fa.ke,2013:333',
+      'object': {'url': 'http://fa.ke/000'},
+      'author': {'displayName': 'Bob'},
+    }, 'repost')
+    FakeGrSource.share = None
+
+    with patch.object(models.Response, 'query') as query:
+      resp = self.check_response('/repost/fake/%s/000/333')
+      query.assert_not_called()
+
+    body = resp.get_data(as_text=True)
+    self.assertIn('<span class="p-name">Bob</span>', body)
+    self.assertIn('<a class="u-repost-of" href="http://or.ig/post"></a>', body)
+
+  def test_stored_response_other_source(self):
+    resp = self.store_response('tag:fa.ke,2013:a1-b2.c3', {'content': 'foo'},
+                               'comment')
+    resp.source = FakeSource.new().key
+    resp.put()
+    FakeGrSource.comment['content'] = 'from silo'
+
+    resp = self.check_response('/comment/fake/%s/000/a1-b2.c3')
+    self.assertIn('from silo', resp.get_data(as_text=True))
+
+  def test_stored_response_stale(self):
+    stored = self.store_response('tag:fa.ke,2013:a1-b2.c3', {'content': 'foo'},
+                                 'comment')
+    FakeGrSource.comment['content'] = 'from silo'
+
+    later = stored.created + handlers.STORED_RESPONSE_MAX_AGE + timedelta(hours=1)
+    with patch.object(util, 'now', return_value=later):
+      # propagating updates the response, but its data is still stale
+      stored.status = 'complete'
+      stored.put()
+      resp = self.check_response('/comment/fake/%s/000/a1-b2.c3')
+    self.assertIn('from silo', resp.get_data(as_text=True))
+
+  def test_stored_response_refetched(self):
+    stored = self.store_response('tag:fa.ke,2013:a1-b2.c3', {'content': 'foo'},
+                                 'comment')
+    later = stored.created + handlers.STORED_RESPONSE_MAX_AGE + timedelta(hours=1)
+    stored.fetched = later - timedelta(days=1)
+    stored.put()
+    FakeGrSource.comment['content'] = 'from silo'
+
+    with patch.object(util, 'now', return_value=later):
+      resp = self.check_response('/comment/fake/%s/000/a1-b2.c3')
+    self.assertIn('foo', resp.get_data(as_text=True))
+
   def test_post_missing(self):
     FakeGrSource.activities = []
     self.check_response('/post/fake/%s/000', expected_status=404)
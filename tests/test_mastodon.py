@@ -44,11 +44,14 @@ class MastodonTest(testutil.AppTest):
     self.assertEqual(good, self.m.canonicalize_url(good))
     self.assertEqual(good, self.m.canonicalize_url('http://foo.com/@x/123/'))
 
+  def test_throttle_key(self):
+    self.assertEqual('mastodon foo.com', self.m.throttle_key())
+
   def test_load_blocklist_missing_scope(self):
     self.mock_get.return_value = requests_response('', status=403)
     self.m.load_blocklist()
     self.assert_requests_get('https://foo.com' + API_BLOCKS)
-    self.assertEqual([], self.m.blocked_ids)
+    self.assertEqual([], self.m.poll_cache().blocked_ids)
     self.assertFalse(self.m.is_blocked({'numeric_id': 123}))
 
   def test_gr_class_with_max_toot_chars(self):
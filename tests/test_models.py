@@ -5,6 +5,7 @@ from unittest.mock import patch
 import copy
 
 from flask import get_flashed_messages
+from google.api_core.exceptions import Aborted
 from google.cloud import ndb
 from granary import source as gr_source
 from webutil.testutil import NOW, requests_response
@@ -42,6 +43,56 @@ class ResponseTest(testutil.AppTest):
     got = self.responses[0].get_or_save(self.sources[0])
     self.assert_entities_equal(self.responses[0], got, ignore=['updated'])
 
+  def test_summary(self):
+    response = self.responses[0]
+    response.put()
+    summary = models.ResponseSummary.get_by_id(response.key.id())
+    self.assertEqual(self.sources[0].key, summary.source)
+    self.assertTrue(summary.public)
+    self.assertEqual(response.updated, summary.updated)
+    self.assertEqual('comment', summary.summary['type'])
+    self.assertEqual([{
+      'url': 'http://fa.ke/post/url',
+      'content': 'foo http://target1/post/url bar',
+    }], summary.summary['activities'])
+
+    # unchanged, or only status and targets changed, don't regenerate or write
+    with patch.object(models.ResponseSummary, 'put') as mock_put, \
+         patch.object(models.ResponseSummary, 'summarize') as mock_summarize:
+      response.put()
+      response.status = 'complete'
+      response.sent = response.unsent
+      response.unsent = []
+      response.put()
+      mock_summarize.assert_not_called()
+      mock_put.assert_not_called()
+
+    response.original_posts = ['http://or/ig']
+    response.put()
+    summary = models.ResponseSummary.get_by_id(response.key.id())
+    self.assertEqual(1, len(summary.summary['original_links']))
+
+    # retried or re-propagated later, so it moves up the user page
+    later = NOW + models.RESPONSE_SUMMARY_UPDATED_RESOLUTION
+    with patch.object(util, 'now', return_value=later):
+      response.status = 'new'
+      response.put()
+    summary = models.ResponseSummary.get_by_id(response.key.id())
+    self.assertEqual(response.updated, summary.updated)
+    self.assertEqual(later, response.summary_updated)
+
+    response.key.delete()
+    self.assertIsNone(models.ResponseSummary.get_by_id(response.key.id()))
+
+  def test_summary_private(self):
+    response = self.responses[0]
+    response.response_json = json_dumps({
+      **json_loads(response.response_json),
+      'to': [{'objectType': 'group', 'alias': '@private'}],
+    })
+    response.put()
+    self.assertFalse(models.ResponseSummary.get_by_id(response.key.id()).public)
+
   def test_get_or_save_restart_new(self):
     response = self.responses[0]
 
@@ -88,6 +139,7 @@ class ResponseTest(testutil.AppTest):
     # original response
     response = self.responses[0]
     response.put()
+    self.assertIsNone(response.fetched)
 
     # change response content
     old_resp_json = response.response_json
@@ -99,6 +151,7 @@ class ResponseTest(testutil.AppTest):
     response = response.get_or_save(self.sources[0])
     self.assert_equals(json_dumps(new_resp_json), response.response_json)
     self.assert_equals([old_resp_json], response.old_response_jsons)
+    self.assertIsNotNone(response.key.get().fetched)
 
     # mark response completed, change content again
     def complete():
@@ -181,6 +234,89 @@ class ResponseTest(testutil.AppTest):
     saved = self.responses[0].get_or_save(self.sources[0])
     self.assertEqual('complete', saved.status)
 
+  def test_get_or_save_multi(self):
+    # existing, with a new target
+    self.responses[0].put()
+    existing = Response(id=self.responses[0].key.id(),
+                        unsent=['http://new'],
+                        response_json=self.responses[0].response_json)
+    # new, no targets
+    self.responses[2].unsent = []
+
+    got = Response.get_or_save_multi(self.responses[1:3] + [existing],
+                                     source=self.sources[0])
+    self.assertEqual([self.responses[1].key, self.responses[2].key,
+                      self.responses[0].key], [r.key for r in got])
+    self.assertEqual('new', got[0].status)
+    self.assertEqual('complete', got[1].status)
+    self.assertEqual(['http://target1/post/url', 'http://new'], got[2].unsent)
+
+    self.assert_entities_equal(got, [r.key.get() for r in got], ignore=['updated'])
+    self.assert_tasks({'queue': 'propagate', 'response_key': self.responses[1]},
+                      {'queue': 'propagate', 'response_key': self.responses[0]})
+
+  @patch.object(models, 'PROPAGATE_BATCH_MIN', 2)
+  @patch.object(models, 'PROPAGATE_BATCH_SIZE', 2)
+  def test_get_or_save_multi_propagate_batch(self):
+    resps = self.responses[:3]
+    Response.get_or_save_multi(resps, source=self.sources[0])
+
+    keys = [r.key.urlsafe().decode() for r in resps]
+    source_key = self.sources[0].key
+    self.assert_tasks({
+      'queue': 'propagate-batch',
+      'source_key': source_key,
+      'response_keys': ','.join(keys[:2]),
+    }, {
+      'queue': 'propagate-batch',
+      'source_key': source_key,
+      'response_keys': keys[2],
+    })
+
+  def test_get_or_save_multi_collision(self):
+    """A new response stored by someone else in the meantime gets merged."""
+    response = self.responses[0]
+    orig_get_multi = ndb.get_multi
+
+    def get_multi(keys, **kwargs):
+      got = orig_get_multi(keys, **kwargs)
+      if not response.key.get():
+        Response(id=response.key.id(), failed=['http://failed'],
+                 response_json=response.response_json).put()
+      return got
+
+    with patch.object(ndb, 'get_multi', side_effect=get_multi):
+      got = Response.get_or_save_multi([response], source=self.sources[0])
+
+    self.assertEqual(['http://target1/post/url'], got[0].unsent)
+    self.assertEqual(['http://failed'], got[0].failed)
+    self.assert_task('propagate', response_key=response)
+
+  def test_get_or_save_multi_batches_summaries(self):
+    with patch.object(models.ResponseSummary, 'put') as mock_put:
+      got = Response.get_or_save_multi(self.responses[:3], source=self.sources[0])
+      mock_put.assert_not_called()
+
+    for resp in got:
+      summary = models.ResponseSummary.get_by_id(resp.key.id())
+      self.assertEqual(resp.updated, summary.updated)
+
+  def test_get_or_save_multi_add_tasks_fails(self):
+    """If adding propagate tasks fails, new responses are deleted for retry."""
+    self.responses[1].unsent = []
+    self.mock_create_task.side_effect = RuntimeError('tasks are down')
+    with self.assertRaises(RuntimeError):
+      Response.get_or_save_multi(self.responses[:2], source=self.sources[0])
+
+    self.assertIsNone(self.responses[0].key.get())
+    self.assertEqual('complete', self.responses[1].key.get().status)
+
+    self.mock_create_task.side_effect = None
+    self.mock_create_task.reset_mock()
+    got = Response.get_or_save_multi(self.responses[:1], source=self.sources[0])
+    self.assertEqual('new', got[0].status)
+    self.assert_task('propagate', response_key=self.responses[0])
+
   def test_get_type(self):
     self.assertEqual('repost', Response.get_type(
         {'objectType': 'activity', 'verb': 'share'}))
@@ -655,6 +791,17 @@ class SourceTest(testutil.AppTest):
     Source.put_updates(source)
     self.assertEqual('disabled', source.key.get().status)
 
+  def test_put_updates_unchanged(self):
+    source = FakeSource.new()
+    source.put()
+
+    source.updates = {'status': source.status, 'last_polled': source.last_polled}
+    with patch.object(FakeSource, 'put') as mock_put:
+      got = Source.put_updates(source)
+
+    mock_put.assert_not_called()
+    self.assertEqual(source.key, got.key)
+
   def test_poll_period(self):
     source = FakeSource.new()
     source.put()
@@ -689,6 +836,179 @@ class SourceTest(testutil.AppTest):
     source.last_webmention_sent = now - timedelta(minutes=45)
     self.assertEqual(source.VOLUME_POLL, source.poll_period())
 
+  def test_poll_period_adaptive(self):
+    source = FakeSource.new(created=datetime(2000, 1, 1, tzinfo=timezone.utc),
+                            last_webmention_sent=util.now() - timedelta(days=60))
+    source.poll_rate_samples = poll_scheduler.MIN_SAMPLES - 1
+    source.poll_rate_responses = 0
+    source.poll_rate_hours = 24 * 60
+    self.assertEqual(source.SLOW_POLL, source.poll_period())
+
+    # enough samples, but no responses, so still slow
+    source.poll_rate_samples = poll_scheduler.MIN_SAMPLES
+    self.assertEqual(source.SLOW_POLL, source.poll_period())
+
+    # lots of responses, so poll fast
+    source.poll_rate_responses = 1000
+    self.assertEqual(source.FAST_POLL, source.poll_period())
+
+    # in between
+    source.poll_rate_responses = 2
+    self.assertLess(source.FAST_POLL, source.poll_period())
+    self.assertGreater(source.SLOW_POLL, source.poll_period())
+
+    # recent post means at least FAST_POLL
+    source.poll_rate_responses = 0
+    source.last_public_post = util.now() - timedelta(hours=1)
+    self.assertEqual(source.FAST_POLL, source.poll_period())
+
+    # scaled by the poll budget
+    source.last_public_post = None
+    source.poll_rate_responses = 2
+    unscaled = source.poll_period()
+    models.PollBudget(id=models.PollBudget.ID, scale=1.5).put()
+    util.poll_budget_cache.clear()
+    self.assertAlmostEqual(unscaled * 1.5, source.poll_period(),
+                           delta=timedelta(seconds=1))
+
+  def test_directory_entry(self):
+    source = FakeSource.new(name='Ms. Foo', picture='http://pic')
+    source.put()
+    key = models.DirectoryEntry.key_for('fake', source.key_id())
+    self.assertEqual({
+      'name_lower': 'ms. foo',
+      'silo': 'fake',
+      'enabled': False,
+      'title': 'Ms. Foo (FakeSource)',
+      'name': 'Ms. Foo',
+      'picture': 'http://pic',
+    }, key.get().to_dict(exclude=['updated']))
+
+    # unchanged, don't read or write, even with a cold process
+    source = source.key.get(use_cache=False)
+    with patch.object(models.DirectoryEntry, 'put') as mock_put, \
+         patch.object(ndb.Key, 'get') as mock_get:
+      source.last_poll_attempt = NOW
+      source.put()
+      mock_put.assert_not_called()
+      mock_get.assert_not_called()
+
+    source.features = ['listen']
+    source.put()
+    self.assertTrue(key.get().enabled)
+
+    source.key.delete()
+    self.assertIsNone(key.get())
+
+  def test_delete_deletes_children(self):
+    source = FakeSource.new()
+    source.put()
+    fetch = models.FeedFetch(parent=source.key, id='http://author/')
+    fetch.put()
+    source.poll_cache().blocked_ids = ['1']
+    source.put_poll_cache()
+
+    source.key.delete()
+    self.assertIsNone(fetch.key.get())
+    self.assertIsNone(source.poll_cache().key.get())
+
+  def test_throttle(self):
+    source = FakeSource.new()
+    self.assertIsNone(source.throttle())
+    self.assertIsNone(models.TokenBucket.get_by_id('fake'))
+
+    with patch.object(FakeSource, 'THROTTLE_RATE', new=.5), \
+         patch.object(FakeSource, 'THROTTLE_BURST', new=2):
+      self.assertIsNone(source.throttle())
+      self.assertIsNone(source.throttle())
+      self.assertEqual(timedelta(seconds=2), source.throttle())
+      self.assertEqual(0, models.TokenBucket.get_by_id('fake').tokens)
+
+      with patch.object(util, 'now', return_value=NOW + timedelta(seconds=1)):
+        self.assertEqual(timedelta(seconds=1), source.throttle())
+
+      with patch.object(util, 'now', return_value=NOW + timedelta(seconds=2)):
+        self.assertIsNone(source.throttle())
+        self.assertEqual(timedelta(seconds=2), source.throttle())
+
+      # refills up to the burst size
+      with patch.object(util, 'now', return_value=NOW + timedelta(hours=1)):
+        self.assertIsNone(source.throttle())
+        self.assertEqual(1, models.TokenBucket.get_by_id('fake').tokens)
+
+  def test_throttle_sharded(self):
+    source = FakeSource.new()
+    with patch.object(FakeSource, 'THROTTLE_RATE', new=3), \
+         patch.object(FakeSource, 'THROTTLE_BURST', new=3), \
+         patch('random.randrange', return_value=2):
+      self.assertIsNone(source.throttle())
+      self.assertEqual(timedelta(seconds=1), source.throttle())
+
+    self.assertIsNone(models.TokenBucket.get_by_id('fake'))
+    self.assertEqual(0, models.TokenBucket.get_by_id('fake 2').tokens)
+
+  def test_throttle_empty_bucket_cached(self):
+    source = FakeSource.new()
+    models.TokenBucket(id='fake', tokens=0, updated=NOW).put()
+    with patch.object(FakeSource, 'THROTTLE_RATE', new=.5), \
+         patch.object(FakeSource, 'THROTTLE_BURST', new=2):
+      self.assertEqual(timedelta(seconds=2), source.throttle())
+      with patch.object(models.TokenBucket, '_take') as take:
+        self.assertEqual(timedelta(seconds=2), source.throttle())
+        take.assert_not_called()
+
+  def test_throttle_contention(self):
+    source = FakeSource.new()
+    with patch.object(FakeSource, 'THROTTLE_RATE', new=.5), \
+         patch.object(FakeSource, 'THROTTLE_BURST', new=2), \
+         patch.object(models.TokenBucket, '_take',
+                      side_effect=Aborted('too much contention')):
+      self.assertEqual(models.TOKEN_BUCKET_CONTENTION_DELAY, source.throttle())
+
+  def test_circuit_breaker(self):
+    source = FakeSource.new()
+    source.record_health(requests.ConnectionError())
+    self.assertIsNone(source.circuit_open())
+    self.assertIsNone(models.InstanceHealth.get_by_id('fake'))
+
+    err_500 = requests.HTTPError(response=util.Struct(status_code='500', text=''))
+    err_404 = requests.HTTPError(response=util.Struct(status_code='404', text=''))
+
+    with patch.object(FakeSource, 'CIRCUIT_BREAKER', new=True):
+      # successes without failures don't write
+      source.record_health()
+      self.assertIsNone(models.InstanceHealth.get_by_id('fake'))
+
+      for _ in range(models.CIRCUIT_FAILURE_THRESHOLD - 1):
+        source.record_health(err_500)
+      self.assertIsNone(source.circuit_open())
+
+      # 404 means the instance is up
+      source.record_health(err_404)
+      self.assertEqual(0, models.InstanceHealth.get_by_id('fake').failures)
+
+      for _ in range(models.CIRCUIT_FAILURE_THRESHOLD - 1):
+        source.record_health(err_500)
+      source.record_health(requests.ConnectionError())
+      self.assertEqual(models.CIRCUIT_OPEN_MIN, source.circuit_open())
+
+      # trial call after the circuit closes fails, so it reopens for longer
+      with patch.object(util, 'now', return_value=NOW + models.CIRCUIT_OPEN_MIN):
+        self.assertIsNone(source.circuit_open())
+        # only one trial at a time
+        self.assertEqual(models.CIRCUIT_TRIAL_TIMEOUT, source.circuit_open())
+        util.instance_health_cache.clear()
+        self.assertEqual(models.CIRCUIT_TRIAL_TIMEOUT, source.circuit_open())
+
+        source.record_health(err_500)
+        self.assertEqual(models.CIRCUIT_OPEN_MIN * 2, source.circuit_open())
+
+      source.record_health()
+      self.assertIsNone(source.circuit_open())
+      health = models.InstanceHealth.get_by_id('fake')
+      self.assertEqual(0, health.failures)
+      self.assertIsNone(health.open_until)
+
   def test_should_refetch(self):
     source = FakeSource.new()  # haven't found a synd url yet
     self.assertFalse(source.should_refetch())
@@ -728,7 +1048,9 @@ class SourceTest(testutil.AppTest):
 
     source = FakeSource(id='x')
     source.load_blocklist()
-    self.assertEqual([1, 2], source.blocked_ids)
+    self.assertEqual([1, 2], source.poll_cache().blocked_ids)
+    self.assertEqual([1, 2], models.PollCache.get_by_id(
+      models.PollCache.ID, parent=source.key).blocked_ids)
 
   def test_load_blocklist_rate_limited(self):
     source = FakeSource(id='x')
@@ -736,7 +1058,7 @@ class SourceTest(testutil.AppTest):
                      side_effect=gr_source.RateLimited(partial=[4, 5]))
 
     source.load_blocklist()
-    self.assertEqual([4, 5], source.blocked_ids)
+    self.assertEqual([4, 5], source.poll_cache().blocked_ids)
 
   def test_is_blocked(self):
     source = Source(id='x')
@@ -746,6 +1068,39 @@ class SourceTest(testutil.AppTest):
     self.assertTrue(source.is_blocked({'author': {'numeric_id': '1'}}))
     self.assertFalse(source.is_blocked({'object': {'actor': {'numeric_id': '3'}}}))
 
+  def test_poll_cache_migrates_legacy_properties(self):
+    source = FakeSource(id='x', last_activities_cache_json='{}',
+                        blocked_ids=['1'])
+    source.put()
+    source.updates = {}
+
+    cache = source.poll_cache()
+    self.assertEqual('{}', cache.activities_cache_json)
+    self.assertEqual(['1'], cache.blocked_ids)
+    self.assertIsNone(cache.key.get())
+
+    source.put_poll_cache()
+    self.assertEqual(['1'], cache.key.get().blocked_ids)
+    self.assertEqual({
+      'last_activities_cache_json': None,
+      'blocked_ids': None,
+    }, source.updates)
+
+  def test_put_poll_cache_unchanged(self):
+    source = FakeSource(id='x')
+    source.poll_cache().blocked_ids = ['1']
+    source.put_poll_cache()
+    updated = source.poll_cache().key.get().updated
+
+    source = FakeSource(id='x')
+    source.poll_cache()
+    source.put_poll_cache()
+    self.assertEqual(updated, source.poll_cache().key.get().updated)
+
+    source.poll_cache().blocked_ids = ['2']
+    source.put_poll_cache()
+    self.assertEqual(['2'], source.poll_cache().key.get().blocked_ids)
+
   def test_getattr_doesnt_exist(self):
     source = FakeSource(id='x')
     with self.assertRaises(AttributeError):
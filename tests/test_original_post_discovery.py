@@ -1,5 +1,6 @@
 """Unit tests for original_post_discovery.py"""
-from datetime import datetime, timezone
+import copy
+from datetime import datetime, timedelta, timezone
 from string import hexdigits
 from unittest.mock import patch
 
@@ -8,7 +9,8 @@ from webutil.util import json_dumps, json_loads
 from requests.exceptions import HTTPError
 
 from github import GitHub
-from models import SyndicatedPost
+import models
+from models import FeedFetch, SyndicatedPost
 import original_post_discovery
 from original_post_discovery import (
   discover,
@@ -429,6 +431,51 @@ class OriginalPostDiscoveryTest(testutil.AppTest):
     # should append the author note url, with no addt'l requests
     self.assert_discover([original_url])
 
+  def test_load_relationships(self):
+    original_url = 'http://author/notes/2014/04/24/1'
+    SyndicatedPost(parent=self.source.key, original=original_url,
+                   syndication='https://fa.ke/post/url').put()
+
+    other = copy.deepcopy(self.activity)
+    other['object']['url'] = 'https://fa.ke/other'
+    no_url = {'object': {'content': 'foo'}}
+
+    relationships = original_post_discovery.load_relationships(
+      self.source, [self.activity, other, no_url])
+    self.assertEqual(['https://fa.ke/other', 'https://fa.ke/post/url'],
+                     sorted(relationships.keys()))
+    self.assertEqual([], relationships['https://fa.ke/other'])
+    self.assertEqual([original_url],
+                     [r.original for r in relationships['https://fa.ke/post/url']])
+
+    # discover should use the preloaded relationships, not query
+    with patch.object(SyndicatedPost, 'query') as mock_query:
+      self.assert_discover([original_url], relationships=relationships)
+    mock_query.assert_not_called()
+
+  def test_load_relationships_chunks_and_fragments(self):
+    self.source = GitHub(id='snarfed', auth_entity=self.auth_entities[0].put(),
+                         domain_urls=['http://author/'], domains=['author'])
+    self.source.put()
+
+    SyndicatedPost(parent=self.source.key, original='http://author/post',
+                   syndication='https://github.com/post/0#frag').put()
+
+    activities = [{'object': {'url': f'https://github.com/post/{i}'}}
+                  for i in range(original_post_discovery.MAX_ALLOWABLE_QUERIES + 5)]
+    relationships = original_post_discovery.load_relationships(
+      self.source, activities)
+    self.assertEqual(len(activities), len(relationships))
+    self.assertEqual(['http://author/post'],
+                     [r.original for r in relationships['https://github.com/post/0']])
+    self.assertEqual([], relationships['https://github.com/post/1'])
+
+  def test_load_relationships_no_author_urls(self):
+    self.source.domain_urls = []
+    self.source.domains = []
+    self.assertEqual({}, original_post_discovery.load_relationships(
+      self.source, [self.activity]))
+
   def test_invalid_webmention_target(self):
     """Confirm that no additional requests are made if the author url is
     an invalid webmention target. Right now this pretty much just
@@ -546,6 +593,48 @@ class OriginalPostDiscoveryTest(testutil.AppTest):
 
     self.assert_discover([])
 
+  @patch.object(original_post_discovery, 'PERMALINK_FETCH_THREADS', new=3)
+  def test_concurrent_permalink_fetches(self):
+    feed = """
+<html class="h-feed">
+  <div class="h-entry"><a class="u-url" href="http://author/a"></a></div>
+  <div class="h-entry"><a class="u-url" href="http://author/b"></a></div>
+  <div class="h-entry"><a class="u-url" href="http://author/c"></a></div>
+</html>"""
+    pages = {
+      'http://author/': feed,
+      'http://author/a': """
+<div class="h-entry"><a class="u-syndication" href="https://fa.ke/post/url"></a></div>""",
+      'http://author/b': '<div class="h-entry"></div>',
+      'http://author/c': """
+<div class="h-entry"><a class="u-syndication" href="https://fa.ke/c"></a></div>""",
+    }
+    self.mock_get.side_effect = lambda url, **kwargs: requests_response(
+      pages[url], url=url)
+
+    self.assert_discover(['http://author/a'])
+    self.assertCountEqual(pages.keys(),
+                          [call[0][0] for call in self.mock_get.call_args_list])
+    self.assert_syndicated_posts(('http://author/a', 'https://fa.ke/post/url'),
+                                 ('http://author/b', None),
+                                 ('http://author/c', 'https://fa.ke/c'))
+
+  def test_permalink_fetch_deadline(self):
+    self.mock_get.return_value = requests_response("""
+<html class="h-feed">
+  <div class="h-entry"><a class="u-url" href="http://author/a"></a></div>
+  <div class="h-entry"><a class="u-url" href="http://author/b"></a></div>
+</html>""", url='http://author/')
+
+    with patch.object(original_post_discovery, 'PERMALINK_FETCH_DEADLINE',
+                      new=timedelta()):
+      self.assert_discover([])
+
+    # didn't fetch the permalinks, so we don't know they're blank
+    self.assertEqual(['http://author/'],
+                     [call[0][0] for call in self.mock_get.call_args_list])
+    self.assert_syndicated_posts((None, 'https://fa.ke/post/url'))
+
   @patch.object(original_post_discovery, 'MAX_FEED_ENTRIES', new=2)
   def test_feed_entry_limit(self):
     self.mock_get.return_value = requests_response("""
@@ -1350,6 +1439,119 @@ class OriginalPostDiscoveryTest(testutil.AppTest):
     self.assert_equals({}, refetch(self.source))
     self.assert_syndicated_posts(('http://author/permalink', None))
 
+  def test_refetch_unchanged_feed_not_modified(self):
+    self.source.last_feed_syndication_url = NOW
+    self.source.put()
+
+    self.mock_get.return_value = requests_response("""
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="/permalink"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url"></a>
+      </div>
+    </html>""", url='http://author/', headers={
+      'ETag': '"abc"',
+      'Last-Modified': 'Sat, 01 Feb 2020 00:00:00 GMT',
+    })
+    self.assert_equals(['https://fa.ke/post/url'],
+                       list(refetch(self.source).keys()))
+
+    feed_fetch = FeedFetch.get_by_id('http://author/', parent=self.source.key)
+    self.assertEqual('"abc"', feed_fetch.etag)
+    self.assertEqual('Sat, 01 Feb 2020 00:00:00 GMT', feed_fetch.last_modified)
+
+    # the h-feed hasn't changed, so we shouldn't parse or process it
+    self.mock_get.reset_mock(return_value=True)
+    self.mock_get.return_value = requests_response('', status=304)
+    self.assert_equals({}, refetch(self.source))
+
+    self.mock_get.assert_called_once()
+    headers = self.mock_get.call_args.kwargs['headers']
+    self.assertEqual('"abc"', headers['If-None-Match'])
+    self.assertEqual('Sat, 01 Feb 2020 00:00:00 GMT', headers['If-Modified-Since'])
+
+  def test_refetch_unchanged_feed_content(self):
+    self.source.last_feed_syndication_url = NOW
+    self.source.put()
+
+    feed = """
+    <html class="h-feed">
+      <link rel="feed" href="/feed">
+      <div class="h-entry">
+        <a class="u-url" href="/permalink"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url"></a>
+      </div>
+    </html>"""
+    self.mock_get.side_effect = [
+      requests_response(feed, url='http://author/'),
+      requests_response('<html class="h-feed"></html>', url='http://author/feed'),
+    ]
+    refetch(self.source)
+    self.assert_equals(['http://author/feed'], FeedFetch.get_by_id(
+      'http://author/', parent=self.source.key).feed_urls)
+
+    # same content, so we don't parse or process it
+    self.mock_get.side_effect = [
+      requests_response(feed, url='http://author/'),
+      requests_response('<html class="h-feed"></html>', url='http://author/feed'),
+    ]
+    with patch.object(original_post_discovery, '_process_syndication_urls') as psu:
+      self.assert_equals({}, refetch(self.source))
+      psu.assert_not_called()
+
+    # a changed rel-feed means we process everything again, but reuse the
+    # author page we already fetched
+    self.mock_get.side_effect = [
+      requests_response(feed, url='http://author/'),
+      requests_response("""
+      <html class="h-feed">
+        <div class="h-entry">
+          <a class="u-url" href="/other"></a>
+          <a class="u-syndication" href="https://fa.ke/other"></a>
+        </div>
+      </html>""", url='http://author/feed'),
+    ]
+    self.assert_equals(['https://fa.ke/other'], list(refetch(self.source).keys()))
+
+  def test_refetch_feed_removed(self):
+    self.source.last_feed_syndication_url = NOW
+    self.source.put()
+    FeedFetch(parent=self.source.key, id='http://author/',
+              feed_urls=['http://author/feed']).put()
+    FeedFetch(parent=self.source.key, id='http://author/feed').put()
+
+    self.mock_get.return_value = requests_response("""
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="/permalink"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url"></a>
+      </div>
+    </html>""", url='http://author/')
+    self.assert_equals(['https://fa.ke/post/url'],
+                       list(refetch(self.source).keys()))
+
+    self.assertEqual([], FeedFetch.get_by_id(
+      'http://author/', parent=self.source.key).feed_urls)
+    self.assertIsNone(FeedFetch.get_by_id('http://author/feed',
+                                          parent=self.source.key))
+
+  def test_refetch_trigger_ignores_unchanged_feed(self):
+    self.source.last_feed_syndication_url = NOW
+    self.source.put()
+    FeedFetch(parent=self.source.key, id='http://author/', etag='"abc"').put()
+
+    self.source.last_hfeed_refetch = models.REFETCH_HFEED_TRIGGER
+    self.mock_get.return_value = requests_response("""
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="/permalink"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url"></a>
+      </div>
+    </html>""", url='http://author/')
+    self.assert_equals(['https://fa.ke/post/url'],
+                       list(refetch(self.source).keys()))
+    self.assertNotIn('If-None-Match', self.mock_get.call_args.kwargs['headers'])
+
   def test_refetch_dont_follow_other_silo_syndication(self):
     """We should only resolve redirects if the initial domain is our silo."""
     self.mock_head.side_effect = [
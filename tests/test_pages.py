@@ -79,7 +79,7 @@ class PagesTest(testutil.AppTest):
     key = resp.key.urlsafe().decode()
 
     # cached webmention endpoint
-    util.webmention_endpoint_cache['https skipped /'] = 'asdf'
+    util.cache_webmention_endpoint('https://skipped/', 'asdf')
 
     response = self.client.post('/retry', data={'key': key})
     self.assertEqual(302, response.status_code)
@@ -472,6 +472,25 @@ class PagesTest(testutil.AppTest):
     self.assertEqual(200, resp.status_code)
     self.assertIn('Not polled yet,', resp.get_data(as_text=True))
 
+  def test_user_page_responses_cache(self):
+    self.sources[0].put()
+    self.responses[0].put()
+    path = self.sources[0].bridgy_path()
+    resp = self.client.get(path)
+    self.assertIn('h-bridgy-response', resp.get_data(as_text=True))
+    self.assertNotIn('h-bridgy-like', resp.get_data(as_text=True))
+
+    like = self.responses[1]
+    self.assertEqual('like', like.type)
+    like.put()
+    resp = self.client.get(path)
+    self.assertNotIn('h-bridgy-like', resp.get_data(as_text=True))
+
+    # retry clears the source's cached responses
+    self.client.post('/retry', data={'key': self.responses[0].key.urlsafe().decode()})
+    resp = self.client.get(path)
+    self.assertIn('h-bridgy-like', resp.get_data(as_text=True))
+
   def test_user_page_responses_before_after(self):
     for param in 'responses_before', 'responses_after':
       resp = self.client.get(f'{self.sources[0].bridgy_path()}?{param}=2022-05-09T10:13:28')
@@ -550,6 +569,38 @@ class PagesTest(testutil.AppTest):
         f'<a href="{entity.bridgy_path()}" title="{entity.label()}"',
         resp.get_data(as_text=True))
 
+  def test_users_page_start_name(self):
+    testutil.FakeSource.new(name='alice', features=['listen']).put()
+    testutil.FakeSource.new(name='Bob', features=['listen']).put()
+
+    resp = self.client.get('/users?start_name=B')
+    self.assertEqual(200, resp.status_code)
+    html = resp.get_data(as_text=True)
+    self.assertIn('<span class="p-name">Bob</span>', html)
+    self.assertNotIn('<span class="p-name">alice</span>', html)
+
+  def test_users_page_cache(self):
+    resp = self.client.get('/users')
+    self.assertNotIn('<span class="p-name">Bob</span>', resp.get_data(as_text=True))
+
+    testutil.FakeSource.new(name='Bob', features=['listen']).put()
+    resp = self.client.get('/users')
+    self.assertNotIn('<span class="p-name">Bob</span>', resp.get_data(as_text=True))
+
+    util.users_page_cache.clear()
+    resp = self.client.get('/users')
+    self.assertIn('<span class="p-name">Bob</span>', resp.get_data(as_text=True))
+
+  def test_users_page_picture_scheme(self):
+    testutil.FakeSource.new(name='Bob', picture='http://pic/bob',
+                            features=['listen']).put()
+
+    resp = self.client.get('/users', base_url='https://localhost/')
+    self.assertIn('src="https://pic/bob"', resp.get_data(as_text=True))
+
+    resp = self.client.get('/users')
+    self.assertIn('src="http://pic/bob"', resp.get_data(as_text=True))
+
   def test_logout(self):
     util.now = lambda: datetime(2000, 1, 1, tzinfo=timezone.utc)
     resp = self.client.get('/logout')
@@ -0,0 +1,103 @@
+"""Unit tests for poll_scheduler.py."""
+from datetime import datetime, timedelta, timezone
+
+from webutil.testutil import NOW
+
+import poll_scheduler
+from poll_scheduler import (
+  budget_scale,
+  poll_interval,
+  rate,
+  record_poll,
+  simulate,
+  update_rate,
+)
+from . import testutil
+from .testutil import FakeSource
+
+HOUR = timedelta(hours=1)
+
+
+class PollSchedulerTest(testutil.AppTest):
+
+  def test_update_rate(self):
+    self.assertEqual((3, 2, 1), update_rate(0, 0, 0, 3, 2 * HOUR))
+
+    half_life = poll_scheduler.RATE_HALF_LIFE
+    hours = half_life.total_seconds() / 3600
+    self.assertEqual((5 + 1, 10 + hours, 5),
+                     update_rate(10, 20, 4, 1, half_life))
+
+  def test_rate(self):
+    self.assertEqual(poll_scheduler.PRIOR_RESPONSES / poll_scheduler.PRIOR_HOURS,
+                     rate(0, 0))
+    self.assertLess(rate(0, 1000), rate(0, 0))
+    self.assertAlmostEqual(1, rate(1000000, 1000000), places=3)
+
+  def test_poll_interval(self):
+    fast = timedelta(minutes=30)
+    args = (fast, timedelta(minutes=5), timedelta(days=1))
+    self.assertEqual(fast, poll_interval(poll_scheduler.REFERENCE_RATE, *args))
+    self.assertEqual(fast / 2, poll_interval(poll_scheduler.REFERENCE_RATE * 4, *args))
+    self.assertEqual(fast * 2, poll_interval(poll_scheduler.REFERENCE_RATE / 4, *args))
+    self.assertEqual(fast, poll_interval(poll_scheduler.REFERENCE_RATE / 4, *args,
+                                         scale=.5))
+
+    # clamped
+    self.assertEqual(timedelta(minutes=5), poll_interval(1000, *args))
+    self.assertEqual(timedelta(days=1), poll_interval(.00001, *args))
+
+  def test_budget_scale(self):
+    fast = timedelta(minutes=30)
+    day = timedelta(days=1)
+    ref = poll_scheduler.REFERENCE_RATE
+    # two sources at REFERENCE_RATE poll 4x/h at scale 1
+    schedules = [(ref, fast, timedelta(minutes=1), day)] * 2
+    self.assertAlmostEqual(1, budget_scale(schedules, budget=4), places=3)
+    self.assertAlmostEqual(2, budget_scale(schedules, budget=2), places=3)
+
+    # fixed-interval sources use up part of the budget
+    schedules.append((None, fast, None, None))
+    self.assertAlmostEqual(2, budget_scale(schedules, budget=4), places=3)
+
+    # bounded
+    self.assertEqual(poll_scheduler.MIN_BUDGET_SCALE,
+                     budget_scale(schedules, budget=1000))
+    self.assertEqual(poll_scheduler.MAX_BUDGET_SCALE,
+                     budget_scale(schedules, budget=2.1))
+
+  def test_record_poll(self):
+    source = FakeSource.new()
+    self.assertEqual({}, record_poll(source, 3, NOW))
+
+    source.last_polled = NOW - 2 * HOUR
+    self.assertEqual({
+      'poll_rate_responses': 3,
+      'poll_rate_hours': 2,
+      'poll_rate_samples': 1,
+    }, record_poll(source, 3, NOW))
+
+  def test_simulate(self):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    end = start + timedelta(days=30)
+    arrivals = [start + timedelta(days=i, minutes=10) for i in range(30)]
+    fast = timedelta(minutes=30)
+
+    fixed = simulate(arrivals, start, end, fast, fast, timedelta(days=1),
+                     interval_fn=lambda *_: fast)
+    self.assertEqual(30 * 48, fixed['polls'])
+    self.assertEqual(30, fixed['responses'])
+    self.assertEqual(timedelta(minutes=20), fixed['mean latency'])
+    self.assertEqual(timedelta(minutes=20), fixed['max latency'])
+
+    # one response a day is under REFERENCE_RATE, so we poll less often
+    adaptive = simulate(arrivals, start, end, fast, fast, timedelta(days=1))
+    self.assertLess(adaptive['polls'], fixed['polls'])
+    self.assertEqual(30, adaptive['responses'])
+    self.assertGreater(adaptive['mean latency'], fixed['mean latency'])
+
+    # no responses at all
+    quiet = simulate([], start, end, fast, fast, timedelta(days=1))
+    self.assertLess(quiet['polls'], adaptive['polls'])
+    self.assertEqual(0, quiet['responses'])
+    self.assertEqual(timedelta(), quiet['mean latency'])
@@ -5,12 +5,11 @@ import http.client
 import socket
 import string
 import io
-import time
 from unittest import skip
 from unittest.mock import patch
 import urllib.request, urllib.parse, urllib.error
 
-from cachetools import TTLCache
+from flask import g
 from google.cloud import ndb
 from google.cloud.ndb._datastore_types import _MAX_STRING_LENGTH
 from google.cloud.tasks_v2.types import Task
@@ -21,6 +20,7 @@ import requests
 
 import models
 from models import Response, SyndicatedPost
+import original_post_discovery
 import tasks
 from . import testutil
 from .testutil import FakeSource, FakeGrSource
@@ -64,7 +64,7 @@ class TaskTest(testutil.BackgroundTest):
         resp.response_json = json_dumps(json_loads(resp.response_json), sort_keys=True)
 
     self.assert_entities_equal(expected, stored,
-                               ignore=('created', 'updated') + ignore)
+                               ignore=('created', 'updated', 'fetched', 'summary_digest') + ignore)
 
 class PollTest(TaskTest):
 
@@ -136,6 +136,62 @@ class PollTest(TaskTest):
       poll_task,
     )
 
+  def test_poll_records_response_rate(self):
+    source = self.sources[0]
+    source.last_polled = NOW - datetime.timedelta(hours=2)
+    source.put()
+
+    TaskTest.post_task(self, params={
+      'source_key': source.key.urlsafe().decode(),
+      'last_polled': source.last_polled.strftime(POLL_TASK_DATETIME_FORMAT),
+    })
+
+    source = source.key.get()
+    self.assertEqual(1, source.poll_rate_samples)
+    self.assertAlmostEqual(2, source.poll_rate_hours)
+    self.assertEqual(len([r for r in Response.query() if r.unsent]),
+                     source.poll_rate_responses)
+
+  @patch.object(FakeSource, 'THROTTLE_RATE', new=.1)
+  @patch.object(FakeSource, 'THROTTLE_BURST', new=1)
+  def test_poll_throttled(self):
+    models.TokenBucket(id='fake', tokens=0, updated=NOW).put()
+
+    self.post_task()
+    self.assertEqual(0, Response.query().count())
+    source = self.sources[0].key.get()
+    self.assertEqual('ok', source.poll_status)
+    self.assertEqual(self.sources[0].last_poll_attempt, source.last_poll_attempt)
+    self.assert_task('poll', eta_seconds=10, source_key=self.sources[0],
+                     last_polled='1970-01-01-00-00-00')
+
+  @patch.object(FakeSource, 'CIRCUIT_BREAKER', new=True)
+  def test_poll_circuit_open(self):
+    models.InstanceHealth(id='fake', failures=5,
+                          open_until=NOW + datetime.timedelta(hours=1)).put()
+
+    self.post_task()
+    self.assertEqual(0, Response.query().count())
+    self.assertEqual(self.sources[0].last_poll_attempt,
+                     self.sources[0].key.get().last_poll_attempt)
+    self.assert_task('poll', eta_seconds=3600, source_key=self.sources[0],
+                     last_polled='1970-01-01-00-00-00')
+
+  @patch.object(FakeSource, 'CIRCUIT_BREAKER', new=True)
+  @patch.object(FakeGrSource, 'get_activities_response',
+                side_effect=urllib.error.HTTPError('url', 503, 'msg', {}, None))
+  def test_poll_records_instance_failure(self, _):
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assertEqual(1, models.InstanceHealth.get_by_id('fake').failures)
+
+  @patch.object(FakeSource, 'CIRCUIT_BREAKER', new=True)
+  def test_poll_other_failure_doesnt_count_against_instance(self):
+    models.InstanceHealth(id='fake', failures=2).put()
+    with patch.object(Response, 'get_or_save_multi',
+                      side_effect=requests.ConnectionError('not the silo')):
+      self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assertEqual(0, models.InstanceHealth.get_by_id('fake').failures)
+
   @patch.object(FakeSource, 'AUTO_POLL', new=False)
   def test_poll_no_auto_poll(self):
     FakeGrSource.clear()
@@ -171,6 +227,44 @@ class PollTest(TaskTest):
     self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
     self.assertEqual('error', self.sources[0].key.get().poll_status)
 
+  def test_poll_task_flush_fails_then_retry(self):
+    """If adding propagate tasks fails, the retried poll should re-add them."""
+    self.mock_create_task.side_effect = RuntimeError('tasks are down')
+    self.assertRaises(RuntimeError, self.post_task)
+    self.assertEqual('error', self.sources[0].key.get().poll_status)
+    self.assertEqual(12, Response.query(Response.status == 'new').count())
+
+    self.mock_create_task.side_effect = None
+    self.mock_create_task.reset_mock()
+    poll_task = self.post_task(reset=True, expect_poll=FakeSource.FAST_POLL)
+    self.assertEqual('ok', self.sources[0].key.get().poll_status)
+    self.assert_tasks(
+      *[{'queue': 'propagate', 'response_key': resp} for resp in self.responses],
+      poll_task,
+    )
+
+  @patch.object(tasks, 'ORIGINAL_POST_DISCOVERY_THREADS', new=4)
+  def test_original_post_discovery_threads_share_context(self):
+    """Discovery threads see the poll's Flask context and task batch."""
+    seen = []
+    orig_discover = original_post_discovery.discover
+
+    def discover(source, activity, **kwargs):
+      seen.append((g.source.key, util.task_batch_buffer.get() is not None,
+                   ndb.get_context() is not None))
+      return orig_discover(source, activity, **kwargs)
+
+    with patch.object(original_post_discovery, 'discover', side_effect=discover):
+      poll_task = self.post_task(expect_poll=FakeSource.FAST_POLL)
+
+    self.assertGreater(len(seen), 1)
+    self.assertEqual({(self.sources[0].key, True, True)}, set(seen))
+    self.assertEqual(12, Response.query().count())
+    self.assert_tasks(
+      *[{'queue': 'propagate', 'response_key': resp} for resp in self.responses],
+      poll_task,
+    )
+
   def test_original_post_discovery(self):
     """Target URLs should be extracted from attachments, tags, and text."""
     obj = self.activities[0]['object']
@@ -1057,15 +1151,17 @@ class PollTest(TaskTest):
     self.assertEqual('c', self.sources[0].key.get().last_activity_id)
 
   def test_cache_trims_to_returned_activity_ids(self):
-    """We should trim last_activities_cache_json to just the returned activity ids."""
+    """We should trim the activities cache to just the returned activity ids."""
     source = self.sources[0]
     source.last_activities_cache_json = json_dumps(
       {1: 2, 'x': 'y', 'prefix x': 1, 'prefix b': 0})
     source.put()
 
     self.post_task()
-    self.assert_equals({'prefix b': 0},
-                       json_loads(source.key.get().last_activities_cache_json))
+    source = source.key.get()
+    self.assert_equals([['prefix b', 0, int(util.to_utc_timestamp(NOW))]],
+                       json_loads(source.poll_cache().activities_cache_json))
+    self.assertIsNone(source.last_activities_cache_json)
 
   def test_slow_poll_never_sent_webmention(self):
     self.sources[0].created = NOW - (FakeSource.FAST_POLL_GRACE_PERIOD +
@@ -1153,6 +1249,26 @@ class PollTest(TaskTest):
     self.post_task()
     self.assert_requests_get('http://author')
 
+  def test_concurrent_discovery_fetches_hfeed_once(self):
+    """Activities discovered concurrently should share one h-feed fetch."""
+    self.sources[0].domain_urls = ['http://author']
+    self.sources[0].put()
+
+    FakeGrSource.activities = self.activities
+    for letter, activity in zip(string.ascii_letters, FakeGrSource.activities):
+      activity['url'] = activity['object']['url'] = 'http://fa.ke/post/' + letter
+      activity['object']['content'] = 'foo bar'
+
+    self._expect_fetch_hfeed()
+    self.post_task()
+
+    fetched = [call.args[0] for call in self.mock_get.call_args_list]
+    self.assertEqual(1, fetched.count('http://author'))
+    for activity in self.activities:
+      url = self.sources[0].canonicalize_url(activity['url'])
+      self.assertEqual(1, SyndicatedPost.query(
+        SyndicatedPost.syndication == url, ancestor=self.sources[0].key).count())
+
   def test_syndicated_post_does_not_prevent_fetch_hfeed(self):
     """The original fix to fetch the source's h-feed only once per task
     had a bug that prevented us from fetching the h-feed *at all* if
@@ -1338,12 +1454,12 @@ class PollTest(TaskTest):
     self._change_response_and_poll()
 
     # return new response *and* existing response. both should be stored in
-    # Source.seen_responses_cache_json
+    # PollCache.seen_responses_fingerprints
     replies = activity['object']['replies']['items']
     replies.append(self.activities[1]['object']['replies']['items'][0])
 
     poll_task = self.post_task(reset=True, expect_poll=FakeSource.FAST_POLL)
-    self.assert_equals(replies, json_loads(source.key.get().seen_responses_cache_json))
+    self.assert_seen_responses(replies)
     self.assert_tasks(
       {'queue': 'propagate', 'response_key': self.responses[4]}, poll_task)
     self.responses[4].key.delete()
@@ -1356,7 +1472,7 @@ class PollTest(TaskTest):
     poll_task = self.post_task(reset=True, expect_poll=FakeSource.FAST_POLL)
     self.assert_equals([r.key for r in self.responses[:4]],
                        list(Response.query().iter(keys_only=True)))
-    self.assert_equals(tags, json_loads(source.key.get().seen_responses_cache_json))
+    self.assert_seen_responses(tags)
     self.assert_tasks(
       *[{'queue': 'propagate', 'response_key': resp} for resp in self.responses[1:4]],
       poll_task,
@@ -1384,8 +1500,40 @@ class PollTest(TaskTest):
     self.assertEqual([], resp.sent)
     self.assert_tasks({'queue': 'propagate', 'response_key': resp}, poll_task)
 
+    self.assert_seen_responses([reply])
+
+  def assert_seen_responses(self, expected):
     source = self.sources[0].key.get()
-    self.assert_equals([reply], json_loads(source.seen_responses_cache_json))
+    self.assertIsNone(source.seen_responses_cache_json)
+    self.assertIsNone(source.seen_responses_fingerprints)
+    self.assertEqual(
+      {util.seen_response_key(resp['id']): util.response_fingerprint(resp)
+       for resp in expected},
+      util.decode_seen_responses(
+        source.poll_cache().seen_responses_fingerprints))
+
+  def test_seen_responses_migrate_from_json(self):
+    """Seen responses in the old JSON format should be honored and converted."""
+    reply = self.activities[0]['object']['replies']['items'][0]
+    self.sources[0].seen_responses_cache_json = json_dumps([reply])
+    self.sources[0].put()
+
+    self.post_task()
+    self.assertIsNone(Response.get_by_id(reply['id']))
+    self.assert_seen_responses(
+      [r for a in self.activities
+       for r in a['object']['replies']['items'] + a['object']['tags']])
+
+  def test_seen_responses_migrate_from_json_no_responses(self):
+    """Legacy seen responses should be converted even if the poll finds none."""
+    reply = self.activities[0]['object']['replies']['items'][0]
+    self.sources[0].seen_responses_cache_json = json_dumps([reply])
+    self.sources[0].put()
+    FakeGrSource.activities = []
+
+    self.post_task()
+    self.assertEqual(0, Response.query().count())
+    self.assert_seen_responses([reply])
 
   @patch.object(FakeSource, 'is_blocked', side_effect=[False, True] + [False] * 10)
   def test_in_blocklist(self, _):
@@ -1445,6 +1593,17 @@ class DiscoverTest(TaskTest):
     self.assert_tasks(*[
       {'queue': 'propagate', 'response_key': resp} for resp in self.responses[4:8]])
 
+  @patch.object(FakeSource, 'THROTTLE_RATE', new=.1)
+  @patch.object(FakeSource, 'THROTTLE_BURST', new=1)
+  def test_throttled(self):
+    FakeGrSource.activities = [self.activities[1]]
+    models.TokenBucket(id='fake', tokens=0, updated=NOW).put()
+
+    self.discover()
+    self.assert_responses([])
+    self.assert_task('discover', eta_seconds=10, source_key=self.sources[0],
+                     post_id='b')
+
   def test_no_post(self):
     """Silo post not found."""
     FakeGrSource.activities = []
@@ -1692,6 +1851,33 @@ class PropagateTest(TaskTest):
     self.responses[0].put()
     self.post_task()
 
+  def test_cached_webmention_discovery_datastore(self):
+    """Webmention endpoints should be cached in the datastore too."""
+    self.expect_webmention()
+    self.post_task()
+    self.assertEqual(1, self.mock_get.call_count)
+
+    cached = models.WebmentionEndpoint.get_by_id('http target1')
+    self.assertEqual('http://webmention/endpoint', cached.endpoint)
+    self.assertEqual(NOW + util.WEBMENTION_ENDPOINT_TTL, cached.expires)
+
+    # simulate a restart. the second webmention should use the datastore
+    util.webmention_endpoint_cache.clear()
+    self.responses[0].status = 'new'
+    self.responses[0].put()
+    self.post_task()
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+    self.assertEqual(1, self.mock_get.call_count)
+    self.assertEqual(1, util.webmention_endpoint_cache_stats['datastore hit'])
+
+  def test_cached_webmention_discovery_ttl_from_cache_control(self):
+    """The target's Cache-Control header should determine the cache TTL."""
+    self.expect_webmention(response_headers={'Cache-Control': 'max-age=86400'})
+    self.post_task()
+
+    cached = models.WebmentionEndpoint.get_by_id('http target1')
+    self.assertEqual(NOW + datetime.timedelta(days=1), cached.expires)
+
   def test_cached_webmention_discovery_error(self):
     """Failed webmention discovery should be cached too."""
     self.expect_webmention(endpoint=None)
@@ -1745,20 +1931,16 @@ class PropagateTest(TaskTest):
     ]
     self.mock_post.return_value = requests_response('')
 
-    # inject a fake time.time into the cache
-    now = time.time()
-    util.webmention_endpoint_cache = TTLCache(500, 2, timer=lambda: now)
-
     self.post_task()
     self.assert_response_is('complete', skipped=['http://target1/post/url'])
 
-    now += 1
     self.responses[0].status = 'new'
     self.responses[0].put()
     self.post_task()
     self.assert_response_is('complete', skipped=['http://target1/post/url'])
 
-    now += 2
+    # entries expire at their own expires time, in both tiers
+    util.now = lambda: NOW + util.WEBMENTION_ENDPOINT_TTL + datetime.timedelta(seconds=1)
     self.responses[0].status = 'new'
     self.responses[0].put()
     self.post_task()
@@ -1985,6 +2167,80 @@ class PropagateTest(TaskTest):
     self.post_task()
     self.assert_response_is('complete')
 
+  def test_domain_health_recorded(self):
+    self.expect_webmention(send_status=500)
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    health = models.InstanceHealth.get_by_id('webmention target1')
+    self.assertEqual(1, health.failures)
+
+    self.expect_webmention()
+    self.post_task()
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+    self.assertEqual(0, health.key.get().failures)
+
+  def test_domain_circuit_open(self):
+    models.InstanceHealth(id='webmention target1', failures=5,
+                          open_until=NOW + datetime.timedelta(hours=1)).put()
+    self.expect_webmention()
+
+    # deferred targets are retried when the domain's circuit closes, not with
+    # the queue's backoff
+    self.post_task()
+    self.assert_response_is('error', None, error=['http://target1/post/url'])
+    self.mock_post.assert_not_called()
+    self.assert_task('propagate', response_key=self.responses[0],
+                     eta_seconds=3600)
+    self.assertEqual(
+      {'http://target1/post/url': int(util.to_utc_timestamp(NOW))},
+      self.responses[0].key.get().deferred_since)
+
+  def test_domain_circuit_open_too_long(self):
+    since = NOW - tasks.WEBMENTION_DEFER_MAX_AGE * 2
+    self.responses[0].deferred_since = {
+      'http://target1/post/url': int(util.to_utc_timestamp(since)),
+    }
+    self.responses[0].put()
+    models.InstanceHealth(id='webmention target1', failures=5,
+                          open_until=NOW + datetime.timedelta(hours=1)).put()
+
+    self.post_task()
+    self.assert_response_is('complete', failed=['http://target1/post/url'])
+    self.mock_post.assert_not_called()
+    self.assertIsNone(self.responses[0].key.get().deferred_since)
+
+  def test_domain_circuit_open_old_response(self):
+    """Old responses get the full deferral period from when they're deferred."""
+    self.responses[0].created = NOW - tasks.WEBMENTION_DEFER_MAX_AGE * 2
+    self.responses[0].put()
+    models.InstanceHealth(id='webmention target1', failures=5,
+                          open_until=NOW + datetime.timedelta(hours=1)).put()
+
+    self.post_task()
+    self.assert_response_is('error', None, error=['http://target1/post/url'])
+
+  def test_domain_rate_limited_after_failure(self):
+    models.InstanceHealth(id='webmention target1', failures=1).put()
+    models.TokenBucket(id='webmention target1', tokens=0, updated=NOW).put()
+    self.expect_webmention()
+
+    self.post_task()
+    self.assert_response_is('error', None, error=['http://target1/post/url'])
+    self.mock_post.assert_not_called()
+
+  def test_domain_stops_after_failure(self):
+    """After a 5xx, we don't send to the rest of the domain's targets."""
+    self.responses[0].unsent = ['http://a/1', 'http://a/2', 'http://b/1']
+    self.responses[0].put()
+    self.expect_webmention(target='http://a/1', send_status=503)
+    self.expect_webmention(target='http://a/2')
+    self.expect_webmention(target='http://b/1')
+
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', None, error=['http://a/1', 'http://a/2'],
+                            sent=['http://b/1'])
+    targets = [call.kwargs['data']['target'] for call in self.mock_post.call_args_list]
+    self.assertEqual(['http://a/1', 'http://b/1'], sorted(targets))
+
   def test_webmention_fail_and_succeed(self):
     """All webmentions should be attempted, but any failure sets error status."""
     self.responses[0].unsent = ['http://first', 'http://second']
@@ -1997,6 +2253,23 @@ class PropagateTest(TaskTest):
                            sent=['http://second'])
     self.assert_equals(NOW, self.sources[0].key.get().last_webmention_sent)
 
+  def test_targets_on_same_domain_share_discovery(self):
+    """Targets on the same domain are sent serially and share discovery."""
+    self.responses[0].unsent = ['http://a/1', 'http://b/1', 'http://a/2']
+    self.responses[0].put()
+    for target in self.responses[0].unsent:
+      self.expect_webmention(target=target)
+
+    self.post_task()
+    self.assert_response_is('complete',
+                            sent=['http://a/1', 'http://a/2', 'http://b/1'])
+    self.assert_equals(NOW, self.sources[0].key.get().last_webmention_sent)
+
+    discovered = [call.args[0] for call in self.mock_get.call_args_list]
+    self.assertEqual(['http://a/1', 'http://b/1'], sorted(discovered))
+    targets = [call.kwargs['data']['target'] for call in self.mock_post.call_args_list]
+    self.assertEqual(['http://a/1', 'http://a/2', 'http://b/1'], sorted(targets))
+
   def test_webmention_exception(self):
     """Exceptions on individual target URLs shouldn't stop the whole task."""
     self.responses[0].unsent = ['http://error', 'http://good']
@@ -2084,6 +2357,100 @@ class PropagateTest(TaskTest):
 
     self.post_task(base_url='https://brid.gy')
 
+  def post_batch_task(self, responses, expected_status=200):
+    resp = self.client.post('/_ah/queue/propagate-batch', data={
+      'source_key': self.sources[0].key.urlsafe().decode(),
+      'response_keys': ','.join(r.key.urlsafe().decode() for r in responses),
+    })
+    self.assertEqual(expected_status, resp.status_code)
+
+  def test_propagate_batch(self):
+    self.expect_webmention()
+
+    with patch.object(models.Source, 'put_updates',
+                      wraps=models.Source.put_updates) as mock_put_updates:
+      self.post_batch_task(self.responses[:2])
+
+    for resp in self.responses[:2]:
+      self.assert_response_is('complete', sent=['http://target1/post/url'],
+                              response=resp)
+
+    # one discovery, two sends, one source update
+    self.assertEqual(1, self.mock_get.call_count)
+    self.assertEqual(2, self.mock_post.call_count)
+    mock_put_updates.assert_called_once()
+    self.assert_equals(NOW, self.sources[0].key.get().last_webmention_sent)
+
+  def test_propagate_batch_error(self):
+    self.responses[1].unsent = ['http://target2/']
+    self.responses[1].put()
+    self.expect_webmention()
+    self.expect_webmention(target='http://target2/', send_status=500)
+
+    self.post_batch_task(self.responses[:3], expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+    self.assert_response_is('error', error=['http://target2/'],
+                            response=self.responses[1])
+    self.assert_response_is('complete', sent=['http://target1/post/url'],
+                            response=self.responses[2])
+
+    # on retry, only the failed response is propagated
+    self.mock_post.reset_mock()
+    self.expect_webmention(target='http://target2/')
+    self.post_batch_task(self.responses[:3])
+    self.assert_response_is('complete', sent=['http://target2/'],
+                            response=self.responses[1])
+    self.assertEqual(1, self.mock_post.call_count)
+
+  def test_propagate_batch_error_then_deferred(self):
+    """One response's failure doesn't stop later ones from scheduling retries."""
+    self.responses[0].unsent = ['http://bad/']
+    self.responses[0].put()
+    self.expect_webmention(target='http://bad/', send_status=500)
+    models.InstanceHealth(id='webmention target1', failures=5,
+                          open_until=NOW + datetime.timedelta(hours=1)).put()
+
+    self.post_batch_task(self.responses[:2], expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', None, error=['http://bad/'])
+    self.assert_response_is('error', None, error=['http://target1/post/url'],
+                            response=self.responses[1])
+    self.assert_task('propagate', response_key=self.responses[1],
+                     eta_seconds=3600)
+
+  def test_leased_by_another_task_while_sending(self):
+    """If another task leases the response after us, we don't overwrite it."""
+    self.expect_webmention()
+
+    orig_send = tasks.SendWebmentions.send_webmentions
+    def send_and_steal(task):
+      # eg our lease expired and a retry took over
+      other = self.responses[0].key.get()
+      other.version += 1
+      other.put()
+      orig_send(task)
+
+    with patch.object(tasks.SendWebmentions, 'send_webmentions', autospec=True,
+                      side_effect=send_and_steal):
+      self.post_task()
+
+    self.assert_response_is('processing', NOW + LEASE_LENGTH,
+                            unsent=['http://target1/post/url'])
+    self.assertEqual(2, self.responses[0].key.get().version)
+
+  def test_last_webmention_sent_recent(self):
+    """We don't rewrite the source for every propagate task in a burst."""
+    recent = NOW - datetime.timedelta(minutes=5)
+    self.sources[0].last_webmention_sent = recent
+    self.sources[0].put()
+
+    self.expect_webmention()
+    with patch.object(models.Source, 'put') as mock_put:
+      self.post_task()
+
+    mock_put.assert_not_called()
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+    self.assertEqual(recent, self.sources[0].key.get().last_webmention_sent)
+
   @patch.object(tasks.PropagateResponse, 'complete', side_effect=Exception('foo'))
   def test_complete_exception(self, _):
     """If completing raises an exception, the lease should be released."""
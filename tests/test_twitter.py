@@ -171,5 +171,5 @@ class TwitterTest(testutil.AppTest):
 
 
     self.tw.load_blocklist()
-    self.assert_equals(['1', '2'], self.tw.blocked_ids)
+    self.assert_equals(['1', '2'], self.tw.poll_cache().blocked_ids)
 
@@ -1,11 +1,15 @@
 """Unit tests for util.py."""
-from datetime import datetime, timezone
+import copy
+from datetime import datetime, timedelta, timezone
 import time
+from unittest.mock import patch
 import urllib.request, urllib.parse, urllib.error
 
 from flask import Flask, get_flashed_messages, request
 from flask.views import View
 from google.cloud import ndb
+from google.cloud.tasks_v2.types import Task
+from granary import as1
 from oauth_dropins import views as oauth_views
 from webutil import appengine_info
 from webutil.testutil import requests_response
@@ -192,6 +196,91 @@ class UtilTest(testutil.AppTest):
       ):
       self.assert_equals(expected, util.prune_activity(orig, self.sources[0]))
 
+  def test_activities_cache(self):
+    now = int(util.to_utc_timestamp(util.now()))
+    cache = util.ActivitiesCache(json_dumps([['A a', 1, now], ['B b', 2, now]]))
+    self.assertFalse(cache.dirty)
+    self.assertEqual(1, cache.get('A a'))
+    self.assertEqual({'B b': 2}, cache.get_multi(['B b', 'C c']))
+    cache['A a'] = 1
+    self.assertFalse(cache.dirty)
+
+    cache.trim({'a', 'b'})
+    self.assertFalse(cache.dirty)
+
+    cache['A a'] = 3
+    self.assertTrue(cache.dirty)
+    self.assertEqual([['B b', 2, now], ['A a', 3, now]],
+                     json_loads(cache.to_json()))
+
+    cache.set_multi({'C c': 4}, time=60)
+    self.assertEqual(4, cache['C c'])
+
+  def test_activities_cache_trim(self):
+    old = int(util.to_utc_timestamp(
+      util.now() - util.ACTIVITIES_CACHE_MAX_AGE)) - 1
+    cache = util.ActivitiesCache(json_dumps([['A a', 1, old], ['B b', 2, old + 2]]))
+    cache['C c'] = 3
+    cache['D d'] = 4
+    cache.get('C c')
+
+    cache.trim({'a', 'b', 'c'})
+    self.assertEqual({'B b': 2, 'C c': 3}, cache)
+
+    # least recently used goes first
+    cache.get('B b')
+    size = len(cache.to_json())
+    with patch.object(util, 'ACTIVITIES_CACHE_MAX_BYTES', size - 5):
+      cache.trim({'a', 'b', 'c'})
+    self.assertEqual({'B b': 2}, cache)
+
+  def test_activities_cache_legacy_format(self):
+    cache = util.ActivitiesCache(json_dumps({'A a': 1}))
+    self.assertTrue(cache.dirty)
+    self.assertEqual([['A a', 1, int(util.to_utc_timestamp(util.now()))]],
+                     json_loads(cache.to_json()))
+
+  def test_response_fingerprint(self):
+    resp = {
+      'id': 'tag:fa.ke,2013:123',
+      'objectType': 'comment',
+      'content': 'foo',
+      'author': {'id': 'alice'},
+      'inReplyTo': {'id': 'x', 'author': {'id': 'bob'}},
+      'object': {'content': 'bar'},
+      'replies': {'items': [{'content': 'baz'}]},
+    }
+    fingerprint = util.response_fingerprint(resp)
+    self.assertEqual(util.SEEN_RESPONSE_HASH_BYTES, len(fingerprint))
+
+    for same in (
+        util.prune_response(copy.deepcopy(resp)),
+        {**resp, 'author': {'id': 'eve'}, 'published': '2022'},
+        {**resp, 'inReplyTo': {'id': 'x'}},
+        {**resp, 'summary': '', 'image': None},
+    ):
+      self.assertFalse(as1.activity_changed(resp, same))
+      self.assertEqual(fingerprint, util.response_fingerprint(same), same)
+
+    for changed in (
+        {**resp, 'content': 'fooo'},
+        {**resp, 'objectType': 'note'},
+        {**resp, 'inReplyTo': {'id': 'y'}},
+        {**resp, 'object': {'content': 'baz'}},
+    ):
+      self.assertTrue(as1.activity_changed(resp, changed))
+      self.assertNotEqual(fingerprint, util.response_fingerprint(changed), changed)
+
+  def test_encode_decode_seen_responses(self):
+    self.assertEqual({}, util.decode_seen_responses(None))
+    self.assertEqual({}, util.decode_seen_responses(b''))
+
+    seen = {util.seen_response_key(id): util.response_fingerprint({'content': id})
+            for id in ('a', 'b', 'c')}
+    encoded = util.encode_seen_responses(seen)
+    self.assertEqual(3 * 2 * util.SEEN_RESPONSE_HASH_BYTES, len(encoded))
+    self.assertEqual(seen, util.decode_seen_responses(encoded))
+
   def test_get_webmention_target_blocklisted_urls(self):
     for resolve in True, False:
       self.assertTrue(util.get_webmention_target(
@@ -324,11 +413,240 @@ class UtilTest(testutil.AppTest):
       got = util.webmention_endpoint_cache_key(url)
       self.assertEqual(expected, got, (url, got))
 
+  def test_webmention_endpoint_ttl(self):
+    for expected, headers in (
+        (util.WEBMENTION_ENDPOINT_TTL, {}),
+        (timedelta(hours=5), {'Cache-Control': 'public, max-age=18000'}),
+        (util.WEBMENTION_ENDPOINT_TTL_MIN, {'Cache-Control': 'max-age=0'}),
+        (util.WEBMENTION_ENDPOINT_TTL_MIN, {'Cache-Control': 'no-cache'}),
+        (util.WEBMENTION_ENDPOINT_TTL_MAX, {'Cache-Control': 'max-age=99999999'}),
+        (timedelta(days=1), {'Expires': 'Mon, 03 Jan 2022 03:04:05 GMT'}),
+        (util.WEBMENTION_ENDPOINT_TTL, {'Expires': 'garbage'}),
+    ):
+      resp = requests_response('', headers=headers)
+      self.assertEqual(expected, util.webmention_endpoint_ttl(resp), headers)
+
+    self.assertEqual(util.WEBMENTION_ENDPOINT_TTL, util.webmention_endpoint_ttl(None))
+
+  def test_webmention_endpoint_cache_per_entry_expiry(self):
+    resp = requests_response('', headers={'Cache-Control': 'max-age=432000'})
+    util.cache_webmention_endpoint('http://long/x', 'http://long/wm', resp=resp)
+    util.cache_webmention_endpoint('http://short/x', 'http://short/wm')
+
+    # past the default TTL but not the long entry's max-age
+    util.now = lambda: testutil.NOW + timedelta(days=3)
+    self.assertEqual('http://long/wm',
+                     util.get_cached_webmention_endpoint('http://long/x'))
+    self.assertIsNone(util.get_cached_webmention_endpoint('http://short/x'))
+    self.assertNotIn('http short', util.webmention_endpoint_cache)
+
+    util.now = lambda: testutil.NOW + timedelta(days=6)
+    self.assertIsNone(util.get_cached_webmention_endpoint('http://long/x'))
+    self.assertNotIn('http long', util.webmention_endpoint_cache)
+
+  def test_fetch_table(self):
+    table = util.FetchTable()
+    calls = []
+
+    def fetch(x):
+      calls.append(x)
+      return x * 2
+
+    self.assertNotIn('a', table)
+    self.assertEqual(6, table.get('a', fetch, 3))
+    self.assertIn('a', table)
+    self.assertEqual(6, table.get('a', fetch, 4))
+    self.assertEqual(10, table.get('b', fetch, 5))
+    self.assertEqual([3, 5], calls)
+    self.assertEqual(1, table.hits)
+
+  def test_fetch_table_exception(self):
+    table = util.FetchTable()
+
+    def fetch():
+      raise ValueError('foo')
+
+    for _ in range(2):
+      with self.assertRaises(ValueError):
+        table.get('a', fetch)
+
+  def test_concurrent_map(self):
+    def fn(x):
+      # each thread should have its own ndb context and share the fetch table
+      self.assertIsNotNone(ndb.get_context())
+      return x * 2, util.fetch_table.get()
+
+    with util.fetch_scope() as table:
+      self.assertEqual([(2, table), (4, table), (6, table)],
+                       util.concurrent_map(fn, [1, 2, 3], max_workers=2))
+    self.assertIsNone(util.fetch_table.get())
+
+  def test_resolve_url(self):
+    self.mock_head.side_effect = None
+    self.mock_head.return_value = requests_response(
+      '', url='http://final/', content_type='text/html; charset=utf-8')
+
+    with util.fetch_scope() as fetches:
+      for url in 'http://orig/', 'http://ORIG/':
+        self.assertEqual(
+          ('http://final/', 'text/html; charset=utf-8', 200), util.resolve_url(url))
+    self.assertEqual(1, self.mock_head.call_count)
+    self.assertEqual(2, fetches.stats['resolve calls'])
+    self.assertEqual(1, fetches.stats['resolve fetches'])
+
+    # cross-task tier
+    with util.fetch_scope() as fetches:
+      self.assertEqual('http://final/', util.resolve_url('http://orig/').url)
+    self.assertEqual(1, self.mock_head.call_count)
+    self.assertEqual(1, fetches.stats['resolve cross-task hits'])
+
+  def test_resolve_url_doesnt_cache_failures(self):
+    self.mock_head.side_effect = None
+    self.mock_head.return_value = requests_response('', url='http://orig/',
+                                                    status=503)
+
+    for _ in range(2):
+      with util.fetch_scope() as fetches:
+        self.assertEqual(503, util.resolve_url('http://orig/').status_code)
+      self.assertEqual(1, fetches.stats['resolve fetches'])
+    self.assertEqual(2, self.mock_head.call_count)
+
+  def test_resolve_url_cross_task_tier_disabled(self):
+    self.mock_head.side_effect = None
+    self.mock_head.return_value = requests_response('', url='http://final/')
+
+    orig = util.resolve_cache
+    util.resolve_cache = None
+    try:
+      for _ in range(2):
+        with util.fetch_scope() as fetches:
+          self.assertEqual('http://final/', util.resolve_url('http://orig/').url)
+        self.assertEqual(1, fetches.stats['resolve fetches'])
+        self.assertEqual(0, fetches.stats['resolve cross-task hits'])
+    finally:
+      util.resolve_cache = orig
+
+  def test_fetch_mf2_parse_cache(self):
+    html = '<div class="h-entry"><a class="u-url" href="/post"></a></div>'
+    self.mock_get.return_value = requests_response(html, url='http://site/a')
+
+    first = util.fetch_mf2('http://site/a')
+    self.assertEqual(['http://site/post'], first['items'][0]['properties']['url'])
+    self.assertEqual('http://site/a', first['url'])
+
+    # callers can modify the returned mf2
+    first['items'].clear()
+    with patch.object(util.util, 'parse_mf2') as parse:
+      second = util.fetch_mf2('http://site/a')
+      parse.assert_not_called()
+    self.assertEqual(['http://site/post'], second['items'][0]['properties']['url'])
+
+    # same HTML at a different URL resolves relative URLs differently
+    self.mock_get.return_value = requests_response(html, url='http://other/a')
+    third = util.fetch_mf2('http://other/a')
+    self.assertEqual(['http://other/post'], third['items'][0]['properties']['url'])
+
+    info = util.mf2_cache_info()
+    self.assertEqual(1, info['hit'])
+    self.assertEqual(2, info['miss'])
+    self.assertEqual(2, info['entries'])
+
+  def test_fetch_mf2_require_backlink(self):
+    html = '<div class="h-entry"><a class="u-url" href="/post"></a></div>'
+    self.mock_get.return_value = requests_response(html, url='http://site/a')
+
+    self.assertIsNotNone(util.fetch_mf2('http://site/a',
+                                        require_backlink='/post'))
+    # cached, but the backlink is still checked
+    with self.assertRaises(ValueError):
+      util.fetch_mf2('http://site/a', require_backlink='http://missing/')
+
+  def test_parse_mf2_cache_size_limit(self):
+    html = '<div class="h-entry"><p class="p-name">foo</p></div>'
+    size = len(json_dumps(util.parse_mf2(html, url='http://a/')))
+    util.mf2_cache.clear()
+
+    orig = util.mf2_cache
+    util.mf2_cache = util.LRUCache(size * 2, getsizeof=lambda val: val[1])
+    try:
+      for url in 'http://a/', 'http://b/', 'http://c/':
+        util.parse_mf2(html, url=url)
+      self.assertEqual(2, len(util.mf2_cache))
+      self.assertEqual(0, util.mf2_cache_stats['hit'])
+
+      util.parse_mf2(html, url='http://c/')
+      self.assertEqual(1, util.mf2_cache_stats['hit'])
+    finally:
+      util.mf2_cache = orig
+
+  def test_parse_mf2_cache_entry_size_limit(self):
+    html = '<div class="h-entry"><p class="p-name">foo</p></div>'
+    with patch.object(util, 'MF2_CACHE_MAX_ENTRY_BYTES', new=10):
+      util.parse_mf2(html, url='http://a/')
+    self.assertEqual(0, len(util.mf2_cache))
+
+    util.parse_mf2(html, url='http://a/')
+    self.assertEqual(1, len(util.mf2_cache))
+
+  def test_http_pools(self):
+    try:
+      util.configure_http_pools(hosts=3, per_host=2)
+      adapter = util.util.session.get_adapter('https://foo.com/')
+      self.assertEqual(2, adapter.poolmanager.connection_pool_kw['maxsize'])
+      self.assertEqual({'hosts': 0, 'connections': 0, 'requests': 0, 'reused': 0},
+                       util.http_pool_stats())
+
+      pool = adapter.poolmanager.connection_from_url('https://foo.com/')
+      pool.num_connections = 1
+      pool.num_requests = 3
+      self.assertEqual({'hosts': 1, 'connections': 1, 'requests': 3, 'reused': 2},
+                       util.http_pool_stats())
+    finally:
+      util.configure_http_pools()
+
   def test_add_task(self):
     eta = int(util.to_utc_timestamp(util.now())) + 123
     util.add_task('foo', eta_seconds=eta, x='y', z=None)
     self.assert_task('foo', eta_seconds=123, x='y')
 
+  def test_task_batch(self):
+    with util.task_batch():
+      util.add_task('foo', x='y')
+      util.add_task('foo', x='y')
+      with util.task_batch():
+        util.add_task('bar', x='z')
+      self.mock_create_task.assert_not_called()
+
+    self.assert_tasks({'queue': 'foo', 'x': 'y'}, {'queue': 'bar', 'x': 'z'})
+
+  def test_task_batch_flushes_on_exception(self):
+    with self.assertRaises(RuntimeError):
+      with util.task_batch():
+        util.add_task('foo', x='y')
+        raise RuntimeError('oops')
+
+    self.assert_task('foo', x='y')
+
+  def test_task_batch_body_and_flush_fail(self):
+    """The body's exception wins over the task creation error."""
+    self.mock_create_task.side_effect = RuntimeError('boom')
+    with self.assertRaises(ValueError):
+      with util.task_batch():
+        util.add_task('foo', x='y')
+        raise ValueError('oops')
+
+  def test_task_batch_retries(self):
+    self.mock_create_task.side_effect = [RuntimeError('boom'), Task(name='ok')]
+    with util.task_batch():
+      util.add_task('foo', x='y')
+
+    self.assertEqual(2, self.mock_create_task.call_count)
+
+    self.mock_create_task.side_effect = RuntimeError('boom')
+    with self.assertRaises(RuntimeError):
+      with util.task_batch():
+        util.add_task('foo', x='y')
+
   def test_host_url(self):
     with app.test_request_context():
       self.assertEqual('http://localhost/', util.host_url())
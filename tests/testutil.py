@@ -22,7 +22,7 @@ from webutil.util import json_dumps, json_loads
 import requests
 from requests import post as orig_requests_post
 
-import flask_app, flask_background, util
+import flask_app, flask_background, original_post_discovery, util
 from models import BlogPost, Publish, PublishedPage, Response, Source
 
 logger = logging.getLogger(__name__)
@@ -329,6 +329,22 @@ class TestCase(testutil.TestCase):
     util.BLOCKLIST.add('fa.ke')
 
     util.webmention_endpoint_cache.clear()
+    util.webmention_endpoint_cache_stats.clear()
+    util.resolve_cache.clear()
+    util.mf2_cache.clear()
+    util.mf2_cache_stats.clear()
+    util.instance_health_cache.clear()
+    util.token_bucket_cache.clear()
+    util.poll_budget_cache.clear()
+    util.users_page_cache.clear()
+    util.responses_html_cache.clear()
+    util.item_cache.clear()
+
+    # fetch permalinks serially so that tests can mock responses in order
+    patcher = patch.object(original_post_discovery, 'PERMALINK_FETCH_THREADS',
+                           new=1)
+    patcher.start()
+    self.addCleanup(patcher.stop)
     self.mock_create_task = self.start_patch(tasks_client, 'create_task',
                                              return_value=Task(name='my task'))
 
@@ -1,8 +1,13 @@
 """Misc utility constants and classes."""
 import binascii
 import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextlib
+import contextvars
 import copy
+import hashlib
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import logging
 import os
 import random
@@ -10,7 +15,7 @@ import re
 import threading
 import urllib.request, urllib.parse, urllib.error
 
-from cachetools import TTLCache
+from cachetools import LRUCache, TLRUCache, TTLCache
 import flask
 from flask import request
 from google.cloud import ndb
@@ -22,6 +27,7 @@ from granary.source import html_to_text
 from oauth_dropins import bluesky as oauth_bluesky
 from webutil.appengine_config import (
   error_reporting_client,
+  ndb_client,
   tasks_client,
 )
 from webutil import appengine_info
@@ -108,22 +114,131 @@ TASKS_LOCATION = 'us-central1'
 
 FEATURES = ('listen', 'publish', 'webmention', 'email')
 
-webmention_endpoint_cache_lock = threading.RLock()
-webmention_endpoint_cache = TTLCache(5000, 60 * 60 * 2)  # 2h expiration
+# Used as a sentinel value in the webmention endpoint caches
+NO_ENDPOINT = 'NONE'
 
+# How long to cache webmention endpoint discovery results. The default is used
+# when the target doesn't send any cache headers; otherwise we use them, clamped
+# to the min and max.
+WEBMENTION_ENDPOINT_TTL = timedelta(hours=2)
+WEBMENTION_ENDPOINT_TTL_MIN = timedelta(minutes=30)
+WEBMENTION_ENDPOINT_TTL_MAX = timedelta(days=7)
 
-def add_poll_task(source, now=False):
+# In-process tier of the webmention endpoint cache. Values are (str endpoint,
+# datetime expires) tuples, and each entry expires at its own expires time. The
+# datastore tier is models.WebmentionEndpoint.
+webmention_endpoint_cache_lock = threading.RLock()
+webmention_endpoint_cache = TLRUCache(
+  5000, ttu=lambda key, value, time: value[1].timestamp(),
+  timer=lambda: now().timestamp())
+# keys are 'memory hit', 'datastore hit', 'miss'
+webmention_endpoint_cache_stats = collections.Counter()
+
+# the current FetchTable, if any. set by fetch_scope().
+fetch_table = contextvars.ContextVar('fetch_table', default=None)
+
+# Fields that granary.as1.activity_changed compares, in addition to inReplyTo.
+ACTIVITY_CHANGED_FIELDS = ('objectType', 'verb', 'to', 'displayName', 'content',
+                           'summary', 'location', 'image')
+# Size of each hash in Source.seen_responses_fingerprints
+SEEN_RESPONSE_HASH_BYTES = 8
+
+# Result of following a URL's redirects. Returned by resolve_url().
+Resolved = collections.namedtuple('Resolved', ('url', 'content_type', 'status_code'))
+
+# Cross-task tier for resolve_url(), maps normalized URL to Resolved. Only
+# successful resolutions, since failures are often transient. Optional; set to
+# None to disable.
+resolve_cache_lock = threading.Lock()
+resolve_cache = TTLCache(10000, 60 * 60 * 6)  # 6h expiration
+
+# Cross-task cache of parsed mf2, used by parse_mf2(). Keys are (bytes HTML
+# digest, str base URL, str id, bool metaformats) tuples, values are (dict mf2,
+# int size) tuples. Sizes are of the mf2 serialized as JSON, which understates
+# its size in memory by a few times, so the budget is small. Bounded by their
+# total, least recently used evicted first. Entries bigger than
+# MF2_CACHE_MAX_ENTRY_BYTES aren't cached. Optional; set to None to disable.
+MF2_CACHE_MAX_BYTES = 4 * 1000 * 1000
+MF2_CACHE_MAX_ENTRY_BYTES = 200 * 1000
+mf2_cache_lock = threading.Lock()
+mf2_cache = LRUCache(MF2_CACHE_MAX_BYTES, getsizeof=lambda val: val[1])
+# keys are 'hit', 'miss', 'uncacheable'
+mf2_cache_stats = collections.Counter()
+
+# Rendered /users page fragments, keyed by (start name, cursor).
+users_page_cache_lock = threading.Lock()
+users_page_cache = TTLCache(100, 60 * 10)  # 10m expiration
+
+# Rendered user page response lists, keyed by (source key, request URL).
+responses_html_cache_lock = threading.Lock()
+responses_html_cache = TTLCache(1000, 60)  # 1m expiration
+
+# Rendered handlers.Item responses, keyed by (site, key id, path ids, format,
+# scheme). Values are (str body, str content type, str ETag) tuples.
+item_cache_lock = threading.Lock()
+item_cache = TTLCache(5000, 60 * 15)  # 15m expiration, matches Cache-Control
+
+# In-process tier of models.InstanceHealth, so that we don't read it from the
+# datastore on every poll. Maps key id to InstanceHealth or None.
+instance_health_cache_lock = threading.Lock()
+instance_health_cache = TTLCache(1000, 60)  # 1m expiration
+
+# In-process tier of models.TokenBucket. Maps shard key id to the datetime when
+# it next has a token, so that callers don't each read an empty bucket in a
+# transaction until then.
+token_bucket_cache_lock = threading.Lock()
+token_bucket_cache = TTLCache(1000, 60 * 60)  # 1h expiration
+
+# In-process tier of models.PollBudget, which changes daily. Maps its key id to
+# float scale.
+poll_budget_cache_lock = threading.Lock()
+poll_budget_cache = TTLCache(1, 60 * 60)  # 1h expiration
+
+# Connection pool sizes for the shared HTTP session that all outbound fetches
+# use. Pools are per host and keep connections alive between requests, so
+# repeated fetches to the same site skip the TCP and TLS handshakes.
+# HTTP_POOL_HOSTS is how many hosts' pools to keep, least recently used are
+# evicted. HTTP_POOL_CONNECTIONS_PER_HOST is how many idle connections to keep
+# per host. If HTTP_POOL_BLOCK is True, requests wait for a free connection
+# instead of opening extra ones that get discarded afterward.
+HTTP_POOL_HOSTS = 500
+HTTP_POOL_CONNECTIONS_PER_HOST = 20
+HTTP_POOL_BLOCK = False
+
+# Bounds for ActivitiesCache, which is stored in
+# Source.last_activities_cache_json. Entries whose values haven't changed in
+# ACTIVITIES_CACHE_MAX_AGE are evicted so that they get refreshed. If the
+# serialized cache is over ACTIVITIES_CACHE_MAX_BYTES, the least recently used
+# entries are evicted until it fits.
+ACTIVITIES_CACHE_MAX_AGE = timedelta(days=30)
+ACTIVITIES_CACHE_MAX_BYTES = 100 * 1000
+
+# the current task_batch() buffer, if any. maps (queue, body, ETA) to
+# (queue, ETA, params) tuples.
+task_batch_buffer = contextvars.ContextVar('task_batch', default=None)
+TASK_BATCH_THREADS = 10
+TASK_BATCH_ATTEMPTS = 3
+
+
+def add_poll_task(source, now=False, delay=None, eta=None):
   """Adds a poll task for the given source entity.
 
-  Pass ``now=True`` to insert a ``poll-now`` task.
+  Pass ``now=True`` to insert a ``poll-now`` task, ``delay`` to poll after
+  about that long instead of the source's poll period, or ``eta``
+  (:class:`datetime.datetime`) to poll at exactly that time.
   """
   if now:
     queue = 'poll-now'
     eta_seconds = None
+  elif eta:
+    queue = 'poll'
+    eta_seconds = int(util.to_utc_timestamp(eta))
   else:
     queue = 'poll'
     eta_seconds = int(util.to_utc_timestamp(util.now()))
-    if source.AUTO_POLL:
+    if delay:
+      eta_seconds += throttle_delay_seconds(delay)
+    elif source.AUTO_POLL:
       # add poll period. randomize task ETA to within +/- 20% to try to spread
       # out tasks and prevent thundering herds.
       eta_seconds += int(source.poll_period().total_seconds() * random.uniform(.8, 1.2))
@@ -132,25 +247,79 @@ def add_poll_task(source, now=False):
            last_polled=source.last_polled.strftime(POLL_TASK_DATETIME_FORMAT))
 
 
-def add_propagate_task(entity):
-  """Adds a propagate task for the given response entity."""
-  add_task('propagate', response_key=entity.key.urlsafe().decode())
+def add_propagate_task(entity, delay=None):
+  """Adds a propagate task for the given response entity.
+
+  Pass ``delay`` (:class:`datetime.timedelta`) to run it after that long.
+  """
+  add_task('propagate', eta_seconds=delay_eta_seconds(delay),
+           response_key=entity.key.urlsafe().decode())
+
+
+def add_propagate_batch_task(source_key, entities):
+  """Adds a propagate-batch task for the given response entities.
+
+  Args:
+    source_key (ndb.Key): the responses' source
+    entities (sequence of Response)
+  """
+  add_task('propagate-batch', source_key=source_key.urlsafe().decode(),
+           response_keys=','.join(e.key.urlsafe().decode() for e in entities))
+
+
+def add_propagate_blogpost_task(entity, delay=None):
+  """Adds a propagate-blogpost task for the given response entity.
+
+  Pass ``delay`` (:class:`datetime.timedelta`) to run it after that long.
+  """
+  add_task('propagate-blogpost', eta_seconds=delay_eta_seconds(delay),
+           key=entity.key.urlsafe().decode())
 
 
-def add_propagate_blogpost_task(entity):
-  """Adds a propagate-blogpost task for the given response entity."""
-  add_task('propagate-blogpost', key=entity.key.urlsafe().decode())
+def add_discover_task(source, post_id, type=None, delay=None):
+  """Adds a discover task for the given source and silo post id.
 
+  Pass ``delay`` (:class:`datetime.timedelta`) to run it after that long.
+  """
+  add_task('discover', eta_seconds=delay_eta_seconds(delay),
+           source_key=source.key.urlsafe().decode(), post_id=post_id, type=type)
+
+
+def delay_eta_seconds(delay):
+  """Returns a task ETA for a delay, randomized with :func:`throttle_delay_seconds`.
+
+  Args:
+    delay (datetime.timedelta): or None
+
+  Returns:
+    int: POSIX timestamp, or None if ``delay`` is None
+  """
+  if delay:
+    return (int(util.to_utc_timestamp(util.now()))
+            + throttle_delay_seconds(delay))
+
+
+def throttle_delay_seconds(delay):
+  """Randomizes a :meth:`models.Source.throttle` delay by up to 20%.
+
+  Deferred tasks would otherwise all come back as soon as the next token is
+  available, and all but one would be deferred again.
+
+  Args:
+    delay (datetime.timedelta)
 
-def add_discover_task(source, post_id, type=None):
-  """Adds a discover task for the given source and silo post id."""
-  add_task('discover', source_key=source.key.urlsafe().decode(),
-           post_id=post_id, type=type)
+  Returns:
+    int: seconds, at least 1
+  """
+  return max(int(delay.total_seconds() * random.uniform(1, 1.2)), 1)
 
 
 def add_task(queue, eta_seconds=None, **kwargs):
   """Adds a Cloud Tasks task for the given entity.
 
+  Inside a :func:`task_batch`, the task is buffered and created when the batch
+  exits instead.
+
   Args:
     queue (str): queue name
     entity (Source or Webmentions)
@@ -169,6 +338,18 @@ def add_task(queue, eta_seconds=None, **kwargs):
   if eta_seconds:
     params['schedule_time'] = Timestamp(seconds=eta_seconds)
 
+  batch = task_batch_buffer.get()
+  if batch is not None:
+    # dedupe, eg when an ndb transaction that adds a task gets retried
+    key = (queue, params['app_engine_http_request']['body'], eta_seconds)
+    batch.setdefault(key, (queue, eta_seconds, params))
+    return
+
+  _create_task(queue, eta_seconds, params)
+
+
+def _create_task(queue, eta_seconds, params):
+  """Makes the Cloud Tasks API call for :func:`add_task`."""
   queue_path = tasks_client.queue_path(APP_ID, TASKS_LOCATION, queue)
   if appengine_info.LOCAL_SERVER:
     logger.info(f'Would add task: {queue_path} {params}')
@@ -177,6 +358,67 @@ def add_task(queue, eta_seconds=None, **kwargs):
     logger.info(f'Added {queue} task {task.name} with ETA {eta_seconds}: {params}')
 
 
+@contextlib.contextmanager
+def task_batch():
+  """Context manager that batches :func:`add_task` calls.
+
+  Tasks added inside it are buffered, deduplicated, and created concurrently
+  when it exits, even if it exits with an exception, since entities they
+  point to may already be stored. Tasks that fail to create are retried up to
+  :const:`TASK_BATCH_ATTEMPTS` times total; if any still fail, the last error
+  is raised, unless the body raised, in which case it's logged and the body's
+  exception propagates instead.
+
+  Nested batches are merged into the outermost one.
+  """
+  if task_batch_buffer.get() is not None:
+    yield
+    return
+
+  batch = {}
+  token = task_batch_buffer.set(batch)
+  body_failed = True
+  try:
+    yield
+    body_failed = False
+  finally:
+    task_batch_buffer.reset(token)
+    try:
+      _flush_tasks(list(batch.values()))
+    except Exception:
+      if not body_failed:
+        raise
+      logger.warning("Couldn't add batched tasks", exc_info=True)
+
+
+def _flush_tasks(tasks):
+  """Creates buffered tasks concurrently, retrying failures.
+
+  Args:
+    tasks (list): of (str queue, int eta_seconds, dict params) tuples
+  """
+  if not tasks:
+    return
+
+  def create(task):
+    try:
+      _create_task(*task)
+    except Exception as e:
+      return e
+
+  for attempt in range(1, TASK_BATCH_ATTEMPTS + 1):
+    errors = concurrent_map(create, tasks, TASK_BATCH_THREADS)
+    failed = [(task, e) for task, e in zip(tasks, errors) if e]
+    logger.info(f'Added {len(tasks) - len(failed)} of {len(tasks)} batched tasks, attempt {attempt}')
+    if not failed:
+      return
+    for (queue, _, params), e in failed:
+      logger.warning(f'Failed to add {queue} task {params}: {e}')
+    tasks = [task for task, _ in failed]
+
+  raise failed[-1][1]
+
+
 class Redirect(RequestRedirect):
   """Adds login cookie support to :class:`werkzeug.exceptions.RequestRedirect`."""
   logins = None
@@ -234,6 +476,298 @@ def webmention_endpoint_cache_key(url):
   return ' '.join(parts)
 
 
+def webmention_endpoint_ttl(resp):
+  """Returns how long to cache a webmention endpoint discovery result.
+
+  Uses the ``Cache-Control`` or ``Expires`` header in the target's response if
+  available, clamped to ``WEBMENTION_ENDPOINT_TTL_MIN`` and ``_MAX``.
+
+  Args:
+    resp (requests.Response): the target's response during discovery, or None
+
+  Returns:
+    datetime.timedelta:
+  """
+  ttl = WEBMENTION_ENDPOINT_TTL
+
+  if resp is not None:
+    cache_control = resp.headers.get('Cache-Control', '').lower()
+    max_age = re.search(r'max-age=(\d+)', cache_control)
+    expires = resp.headers.get('Expires')
+    if max_age:
+      ttl = timedelta(seconds=int(max_age.group(1)))
+    elif 'no-cache' in cache_control or 'no-store' in cache_control:
+      ttl = WEBMENTION_ENDPOINT_TTL_MIN
+    elif expires:
+      try:
+        ttl = parsedate_to_datetime(expires) - now()
+      except (TypeError, ValueError):
+        pass
+
+  return min(max(ttl, WEBMENTION_ENDPOINT_TTL_MIN), WEBMENTION_ENDPOINT_TTL_MAX)
+
+
+def get_cached_webmention_endpoint(url):
+  """Looks up a webmention endpoint in the in-process cache.
+
+  The datastore tier is loaded into this cache by
+  :meth:`models.WebmentionEndpoint.load`.
+
+  Args:
+    url (str): target URL
+
+  Returns:
+    str: endpoint URL, ``NO_ENDPOINT`` if we didn't find one, or None if
+    it's not cached
+  """
+  with webmention_endpoint_cache_lock:
+    cached = webmention_endpoint_cache.get(webmention_endpoint_cache_key(url))
+    if cached and cached[1] > now():
+      webmention_endpoint_cache_stats['memory hit'] += 1
+      return cached[0]
+
+
+def cache_webmention_endpoint(url, endpoint, resp=None):
+  """Stores a webmention endpoint discovery result in the in-process cache.
+
+  Args:
+    url (str): target URL
+    endpoint (str): endpoint URL, or ``NO_ENDPOINT``
+    resp (requests.Response): the target's response during discovery, used
+      for the TTL. Optional.
+
+  Returns:
+    datetime: when this entry expires
+  """
+  expires = now() + webmention_endpoint_ttl(resp)
+  with webmention_endpoint_cache_lock:
+    webmention_endpoint_cache[webmention_endpoint_cache_key(url)] = (endpoint, expires)
+  return expires
+
+
+class FetchTable:
+  """Thread-safe memo that runs each fetch at most once, even concurrently.
+
+  The first caller for a given key runs the fetch. Concurrent and later callers
+  for the same key wait for it to finish and get the same result, or exception.
+
+  Attributes:
+
+  * hits (int): number of calls that reused another call's result
+  * stats (collections.Counter): other metrics, updated by callers via
+    :meth:`count`
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._futures = {}
+    self.hits = 0
+    self.stats = collections.Counter()
+
+  def count(self, name, n=1):
+    """Increments a metric in ``stats``."""
+    with self._lock:
+      self.stats[name] += n
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._futures
+
+  def get(self, key, fn, *args, **kwargs):
+    """Returns the result of ``fn(*args, **kwargs)``, memoized by ``key``.
+
+    Args:
+      key: hashable
+      fn (callable)
+      args, kwargs: passed to ``fn``
+    """
+    with self._lock:
+      future = self._futures.get(key)
+      owner = future is None
+      if owner:
+        future = self._futures[key] = Future()
+      else:
+        self.hits += 1
+
+    if owner:
+      try:
+        future.set_result(fn(*args, **kwargs))
+      except BaseException as e:
+        future.set_exception(e)
+
+    return future.result()
+
+
+@contextlib.contextmanager
+def fetch_scope():
+  """Shares a :class:`FetchTable` across HTTP fetches inside this block.
+
+  Includes fetches in :func:`concurrent_map` threads started inside the block.
+  If a scope is already active, reuses its table.
+
+  Yields:
+    FetchTable:
+  """
+  table = fetch_table.get()
+  if table is not None:
+    yield table
+    return
+
+  table = FetchTable()
+  token = fetch_table.set(table)
+  try:
+    yield table
+  finally:
+    fetch_table.reset(token)
+
+
+def concurrent_map(fn, items, max_workers):
+  """Calls a function on each item in a thread pool, like :func:`map`.
+
+  Returns results in the same order as ``items``. Exceptions from ``fn``
+  propagate to the caller. Runs inline, without a thread pool, if there's only
+  one item.
+
+  Each call in a thread pool runs in a copy of the caller's context variables,
+  so it sees the caller's Flask app and request context, :class:`FetchTable`,
+  and :func:`task_batch`, if any. ndb contexts aren't thread safe, so instead
+  of the caller's, each call gets its own ndb context with the same settings,
+  eg cache policy.
+
+  Args:
+    fn (callable): takes one item
+    items (iterable)
+    max_workers (int): maximum number of threads
+
+  Returns:
+    list: ``fn``'s return values
+  """
+  items = list(items)
+  if len(items) <= 1 or max_workers <= 1:
+    return [fn(item) for item in items]
+
+  caller = contextvars.copy_context()
+  caller_ndb = ndb.get_context(raise_context_error=False)
+  ndb_kwargs = {}
+  if caller_ndb:
+    ndb_kwargs = {
+      'namespace': caller_ndb.get_namespace(),
+      'cache_policy': caller_ndb.get_cache_policy(),
+      'global_cache': caller_ndb.global_cache,
+      'global_cache_policy': caller_ndb.get_global_cache_policy(),
+      'global_cache_timeout_policy': caller_ndb.get_global_cache_timeout_policy(),
+      'legacy_data': caller_ndb.legacy_data,
+    }
+
+  def call(item):
+    with ndb_client.context(**ndb_kwargs):
+      return fn(item)
+
+  def run(item):
+    # contextvars contexts can only be entered by one thread at a time, so
+    # give each call its own copy, without the caller's ndb context
+    context = contextvars.Context()
+    for var, val in caller.items():
+      if not isinstance(val, ndb.Context):
+        context.run(var.set, val)
+    return context.run(call, item)
+
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+    return list(executor.map(run, items))
+
+
+class ActivitiesCache(util.CacheDict):
+  """Bounded, LRU cache for :meth:`granary.source.Source.get_activities_response`.
+
+  Stored in :attr:`models.Source.last_activities_cache_json` as a JSON list of
+  ``[key, value, updated]`` entries, least recently used first, where
+  ``updated`` is the POSIX timestamp when the value last changed. Also loads
+  the old format, a plain JSON object that maps keys to values.
+
+  Reading or writing an entry makes it the most recently used. :attr:`dirty`
+  is True if any value has been added, changed, or evicted since loading, ie
+  if the cache needs to be stored again. Just reading entries doesn't make it
+  dirty, so recency is only stored along with other changes.
+  """
+  def __init__(self, json_str=None):
+    super().__init__()
+    self.updated = {}
+    self.dirty = False
+
+    if json_str:
+      loaded = json_loads(json_str)
+      if isinstance(loaded, dict):
+        self.update(loaded)
+      else:
+        for key, val, updated in loaded:
+          dict.__setitem__(self, key, val)
+          self.updated[key] = updated
+
+  def _touch(self, key):
+    """Moves an entry to the most recently used end."""
+    dict.__setitem__(self, key, dict.pop(self, key))
+
+  def __getitem__(self, key):
+    val = super().__getitem__(key)
+    self._touch(key)
+    return val
+
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+
+  def get_multi(self, keys):
+    return {k: self[k] for k in keys if k in self}
+
+  def __setitem__(self, key, val):
+    if key not in self or dict.__getitem__(self, key) != val:
+      self.dirty = True
+      self.updated[key] = int(util.to_utc_timestamp(now()))
+    dict.pop(self, key, None)
+    dict.__setitem__(self, key, val)
+
+  def __delitem__(self, key):
+    super().__delitem__(key)
+    self.updated.pop(key, None)
+    self.dirty = True
+
+  def update(self, updates):
+    for key, val in updates.items():
+      self[key] = val
+
+  def set_multi(self, values, **kwargs):
+    """Like :meth:`webutil.util.CacheDict.set_multi`. Ignores ``kwargs``, eg
+    ``time``."""
+    self.update(values)
+
+  def trim(self, activity_ids):
+    """Evicts entries for other activities, old entries, and LRU entries over
+    the size limit.
+
+    Depends on :meth:`granary.source.Source.get_activities_response`'s cache
+    key format, eg ``'PREFIX ACTIVITY_ID'``.
+
+    Args:
+      activity_ids (set of str): silo activity ids to keep entries for
+    """
+    oldest = util.to_utc_timestamp(now() - ACTIVITIES_CACHE_MAX_AGE)
+    for key in list(self):
+      if (key.split()[-1] not in activity_ids
+          or self.updated.get(key, 0) < oldest):
+        del self[key]
+
+    sizes = {key: len(json_dumps([key, val, self.updated[key]])) + 1
+             for key, val in self.items()}
+    size = sum(sizes.values())
+    for key in list(self):
+      if size <= ACTIVITIES_CACHE_MAX_BYTES:
+        break
+      size -= sizes[key]
+      del self[key]
+
+  def to_json(self):
+    """Returns the cache serialized as JSON, in the format described above."""
+    return json_dumps([[key, val, self.updated[key]] for key, val in self.items()])
+
+
 def report_error(msg, **kwargs):
   """Reports an error to StackDriver Error Reporting.
 
@@ -255,6 +789,60 @@ def report_error(msg, **kwargs):
       logger.warning(f'Failed to report error to StackDriver! {msg} {kwargs}', exc_info=True)
 
 
+def configure_http_pools(hosts=None, per_host=None, block=None):
+  """Resizes the connection pools of the shared HTTP session.
+
+  :data:`webutil.util.session` is a single thread-safe :class:`requests.Session`
+  that :func:`requests_get`, :func:`requests_post`, :func:`follow_redirects`,
+  :func:`fetch_mf2`, webmention discovery and sending, and the silo API calls
+  all go through. Its adapters only get big pools in prod, so this makes them
+  consistent everywhere. Existing pooled connections are dropped.
+
+  Args:
+    hosts (int): number of per-host pools to keep, defaults to
+      :const:`HTTP_POOL_HOSTS`
+    per_host (int): max idle connections to keep per host, defaults to
+      :const:`HTTP_POOL_CONNECTIONS_PER_HOST`
+    block (bool): whether to wait for a free connection when a host's pool is
+      exhausted, defaults to :const:`HTTP_POOL_BLOCK`
+  """
+  hosts = hosts or HTTP_POOL_HOSTS
+  per_host = per_host or HTTP_POOL_CONNECTIONS_PER_HOST
+  block = HTTP_POOL_BLOCK if block is None else block
+
+  for adapter in set(util.session.adapters.values()):
+    adapter.poolmanager.clear()
+    adapter.init_poolmanager(hosts, per_host, block=block)
+
+
+def http_pool_stats():
+  """Returns connection reuse stats for the shared HTTP session's pools.
+
+  Only covers hosts whose pools are still alive, ie haven't been evicted.
+
+  Returns:
+    dict: with int values for keys ``hosts``, ``connections`` (new connections
+    opened), ``requests``, and ``reused`` (requests that reused a kept-alive
+    connection)
+  """
+  stats = collections.Counter(hosts=0, connections=0, requests=0)
+
+  for adapter in set(util.session.adapters.values()):
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+      pool = pools.get(key)
+      if pool:
+        stats['hosts'] += 1
+        stats['connections'] += pool.num_connections
+        stats['requests'] += pool.num_requests
+
+  stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+  return dict(stats)
+
+
+configure_http_pools()
+
+
 def requests_get(url, **kwargs):
   """Wraps :func:`requests.get` with extra semantics and our user agent.
 
@@ -278,9 +866,113 @@ def requests_get(url, **kwargs):
   return util.requests_get(url, **kwargs)
 
 
-def fetch_mf2(url, **kwargs):
-  """Injects :func:`requests_get` into :func:`webutil.util.fetch_mf2`."""
-  return util.fetch_mf2(url, get_fn=requests_get, **kwargs)
+def fetch_mf2(url, get_fn=requests_get, gateway=False, require_backlink=None,
+              metaformats=False, **kwargs):
+  """Wraps :func:`webutil.util.fetch_mf2` with :attr:`mf2_cache`.
+
+  Uses :func:`requests_get` by default. Fetches the page, then only passes it
+  to webutil to check and parse if the cache doesn't already have the result
+  for identical HTML.
+
+  Args: see :func:`webutil.util.fetch_mf2`
+
+  Returns:
+    dict: parsed mf2 data, or None. A new copy that callers may modify.
+  """
+  resp = get_fn(util.fragmentless(url), gateway=gateway, **kwargs)
+
+  def fetch():
+    return util.fetch_mf2(url, get_fn=lambda *args, **kwargs: resp,
+                          require_backlink=require_backlink,
+                          metaformats=metaformats)
+
+  if mf2_cache is None:
+    return fetch()
+
+  if require_backlink and not isinstance(require_backlink, (tuple, list)):
+    require_backlink = [require_backlink]
+  key = ('fetch', hashlib.blake2b(resp.content, digest_size=16).digest(),
+         url, resp.url, resp.status_code, resp.headers.get('Content-Type'),
+         tuple(require_backlink or ()), bool(metaformats))
+  cached = _mf2_cache_get(key)
+  if cached:
+    return cached
+
+  mf2 = fetch()
+  if mf2:
+    _mf2_cache_put(key, mf2)
+  return mf2
+
+
+def parse_mf2(input, url=None, id=None, metaformats=None):
+  r"""Wraps :func:`webutil.util.parse_mf2` with :attr:`mf2_cache`.
+
+  Only caches HTML input as a string, bytes, or :class:`requests.Response`, not
+  already parsed :class:`bs4.BeautifulSoup`\s.
+
+  Args: see :func:`webutil.util.parse_mf2`
+
+  Returns:
+    dict: parsed mf2 data. A new copy that callers may modify.
+  """
+  if isinstance(input, requests.Response):
+    url = url or input.url
+    html = input.content
+  elif isinstance(input, str):
+    html = input.encode()
+  elif isinstance(input, bytes):
+    html = input
+  else:
+    html = None
+
+  if html is None or mf2_cache is None:
+    with mf2_cache_lock:
+      mf2_cache_stats['uncacheable'] += 1
+    return util.parse_mf2(input, url=url, id=id, metaformats=metaformats)
+
+  key = (hashlib.blake2b(html, digest_size=16).digest(), url, id,
+         bool(metaformats))
+  cached = _mf2_cache_get(key)
+  if cached:
+    return cached
+
+  mf2 = util.parse_mf2(input, url=url, id=id, metaformats=metaformats)
+  _mf2_cache_put(key, mf2)
+  return mf2
+
+
+def _mf2_cache_get(key):
+  """Returns a copy of a cached mf2 value from :attr:`mf2_cache`, or None."""
+  with mf2_cache_lock:
+    cached = mf2_cache.get(key)
+    mf2_cache_stats['hit' if cached else 'miss'] += 1
+
+  if cached:
+    return copy.deepcopy(cached[0])
+
+
+def _mf2_cache_put(key, mf2):
+  """Stores a copy of an mf2 value in :attr:`mf2_cache`, if it's not too big."""
+  size = len(json_dumps(mf2))
+  if size <= min(MF2_CACHE_MAX_ENTRY_BYTES, mf2_cache.maxsize):
+    with mf2_cache_lock:
+      mf2_cache[key] = (copy.deepcopy(mf2), size)
+
+
+def mf2_cache_info():
+  """Returns :attr:`mf2_cache` hit rate and size stats.
+
+  Returns:
+    dict: :attr:`mf2_cache_stats`, plus float ``hit rate`` and int ``entries``
+    and ``bytes``
+  """
+  with mf2_cache_lock:
+    info = dict(mf2_cache_stats)
+    lookups = mf2_cache_stats['hit'] + mf2_cache_stats['miss']
+    info['hit rate'] = round(mf2_cache_stats['hit'] / lookups, 3) if lookups else 0
+    if mf2_cache is not None:
+      info.update({'entries': len(mf2_cache), 'bytes': mf2_cache.currsize})
+    return info
 
 
 def requests_post(url, **kwargs):
@@ -290,8 +982,69 @@ def requests_post(url, **kwargs):
 
 
 def follow_redirects(url):
-  """Wraps :func:`webutil.util.follow_redirects` with our headers."""
-  return util.follow_redirects(url, headers=request_headers(url=url))
+  """Wraps :func:`webutil.util.follow_redirects` with our headers.
+
+  Inside a :func:`fetch_scope`, concurrent calls for the same URL only fetch it
+  once. webutil caches results across calls for a day, so we evict failures
+  from its cache, since they're often transient, eg 5xx or connection errors.
+  """
+  headers = request_headers(url=url)
+  table = fetch_table.get()
+  if table is None:
+    resp = util.follow_redirects(url, headers=headers)
+  else:
+    resp = table.get(('follow_redirects', url), util.follow_redirects, url,
+                     headers=headers)
+
+  if not resp.ok:
+    with util.follow_redirects_cache_lock:
+      util.follow_redirects_cache.pop(url, None)
+  return resp
+
+
+def resolve_url(url):
+  """Follows a URL's redirects and returns its final URL and content type.
+
+  Memoized per task in the current :func:`fetch_scope`, if any, and across
+  tasks in ``resolve_cache``, if it's enabled, but only if it succeeded, ie the
+  final response wasn't an HTTP error or connection failure. Counts calls, fetches, and
+  cross-task hits in the current :class:`FetchTable`'s ``stats``.
+
+  Args:
+    url (str)
+
+  Returns:
+    Resolved:
+  """
+  parsed = urllib.parse.urlsplit(url)
+  key = parsed._replace(scheme=parsed.scheme.lower(),
+                        netloc=parsed.netloc.lower()).geturl()
+  table = fetch_table.get()
+
+  if table:
+    table.count('resolve calls')
+
+  def resolve():
+    if resolve_cache is not None:
+      with resolve_cache_lock:
+        cached = resolve_cache.get(key)
+      if cached:
+        if table:
+          table.count('resolve cross-task hits')
+        return cached
+
+    if table:
+      table.count('resolve fetches')
+    resp = follow_redirects(url)
+    resolved = Resolved(resp.url, resp.headers.get('content-type', ''),
+                        resp.status_code)
+
+    if resolve_cache is not None and resp.ok:
+      with resolve_cache_lock:
+        resolve_cache[key] = resolved
+    return resolved
+
+  return table.get(('resolve', key), resolve) if table else resolve()
 
 
 def request_headers(url=None, source=None):
@@ -328,8 +1081,8 @@ def get_webmention_target(url, resolve=True, replace_test_domains=True):
   send = True
   if resolve:
     # this follows *all* redirects, until the end
-    resolved = follow_redirects(url)
-    html = (resolved.headers.get('content-type', '').split(';')[0]
+    resolved = resolve_url(url)
+    html = (resolved.content_type.split(';')[0]
             in ('text/html', 'text/mf2+html'))
     send = html and resolved.status_code != util.HTTP_RESPONSE_TOO_BIG_STATUS_CODE
     url, domain, _ = get_webmention_target(
@@ -429,6 +1182,78 @@ def prune_response(response):
   return trim_nulls({k: v for k, v in response.items() if k not in drop})
 
 
+def response_fingerprint(response):
+  """Returns a short hash of the parts of a response that can change.
+
+  Covers the same fields, on the response and its object, that
+  :func:`granary.as1.activity_changed` compares. Two responses have the same
+  fingerprint if and only if (modulo hash collisions) ``activity_changed``
+  considers them unchanged.
+
+  Args:
+    response (dict): ActivityStreams response object, pruned or not
+
+  Returns:
+    bytes: :const:`SEEN_RESPONSE_HASH_BYTES` long
+  """
+  def fields(obj):
+    vals = {field: trim_nulls(obj.get(field)) for field in ACTIVITY_CHANGED_FIELDS}
+    in_reply_to = obj.get('inReplyTo')
+    if isinstance(in_reply_to, dict):
+      in_reply_to = {k: v for k, v in in_reply_to.items() if k != 'author'}
+    vals['inReplyTo'] = trim_nulls(in_reply_to)
+    return {k: v for k, v in vals.items() if v}
+
+  data = json_dumps([fields(response), fields(as1.get_object(response))],
+                    sort_keys=True)
+  return hashlib.blake2b(data.encode(), digest_size=SEEN_RESPONSE_HASH_BYTES).digest()
+
+
+def seen_response_key(id):
+  """Returns the hash of a response id used in seen response fingerprints.
+
+  Args:
+    id (str): response id
+
+  Returns:
+    bytes: :const:`SEEN_RESPONSE_HASH_BYTES` long
+  """
+  return hashlib.blake2b(id.encode(), digest_size=SEEN_RESPONSE_HASH_BYTES).digest()
+
+
+def encode_seen_responses(seen):
+  """Serializes seen response fingerprints into
+  :attr:`models.Source.seen_responses_fingerprints`.
+
+  The format is just concatenated fixed width records, each one a
+  :func:`seen_response_key` followed by a :func:`response_fingerprint`.
+
+  Args:
+    seen (dict): maps bytes id hash to bytes fingerprint
+
+  Returns:
+    bytes:
+  """
+  return b''.join(key + fingerprint for key, fingerprint in seen.items())
+
+
+def decode_seen_responses(data):
+  """Deserializes :attr:`models.Source.seen_responses_fingerprints`.
+
+  Args:
+    data (bytes): from :func:`encode_seen_responses`
+
+  Returns:
+    dict: maps bytes id hash to bytes fingerprint
+  """
+  if not data:
+    return {}
+
+  n = SEEN_RESPONSE_HASH_BYTES
+  return {data[i:i + n]: data[i + n:i + 2 * n]
+          for i in range(0, len(data) - 2 * n + 1, 2 * n)}
+
+
 def replace_test_domains_with_localhost(url):
   """Replace domains in ``LOCALHOST_TEST_DOMAINS`` with localhost for testing.
 
@@ -23,11 +23,12 @@ Making an API call with an access token from the command line::
 """
 import collections
 import logging
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 
 from flask import request
 from google.cloud import ndb
 from oauth_dropins import wordpress_rest as oauth_wordpress
+import requests
 from webutil.flask_util import error, flash
 from webutil.util import json_dumps, json_loads
 
@@ -144,10 +145,9 @@ class WordPress(models.Source):
     # create the comment
     url = API_CREATE_COMMENT_URL % (auth_entity.blog_id, post_id)
     content = f'<a href="{author_url}">{author_name}</a>: {content}'
-    data = {'content': content.encode()}
     try:
-      resp = self.urlopen(auth_entity, url, data=urllib.parse.urlencode(data))
-    except urllib.error.HTTPError as e:
+      resp = self.urlopen(auth_entity, url, data={'content': content})
+    except requests.HTTPError as e:
       code, body = util.interpret_http_exception(e)
       try:
         parsed = json_loads(body) if body else {}
@@ -177,7 +177,7 @@ class WordPress(models.Source):
     """
     try:
       return cls.urlopen(auth_entity, API_SITE_URL % auth_entity.blog_id)
-    except urllib.error.HTTPError as e:
+    except requests.HTTPError as e:
       code, body = util.interpret_http_exception(e)
       if (code == '403' and '"API calls to this blog have been disabled."' in body):
         flash(f'You need to <a href="http://jetpack.me/support/json-api/">enable the Jetpack JSON API</a> in {util.pretty_link(auth_entity.blog_url)}\'s WordPress admin console.')
@@ -186,10 +186,33 @@ class WordPress(models.Source):
       raise
 
   @staticmethod
-  def urlopen(auth_entity, url, **kwargs):
-    resp = auth_entity.urlopen(url, **kwargs).read()
-    logger.debug(resp)
-    return json_loads(resp)
+  def urlopen(auth_entity, url, data=None):
+    """Makes an authenticated WordPress REST API call.
+
+    Uses the shared, pooled HTTP session, so consecutive calls reuse the same
+    connection to the API.
+
+    Args:
+      auth_entity (oauth_dropins.wordpress_rest.WordPressAuth)
+      url (str)
+      data (dict): optional form-encoded POST body. If provided, makes a POST
+        request, otherwise a GET.
+
+    Returns:
+      dict: decoded JSON response
+
+    Raises:
+      requests.HTTPError: if the API returns an HTTP error
+    """
+    headers = {'Authorization': f'Bearer {auth_entity.access_token()}'}
+    if data is None:
+      resp = util.requests_get(url, headers=headers)
+    else:
+      resp = util.requests_post(url, data=data, headers=headers)
+
+    logger.debug(resp.text)
+    resp.raise_for_status()
+    return json_loads(resp.text)
 
 
 class Add(oauth_wordpress.Callback):